@@ -0,0 +1,10 @@
+# asgi.py (at the project root, next to run.py)
+# ASGI entry point: the WhatsApp webhook runs on asyncio (src/async_webhook.py),
+# every other route is the regular Flask app.
+#   uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 2
+import os
+from src import create_app
+from src.async_webhook import create_asgi_app
+
+flask_app = create_app(os.getenv('FLASK_CONFIG') or 'default')
+app = create_asgi_app(flask_app)
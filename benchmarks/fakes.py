@@ -0,0 +1,240 @@
+# benchmarks/fakes.py
+# Local stand-ins for Dialogflow and the Twilio media endpoint, with configurable latency.
+import asyncio
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Text -> intent rules for the fake agent (first match wins); anything else hits the fallback intent
+TEXT_RULES = [
+    ('check in', 'CheckIn'), ('checkin', 'CheckIn'),
+    ('check out', 'CheckOut'), ('checkout', 'CheckOut'),
+    ('salary', 'SalaryInquiry'),
+    ('hello', 'Default Welcome Intent'), ('hi', 'Default Welcome Intent'),
+]
+
+# Fake voice notes carry this marker followed by the intent the "speech" contains (in the OpusTags header)
+AUDIO_MARKER = b'FAKEOPUS:'
+
+
+def _ogg_page(payload_packets, granule, sequence, header_type=0, serial=0x4C48):
+    # Imported here: importing src loads the config, which the benchmark sets up through env vars first
+    from src.voice import ogg_crc
+
+    lacing = bytearray()
+    for packet in payload_packets:
+        lacing.extend(b'\xff' * (len(packet) // 255) + bytes([len(packet) % 255]))
+    page = bytearray(struct.pack('<4sBBqIIIB', b'OggS', 0, header_type, granule, serial, sequence, 0, len(lacing)))
+    page += lacing + b''.join(payload_packets)
+    page[22:26] = struct.pack('<I', ogg_crc(page))
+    return bytes(page)
+
+
+def make_voice_note(label, seconds=2.0, packet_bytes=40, silent=False, sample_rate=16000, channels=1):
+    """A structurally valid Ogg/Opus voice note: 20 ms SILK packets, one page per second, label in the tags."""
+    pre_skip = 312
+    head = b'OpusHead' + struct.pack('<BBHIhB', 1, channels, pre_skip, sample_rate, 0, 0)
+    vendor = AUDIO_MARKER + label.encode() + b'\n'
+    tags = b'OpusTags' + struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', 0)
+    pages = [_ogg_page([head], 0, 0, header_type=0x02), _ogg_page([tags], 0, 1)]
+    packet = bytes([(9 << 3) | 0]) + b'\x55' * ((2 if silent else packet_bytes) - 1) # TOC: SILK wideband, 20 ms
+    total = int(seconds * 50)
+    for second, start in enumerate(range(0, total, 50)):
+        count = min(50, total - start)
+        granule = pre_skip + (start + count) * 960
+        pages.append(_ogg_page([packet] * count, granule, second + 2, header_type=0x04 if start + count >= total else 0))
+    return b''.join(pages)
+
+
+def _dialogflow():
+    # Imported on first use, like the app does (src/lazy.py), so startup_bench.py measures the app's own SDK import
+    from google.cloud import dialogflow
+    return dialogflow
+
+
+def _delay(mean_ms, jitter_ms):
+    if mean_ms <= 0:
+        return 0.0
+    return max(0.0, random.gauss(mean_ms, jitter_ms)) / 1000.0
+
+
+def _latency(mean_ms, jitter_ms):
+    time.sleep(_delay(mean_ms, jitter_ms))
+
+
+class FakeSessionsClient:
+    """Implements the parts of dialogflow.SessionsClient the app uses."""
+
+    def __init__(self, latency_ms=80.0, jitter_ms=20.0, audio_latency_ms=400.0, outage=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.audio_latency_ms = audio_latency_ms
+        self.outage = outage # None, 'unavailable' (fails fast) or 'timeout' (hangs until the call's deadline)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def session_path(self, project, session):
+        return f"projects/{project}/agent/sessions/{session}"
+
+    def _count(self):
+        with self._lock:
+            self.calls += 1
+
+    def _outage_delay(self, timeout):
+        """Seconds to wait before failing the call, or None when the agent is up."""
+        if self.outage is None:
+            return None
+        return _delay(20, 5) if self.outage == 'unavailable' else (timeout or 5.0)
+
+    def _outage_error(self):
+        from google.api_core.exceptions import DeadlineExceeded, ServiceUnavailable
+        if self.outage == 'unavailable':
+            return ServiceUnavailable("failed to connect to all addresses")
+        return DeadlineExceeded("Deadline Exceeded")
+
+    @staticmethod
+    def _result(intent, query_text):
+        fallback = intent == 'Default Fallback Intent'
+        dialogflow = _dialogflow()
+        return dialogflow.QueryResult(
+            query_text=query_text,
+            intent=dialogflow.Intent(display_name=intent),
+            all_required_params_present=True,
+            fulfillment_text="Sorry, could you say that again?" if fallback else '',
+        )
+
+    def detect_intent(self, request, timeout=None):
+        self._count()
+        outage_delay = self._outage_delay(timeout)
+        if outage_delay is not None:
+            time.sleep(outage_delay)
+            raise self._outage_error()
+        query_input = request['query_input']
+        if 'input_audio' in request:
+            _latency(self.audio_latency_ms, self.jitter_ms)
+            intent = self._intent_from_audio(request['input_audio'])
+            return _dialogflow().DetectIntentResponse(query_result=self._result(intent, intent.lower()))
+        _latency(self.latency_ms, self.jitter_ms)
+        text = query_input.text.text
+        lowered = text.lower()
+        intent = next((name for key, name in TEXT_RULES if key in lowered), 'Default Fallback Intent')
+        return _dialogflow().DetectIntentResponse(query_result=self._result(intent, text))
+
+    def streaming_detect_intent(self, requests, timeout=None):
+        self._count()
+        outage_delay = self._outage_delay(timeout)
+        if outage_delay is not None:
+            time.sleep(outage_delay)
+            raise self._outage_error()
+        audio = bytearray()
+        for req in requests: # Drains the download just like the real client would
+            audio.extend(req.input_audio)
+        _latency(self.audio_latency_ms, self.jitter_ms)
+        intent = self._intent_from_audio(bytes(audio))
+        yield _dialogflow().StreamingDetectIntentResponse(query_result=self._result(intent, intent.lower()))
+
+    @staticmethod
+    def _intent_from_audio(audio):
+        start = audio.find(AUDIO_MARKER)
+        if start >= 0:
+            label = audio[start + len(AUDIO_MARKER):].split(b'\n', 1)[0].decode()
+            return label.split('#', 1)[0] or 'Default Fallback Intent'
+        return 'Default Fallback Intent'
+
+
+class FakeSessionsAsyncClient(FakeSessionsClient):
+    """Same fake agent with the dialogflow.SessionsAsyncClient interface (for the ASGI path)."""
+
+    async def detect_intent(self, request, timeout=None):
+        self._count()
+        outage_delay = self._outage_delay(timeout)
+        if outage_delay is not None:
+            await asyncio.sleep(outage_delay)
+            raise self._outage_error()
+        if 'input_audio' in request:
+            await asyncio.sleep(_delay(self.audio_latency_ms, self.jitter_ms))
+            intent = self._intent_from_audio(request['input_audio'])
+            return _dialogflow().DetectIntentResponse(query_result=self._result(intent, intent.lower()))
+        await asyncio.sleep(_delay(self.latency_ms, self.jitter_ms))
+        text = request['query_input'].text.text
+        intent = next((name for key, name in TEXT_RULES if key in text.lower()), 'Default Fallback Intent')
+        return _dialogflow().DetectIntentResponse(query_result=self._result(intent, text))
+
+    async def streaming_detect_intent(self, requests, timeout=None):
+        self._count()
+        outage_delay = self._outage_delay(timeout)
+        if outage_delay is not None:
+            await asyncio.sleep(outage_delay)
+            raise self._outage_error()
+        audio = bytearray()
+        async for req in requests:
+            audio.extend(req.input_audio)
+        await asyncio.sleep(_delay(self.audio_latency_ms, self.jitter_ms))
+        intent = self._intent_from_audio(bytes(audio))
+
+        async def responses():
+            yield _dialogflow().StreamingDetectIntentResponse(query_result=self._result(intent, intent.lower()))
+        return responses()
+
+
+class FakeMediaServer:
+    """
+    Serves Twilio-style media URLs from a local HTTP server:
+      /audio/<Intent>/<n>  -> fake voice note recognized as <Intent> (distinct bytes per n)
+      /image/<n>           -> JPEG-sized blob
+    """
+
+    def __init__(self, latency_ms=150.0, jitter_ms=40.0, audio_bytes=24 * 1024, image_bytes=300 * 1024):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.audio_bytes = audio_bytes
+        self.image_bytes = image_bytes
+        self._server = None
+        self._thread = None
+        self._image_padding = b'\0' * max(0, image_bytes - 20)
+
+    def start(self):
+        server_ref = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                _latency(server_ref.latency_ms, server_ref.jitter_ms)
+                parts = self.path.strip('/').split('/')
+                if parts[0] == 'audio' and len(parts) >= 2:
+                    # ~16 kbit/s, so audio_bytes sets the clip length
+                    label = parts[1] + ('#' + parts[2] if len(parts) > 2 else '')
+                    body = make_voice_note(label, seconds=max(0.2, server_ref.audio_bytes / 2000))
+                    content_type = 'audio/ogg'
+                elif parts[0] == 'image':
+                    # Random bytes up front so every upload is a distinct file
+                    body = b'\xff\xd8\xff\xe0' + random.randbytes(16) + server_ref._image_padding
+                    content_type = 'image/jpeg'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
@@ -0,0 +1,179 @@
+# benchmarks/hours_bench.py
+# Benchmark for the attendance hours engine (src/hours.py) on a large synthetic attendance_logs table.
+# Generates workers x days of checkin/checkout events with realistic noise (missing checkouts,
+# repeated checkins/checkouts, overnight shifts), then times:
+#   - a worker's 'hours' inquiry (one worker, current month)
+#   - an employer's 'roster' (ROSTER_SIZE workers, current month)
+#   - the same roster computed the obvious way (ORM rows paired in Python), for comparison
+#
+#   python -m benchmarks.hours_bench --workers 2500 --days 200          # ~1M rows in a temp SQLite file
+#   python -m benchmarks.hours_bench --database-url postgresql://... --workers 10000 --days 365
+#   python -m benchmarks.hours_bench --drop-index                        # without ix_attendance_logs_user_timestamp
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.webhook_bench import RESULTS_DIR, summarize
+
+INSERT_BATCH = 50000
+
+
+def generate_events(user_ids, days, end, seed):
+    """Yields attendance rows: one shift per worker per working day, with noise."""
+    rng = random.Random(seed)
+    first_day = end - timedelta(days=days)
+    for user_id in user_ids:
+        night_worker = rng.random() < 0.1
+        for offset in range(days):
+            if rng.random() < 0.15: # Day off
+                continue
+            day = first_day + timedelta(days=offset)
+            start = day + timedelta(hours=(20 if night_worker else 8) + rng.random() * 2)
+            length = timedelta(hours=7 + rng.random() * 3)
+            yield {'user_id': user_id, 'log_type': 'checkin', 'timestamp': start}
+            if rng.random() < 0.05: # Double-tapped checkin
+                yield {'user_id': user_id, 'log_type': 'checkin', 'timestamp': start + timedelta(minutes=rng.randint(1, 20))}
+            if rng.random() < 0.04: # Forgot to check out
+                continue
+            yield {'user_id': user_id, 'log_type': 'checkout', 'timestamp': start + length}
+            if rng.random() < 0.03: # Checked out twice
+                yield {'user_id': user_id, 'log_type': 'checkout', 'timestamp': start + length + timedelta(minutes=rng.randint(1, 30))}
+
+
+def naive_roster_hours(session, user_ids, start, end, max_shift_hours):
+    """Reference implementation: load every event and pair them in Python (what the engine replaces)."""
+    from src.models import AttendanceLog
+
+    max_shift = timedelta(hours=max_shift_hours)
+    totals = {}
+    for user_id in user_ids:
+        rows = session.query(AttendanceLog).filter(
+            AttendanceLog.user_id == user_id,
+            AttendanceLog.timestamp >= start - max_shift, AttendanceLog.timestamp < end + max_shift,
+        ).order_by(AttendanceLog.timestamp, AttendanceLog.id).all()
+        # Same rules as the engine: keep the first of repeated checkins and the last of repeated checkouts
+        kept = []
+        for i, row in enumerate(rows):
+            if row.log_type == 'checkin':
+                prev = rows[i - 1] if i else None
+                if prev is None or prev.log_type != 'checkin' or row.timestamp - prev.timestamp > max_shift:
+                    kept.append(row)
+            else:
+                nxt = rows[i + 1] if i + 1 < len(rows) else None
+                if nxt is None or nxt.log_type != 'checkout' or nxt.timestamp - row.timestamp > max_shift:
+                    kept.append(row)
+        seconds = 0.0
+        for row, nxt in zip(kept, kept[1:]):
+            if row.log_type == 'checkin' and nxt.log_type == 'checkout' and start <= row.timestamp < end:
+                if nxt.timestamp - row.timestamp <= max_shift:
+                    seconds += (nxt.timestamp - row.timestamp).total_seconds()
+        totals[user_id] = round(seconds / 3600.0, 2)
+    return totals
+
+
+def timed_runs(func, runs):
+    samples = []
+    result = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=2500)
+    parser.add_argument('--days', type=int, default=200)
+    parser.add_argument('--roster-size', type=int, default=300, help='Workers in the employer roster query')
+    parser.add_argument('--runs', type=int, default=20, help='Timed repetitions per query')
+    parser.add_argument('--naive-runs', type=int, default=3, help='Repetitions of the Python-loop baseline (0 skips it)')
+    parser.add_argument('--database-url', help='Benchmark against this database instead of a temp SQLite file')
+    parser.add_argument('--drop-index', action='store_true', help='Drop ix_attendance_logs_user_timestamp first')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', help='Where to write the JSON results (default: benchmarks/results/)')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='lighthouse-hours-')
+    os.environ['TEST_DATABASE_URL'] = args.database_url or 'sqlite:///' + os.path.join(workdir, 'hours.db')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+    from src import create_app
+    from src.models import db, User, AttendanceLog
+    from src.hours import hours_by_worker, month_range
+
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        if db.session.query(AttendanceLog.id).first() is not None:
+            print("attendance_logs is not empty; point --database-url at a scratch database.", file=sys.stderr)
+            return 2
+
+        now = datetime.utcnow()
+        started = time.perf_counter()
+        db.session.execute(db.insert(User), [
+            {'whatsapp_number': f'whatsapp:+91{9000000000 + i}', 'sampatti_card_id': f'BENCH{i:06d}', 'role': 'worker'}
+            for i in range(args.workers)
+        ])
+        user_ids = [row[0] for row in db.session.query(User.id).order_by(User.id)]
+        batch = []
+        rows = 0
+        for event in generate_events(user_ids, args.days, now.replace(hour=0, minute=0, second=0, microsecond=0), args.seed):
+            batch.append(event)
+            if len(batch) >= INSERT_BATCH:
+                db.session.execute(db.insert(AttendanceLog), batch)
+                rows += len(batch)
+                batch = []
+        if batch:
+            db.session.execute(db.insert(AttendanceLog), batch)
+            rows += len(batch)
+        db.session.commit()
+        if args.drop_index:
+            db.session.execute(db.text('DROP INDEX IF EXISTS ix_attendance_logs_user_timestamp'))
+            db.session.commit()
+        if db.engine.dialect.name == 'sqlite':
+            db.session.execute(db.text('ANALYZE'))
+        print(f"Loaded {rows} attendance rows for {args.workers} workers in {time.perf_counter() - started:.1f}s")
+
+        rng = random.Random(args.seed)
+        start, end = month_range(now.date())
+        max_shift = app.config['ATTENDANCE_MAX_SHIFT_HOURS']
+        roster = rng.sample(user_ids, min(args.roster_size, len(user_ids)))
+
+        results = {}
+        worker_samples, _ = timed_runs(lambda: hours_by_worker(db.session, [rng.choice(user_ids)], start, end, max_shift), args.runs)
+        results['worker_month'] = summarize(worker_samples)
+        roster_samples, engine_totals = timed_runs(lambda: hours_by_worker(db.session, roster, start, end, max_shift), args.runs)
+        results['roster_month'] = summarize(roster_samples)
+        dialect = db.engine.dialect.name
+        if args.naive_runs:
+            naive_samples, naive_totals = timed_runs(lambda: naive_roster_hours(db.session, roster, start, end, max_shift), args.naive_runs)
+            results['roster_month_python_loop'] = summarize(naive_samples)
+            mismatched = [u for u in roster if abs(naive_totals.get(u, 0) - (engine_totals[u].hours if u in engine_totals else 0)) > 0.01]
+            results['python_loop_mismatches'] = len(mismatched)
+
+    print(f"\n{'query':<28} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+    for name, stats in results.items():
+        if isinstance(stats, dict):
+            print(f"{name:<28} {stats['count']:>6} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['max_ms']:>9}")
+    if 'python_loop_mismatches' in results:
+        print(f"\nRoster totals differing from the Python loop: {results['python_loop_mismatches']}")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"hours-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'config': {k: v for k, v in vars(args).items() if k != 'database_url'},
+            'dialect': dialect, 'rows': rows, 'results': results,
+        }, f, indent=2)
+    print(f"Results saved to {output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,205 @@
+# benchmarks/startup_bench.py
+# Cold-start benchmark: each run is a fresh Python process that imports the app, calls
+# create_app('testing') and answers its first two messages, as a container woken from zero would.
+#   import       - `import src` (config, models, SQLAlchemy, Flask)
+#   create_app   - building the app, blueprints, caches and queues
+#   ready        - import + create_app: when the server could start accepting requests
+#   first_local  - first message handled by the local command matcher ('checkin')
+#   first_nlp    - first message that needs Dialogflow (a local fake; pays for the SDK import unless
+#                  the preload already did it)
+#   process      - the whole process, from spawn to exit
+# Every SDK_PRELOAD mode given is measured, so the cost of the deferred imports shows up where it is paid.
+# --gap-ms waits between ready and the first message, e.g. for the load balancer's health check.
+#
+#   python -m benchmarks.startup_bench --runs 7
+#   python -m benchmarks.startup_bench --gap-ms 500   # gives the background preload time to finish
+#   python -m benchmarks.startup_bench --modes off,background --compare benchmarks/results/startup-20250101-120000.json
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from benchmarks.webhook_bench import RESULTS_DIR, summarize
+
+MODES = ('off', 'background', 'eager')
+METRICS = ('import', 'create_app', 'ready', 'first_local', 'first_nlp', 'process')
+# Reported when already loaded once the app is ready (anything here is paid for before the first request)
+HEAVY_MODULES = ('google.cloud.dialogflow', 'google.api_core.exceptions', 'grpc', 'requests', 'twilio.rest', 'aiohttp')
+SENDER = 'whatsapp:+919000000001'
+
+
+def child_env(workdir, mode, gap_ms=0):
+    env = dict(os.environ)
+    env.update({
+        'DIALOGFLOW_PROJECT_ID': env.get('DIALOGFLOW_PROJECT_ID', 'bench-project'),
+        'TWILIO_ACCOUNT_SID': 'ACbench', 'TWILIO_AUTH_TOKEN': 'bench-token',
+        'TEST_DATABASE_URL': 'sqlite:///' + os.path.join(workdir, 'startup.db'),
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'LOG_LEVEL': env.get('LOG_LEVEL', 'WARNING'),
+        'RATE_LIMIT_ENABLED': '0',
+        'SDK_PRELOAD': mode,
+        'STARTUP_BENCH_GAP_MS': str(gap_ms),
+    })
+    return env
+
+
+def prepare_database(workdir):
+    """Creates the schema and the registered sender once, in a separate process, so runs only read it."""
+    script = (
+        "from src import create_app\n"
+        "from src.models import db, User\n"
+        "app = create_app('testing')\n"
+        "with app.app_context():\n"
+        "    db.create_all()\n"
+        f"    db.session.add(User(whatsapp_number={SENDER!r}, sampatti_card_id='W0000001', role='worker'))\n"
+        "    db.session.commit()\n"
+    )
+    subprocess.run([sys.executable, '-c', script], env=child_env(workdir, 'off'), check=True)
+
+
+def child():
+    """One measured cold start; prints its timings (ms) as a JSON line."""
+    started = time.perf_counter()
+    from src import create_app
+    imported = time.perf_counter()
+    app = create_app('testing')
+    ready = time.perf_counter()
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    from src import nlp
+    from benchmarks.fakes import FakeSessionsClient
+    nlp.set_session_client(FakeSessionsClient(latency_ms=0, jitter_ms=0))
+    client = app.test_client()
+    statuses = []
+    time.sleep(float(os.environ.get('STARTUP_BENCH_GAP_MS', 0)) / 1000)
+
+    def send(sid, body):
+        request_started = time.perf_counter()
+        response = client.post('/webhook/whatsapp', data={'From': SENDER, 'Body': body, 'NumMedia': '0', 'MessageSid': sid})
+        statuses.append(response.status_code)
+        return (time.perf_counter() - request_started) * 1000
+
+    first_local = send('SMstartup0001', 'checkin')
+    first_nlp = send('SMstartup0002', 'hello there')
+    print(json.dumps({
+        'import': (imported - started) * 1000, 'create_app': (ready - imported) * 1000,
+        'ready': (ready - started) * 1000, 'first_local': first_local, 'first_nlp': first_nlp,
+        'loaded_at_ready': loaded, 'errors': sum(status != 200 for status in statuses),
+    }))
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='lighthouse-startup-')
+    prepare_database(workdir)
+    modes = {}
+    for mode in args.modes:
+        timings = defaultdict(list)
+        loaded = defaultdict(int)
+        errors = 0
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            completed = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.startup_bench', '--child'], env=child_env(workdir, mode, args.gap_ms),
+                capture_output=True, text=True,
+            )
+            process_ms = (time.perf_counter() - started) * 1000
+            if completed.returncode != 0:
+                errors += 1
+                print(f"[{mode}] run failed:\n{completed.stderr.strip()}", file=sys.stderr)
+                continue
+            sample = json.loads(completed.stdout.strip().splitlines()[-1])
+            sample['process'] = process_ms
+            for metric in METRICS:
+                timings[metric].append(sample[metric])
+            for name in sample['loaded_at_ready']:
+                loaded[name] += 1
+            errors += sample['errors']
+        modes[mode] = {
+            'errors': errors,
+            'metrics': {metric: summarize(timings[metric]) for metric in METRICS},
+            'loaded_at_ready': dict(loaded),
+        }
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'params': {'runs': args.runs, 'modes': list(args.modes), 'gap_ms': args.gap_ms},
+        'python': sys.version.split()[0],
+        'modes': modes,
+    }
+
+
+def print_report(result):
+    header = f"{'':<16}{'count':>7}{'mean':>9}{'p50':>9}{'p95':>9}{'max':>9}"
+    for mode, data in result['modes'].items():
+        print(f"\n[SDK_PRELOAD={mode}] (ms, {data['errors']} errors)\n{header}")
+        for metric, s in data['metrics'].items():
+            print(f"{metric:<16}{s['count']:>7}{s['mean_ms']:>9}{s['p50_ms']:>9}{s['p95_ms']:>9}{s['max_ms']:>9}")
+        loaded = ', '.join(f"{name} ({count})" for name, count in data['loaded_at_ready'].items()) or 'none'
+        print(f"heavy modules loaded at ready: {loaded}")
+
+
+def compare(result, baseline, threshold_pct):
+    """Prints median deltas against a baseline run; returns the list of regressions."""
+    regressions = []
+    print(f"\nComparison with baseline from {baseline.get('timestamp')} (threshold {threshold_pct}% on the median):")
+    for mode, data in result['modes'].items():
+        old_metrics = baseline.get('modes', {}).get(mode, {}).get('metrics', {})
+        for metric, new in data['metrics'].items():
+            old = old_metrics.get(metric)
+            if not old or not old['p50_ms']:
+                continue
+            delta_pct = (new['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100
+            flag = ''
+            if delta_pct > threshold_pct:
+                flag = '  <-- REGRESSION'
+                regressions.append(f"{mode}/{metric}")
+            print(f"  {mode}/{metric}: p50 {old['p50_ms']} -> {new['p50_ms']} ms ({delta_pct:+.1f}%){flag}")
+    return regressions
+
+
+def parse_modes(spec):
+    modes = [mode.strip() for mode in spec.split(',') if mode.strip()]
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown SDK_PRELOAD mode(s) {', '.join(unknown)} (use {', '.join(MODES)})")
+    return modes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure cold start: import, create_app and the first requests.")
+    parser.add_argument('--runs', type=int, default=5, help="Fresh processes per mode")
+    parser.add_argument('--modes', type=parse_modes, default=list(MODES), help="SDK_PRELOAD modes, e.g. off,background")
+    parser.add_argument('--gap-ms', type=float, default=0.0, help="Idle time between ready and the first message")
+    parser.add_argument('--output', help="Results file (default: benchmarks/results/startup-<timestamp>.json)")
+    parser.add_argument('--compare', help="Baseline results file to compare against")
+    parser.add_argument('--threshold', type=float, default=15.0, help="Allowed median regression in percent")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child()
+        return 0
+
+    result = run(args)
+    print_report(result)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"startup-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(result, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
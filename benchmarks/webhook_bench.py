@@ -0,0 +1,315 @@
+# benchmarks/webhook_bench.py
+# Load test for POST /webhook/whatsapp against create_app('testing').
+# Dialogflow and the Twilio media endpoint are replaced by local fakes (benchmarks/fakes.py)
+# with configurable latency, so runs are repeatable and need no credentials.
+#
+#   python -m benchmarks.webhook_bench --requests 2000 --concurrency 16 --mix text=70,voice=20,image=10
+#   python -m benchmarks.webhook_bench --compare benchmarks/results/webhook-20250101-120000.json
+#   python -m benchmarks.webhook_bench --df-outage timeout   # Dialogflow down: circuit breaker + degraded parser
+#
+# Reports throughput plus p50/p95/p99 latency overall, per intent and per processing stage,
+# and writes the results as JSON so later runs can be compared for regressions.
+import argparse
+import functools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# Text messages replayed by the benchmark; a share of them are literal commands the local
+# matcher handles, the rest need the (fake) Dialogflow agent
+TEXT_MESSAGES = [
+    'checkin', 'checkout', 'salary', 'check in please', 'I want to check out now',
+    'what is my salary', 'hello', 'hi there', 'how are you', 'help',
+]
+VOICE_INTENTS = ['CheckIn', 'CheckOut', 'SalaryInquiry']
+
+# Functions looked up by name in src.webhook at call time; each is timed as a processing stage
+STAGES = {
+    'get_user': 'user_lookup',
+    'match_local_intent': 'local_match',
+    'detect_intent_text': 'nlp_text',
+    'detect_intent_audio': 'nlp_audio',
+    'handle_register_params': 'register',
+    'handle_attendance': 'attendance',
+    'handle_salary_inquiry': 'salary_inquiry',
+    'handle_log_salary_params': 'log_salary',
+    'handle_media_upload': 'media_upload',
+    'get_fallback_message': 'fallback',
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values), 2) if values else 0.0,
+        'p50_ms': round(percentile(values, 50), 2),
+        'p95_ms': round(percentile(values, 95), 2),
+        'p99_ms': round(percentile(values, 99), 2),
+        'max_ms': round(max(values), 2) if values else 0.0,
+    }
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in ('text', 'voice', 'image'):
+            raise argparse.ArgumentTypeError(f"Unknown message kind '{kind}' (use text, voice, image)")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+class StageRecorder:
+    """Collects per-request stage timings from wrapped webhook dependencies."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def start_request(self):
+        self._local.stages = defaultdict(float)
+        self._local.intent = None
+
+    def finish_request(self):
+        return dict(self._local.stages), self._local.intent
+
+    def wrap(self, func, stage):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stages = getattr(self._local, 'stages', None)
+                if stages is not None:
+                    stages[stage] += (time.perf_counter() - started) * 1000
+        return timed
+
+    def wrap_router(self, func):
+        # route_intent receives the resolved intent name, which labels the request
+        @functools.wraps(func)
+        def labelled(user, sender, intent_name, *args, **kwargs):
+            self._local.intent = intent_name
+            return func(user, sender, intent_name, *args, **kwargs)
+        return labelled
+
+
+def build_app(args, workdir):
+    # Settings are read at import time, so set them before importing the app
+    os.environ.setdefault('DIALOGFLOW_PROJECT_ID', 'bench-project')
+    os.environ['TWILIO_ACCOUNT_SID'] = 'ACbench'
+    os.environ['TWILIO_AUTH_TOKEN'] = 'bench-token'
+    os.environ['TEST_DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    if args.no_nlp_cache:
+        os.environ['NLP_CACHE_BACKEND'] = 'off'
+    # Replayed traffic is much denser per sender than real users; measure the pipeline, not the limiter
+    os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+    # The fake media server returns random bytes, not decodable images
+    os.environ.setdefault('KYC_PREVIEWS_ENABLED', '0')
+
+    from src import create_app
+    from src.models import db, User
+    from src import nlp
+    from benchmarks.fakes import FakeSessionsClient
+
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        users = []
+        for i in range(args.senders):
+            users.append(User(
+                whatsapp_number=f"whatsapp:+9190000{i:05d}", sampatti_card_id=f"W{i:07d}",
+                role='worker', language_preference='en',
+            ))
+        users.append(User(whatsapp_number='whatsapp:+919999999999', sampatti_card_id='EMP0000001', role='employer'))
+        db.session.add_all(users)
+        db.session.commit()
+
+    fake_client = FakeSessionsClient(
+        latency_ms=args.df_latency_ms, jitter_ms=args.df_jitter_ms, audio_latency_ms=args.df_audio_latency_ms,
+        outage=args.df_outage,
+    )
+    nlp.set_session_client(fake_client)
+    return app, fake_client
+
+
+def instrument(recorder):
+    from src import webhook
+    for name, stage in STAGES.items():
+        setattr(webhook, name, recorder.wrap(getattr(webhook, name), stage))
+    webhook.route_intent = recorder.wrap_router(webhook.route_intent)
+
+
+def make_messages(args, media_base_url):
+    rng = random.Random(args.seed)
+    kinds = list(args.mix)
+    weights = [args.mix[k] for k in kinds]
+    messages = []
+    for i in range(args.requests):
+        sender = f"whatsapp:+9190000{rng.randrange(args.senders):05d}"
+        form = {'From': sender, 'MessageSid': f"SMbench{i:08d}", 'NumMedia': '0', 'Body': ''}
+        kind = rng.choices(kinds, weights)[0]
+        if kind == 'text':
+            form['Body'] = rng.choice(TEXT_MESSAGES)
+        elif kind == 'voice':
+            form.update(NumMedia='1', MediaUrl0=f"{media_base_url}/audio/{rng.choice(VOICE_INTENTS)}/{i}",
+                        MediaContentType0='audio/ogg')
+        else:
+            form.update(NumMedia='1', MediaUrl0=f"{media_base_url}/image/{i}", MediaContentType0='image/jpeg')
+        messages.append((kind, form))
+    return messages
+
+
+def run(args):
+    from benchmarks.fakes import FakeMediaServer
+
+    workdir = tempfile.mkdtemp(prefix='lighthouse-bench-')
+    media_server = FakeMediaServer(latency_ms=args.media_latency_ms, jitter_ms=args.media_jitter_ms).start()
+    try:
+        app, fake_client = build_app(args, workdir)
+        recorder = StageRecorder()
+        instrument(recorder)
+        messages = make_messages(args, media_server.base_url)
+
+        def send(message):
+            kind, form = message
+            client = app.test_client()
+            recorder.start_request()
+            started = time.perf_counter()
+            response = client.post('/webhook/whatsapp', data=form)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            stages, intent = recorder.finish_request()
+            return kind, intent or f'({kind}, no intent)', response.status_code, elapsed_ms, stages
+
+        for message in messages[:args.warmup]:
+            send(message)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(send, messages))
+        wall_s = time.perf_counter() - started
+    finally:
+        media_server.stop()
+
+    overall = [r[3] for r in results]
+    by_intent = defaultdict(list)
+    by_kind = defaultdict(list)
+    by_stage = defaultdict(list)
+    errors = 0
+    for kind, intent, status, elapsed_ms, stages in results:
+        by_intent[intent].append(elapsed_ms)
+        by_kind[kind].append(elapsed_ms)
+        errors += status != 200
+        for stage, stage_ms in stages.items():
+            by_stage[stage].append(stage_ms)
+
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'params': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'threshold')},
+        'requests': len(results),
+        'errors': errors,
+        'wall_seconds': round(wall_s, 3),
+        'throughput_rps': round(len(results) / wall_s, 2) if wall_s else 0.0,
+        'dialogflow_calls': fake_client.calls,
+        'overall': summarize(overall),
+        'by_kind': {k: summarize(v) for k, v in sorted(by_kind.items())},
+        'by_intent': {k: summarize(v) for k, v in sorted(by_intent.items())},
+        'by_stage': {k: summarize(v) for k, v in sorted(by_stage.items())},
+    }
+
+
+def print_report(result):
+    print(f"\n{result['requests']} requests in {result['wall_seconds']}s "
+          f"-> {result['throughput_rps']} req/s ({result['errors']} errors, "
+          f"{result['dialogflow_calls']} Dialogflow calls)")
+    header = f"{'':<28}{'count':>7}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}"
+    for title, rows in (('overall', {'all': result['overall']}), ('by kind', result['by_kind']),
+                        ('by intent', result['by_intent']), ('by stage', result['by_stage'])):
+        print(f"\n[{title}] (ms)\n{header}")
+        for name, s in rows.items():
+            print(f"{name:<28}{s['count']:>7}{s['mean_ms']:>9}{s['p50_ms']:>9}{s['p95_ms']:>9}{s['p99_ms']:>9}{s['max_ms']:>9}")
+
+
+def compare(result, baseline, threshold_pct):
+    """Prints p95 deltas against a baseline run; returns the list of regressions."""
+    regressions = []
+    print(f"\nComparison with baseline from {baseline.get('timestamp')} (threshold {threshold_pct}% on p95):")
+    old_rps, new_rps = baseline.get('throughput_rps', 0), result['throughput_rps']
+    print(f"  throughput: {old_rps} -> {new_rps} req/s")
+    sections = [('overall', {'all': baseline['overall']}, {'all': result['overall']})]
+    for key in ('by_intent', 'by_stage'):
+        sections.append((key, baseline.get(key, {}), result[key]))
+    for section, old_rows, new_rows in sections:
+        for name, new in new_rows.items():
+            old = old_rows.get(name)
+            if not old or not old['p95_ms']:
+                continue
+            delta_pct = (new['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100
+            flag = ''
+            if delta_pct > threshold_pct:
+                flag = '  <-- REGRESSION'
+                regressions.append(f"{section}/{name}")
+            print(f"  {section}/{name}: p95 {old['p95_ms']} -> {new['p95_ms']} ms ({delta_pct:+.1f}%){flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the WhatsApp webhook with fake Dialogflow/Twilio.")
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--senders', type=int, default=500, help="Distinct (pre-registered) worker numbers")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('text=70,voice=20,image=10'),
+                        help="Message mix weights, e.g. text=70,voice=20,image=10")
+    parser.add_argument('--warmup', type=int, default=20, help="Requests sent before timing starts")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--df-latency-ms', type=float, default=80.0)
+    parser.add_argument('--df-jitter-ms', type=float, default=20.0)
+    parser.add_argument('--df-audio-latency-ms', type=float, default=400.0)
+    parser.add_argument('--df-outage', choices=['unavailable', 'timeout'],
+                        help="Make every Dialogflow call fail (fast UNAVAILABLE, or hang until DEADLINE_EXCEEDED)")
+    parser.add_argument('--media-latency-ms', type=float, default=150.0)
+    parser.add_argument('--media-jitter-ms', type=float, default=40.0)
+    parser.add_argument('--no-nlp-cache', action='store_true', help="Disable the Dialogflow text result cache")
+    parser.add_argument('--output', help="Results file (default: benchmarks/results/webhook-<timestamp>.json)")
+    parser.add_argument('--compare', help="Baseline results file to compare against")
+    parser.add_argument('--threshold', type=float, default=10.0, help="Allowed p95 regression in percent")
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    print_report(result)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"webhook-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(result, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
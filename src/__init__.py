@@ -1,8 +1,9 @@
 # src/__init__.py
 import os
-from flask import Flask
-from .models import db # Import db instance from models
+from flask import Flask, Response, request
+from .models import db, read_session # Import db instance from models
 from .config import config # Import config dictionary
+from .log import configure_logging, get_logger
 
 def create_app(config_name=None):
     """Application Factory Function"""
@@ -12,14 +13,44 @@ def create_app(config_name=None):
     app = Flask(__name__)
     app.config.from_object(config[config_name]) # Load config from config.py
     config[config_name].init_app(app) # Perform any init specific to the config
+    configure_logging(app) # Queued, level-gated logging for the request path
 
-    print(f"INFO: Initializing DB with URI: {app.config.get('SQLALCHEMY_DATABASE_URI')}")
+    get_logger(__name__).info("Initializing DB with URI: %s", app.config.get('SQLALCHEMY_DATABASE_URI'))
     db.init_app(app) # Initialize SQLAlchemy with this app instance
 
+    # --- Per-process user lookup cache ---
+    from .commands import init_user_cache
+    init_user_cache(app)
+
     # --- Register Blueprints ---
-    from .webhook import webhook_bp # Import blueprint
+    from .webhook import webhook_bp, run_media_job # Import blueprint
     app.register_blueprint(webhook_bp) # Register the webhook blueprint
 
+    # --- Content-addressed KYC upload store ---
+    from .storage import init_kyc_storage
+    from .previews import init_kyc_previews
+    init_kyc_previews(app, init_kyc_storage(app))
+
+    # --- Background media processing (only when ASYNC_MEDIA_PROCESSING is enabled) ---
+    from .jobs import init_job_queue
+    init_job_queue(app, run_media_job)
+
+    # --- MessageSid deduplication of Twilio retries (on unless IDEMPOTENCY_ENABLED=0) ---
+    from .idempotency import init_idempotency
+    init_idempotency(app)
+
+    # --- Slot-filling state for commands sent without all their details ---
+    from .conversation import init_conversations
+    init_conversations(app)
+
+    # --- Per-sender rate limiting and load shedding ---
+    from .ratelimit import init_rate_limiting
+    init_rate_limiting(app)
+
+    # --- Write-behind attendance buffer (only when ATTENDANCE_WRITE_BEHIND is enabled) ---
+    from .attendance_buffer import init_attendance_buffer
+    init_attendance_buffer(app)
+
     # You could register other blueprints here (e.g., for an admin interface)
     # from .admin import admin_bp
     # app.register_blueprint(admin_bp, url_prefix='/admin')
@@ -29,20 +60,91 @@ def create_app(config_name=None):
     def home():
         try:
             # Simple DB check
-            user_count = db.session.query(db.func.count(User.id)).scalar()
+            with read_session() as session:
+                user_count = session.query(db.func.count(User.id)).scalar()
             return f"LightHouse Chatbot Flask server is running! Config: {config_name}. DB Connected. User count: {user_count}"
         except Exception as e:
-            print(f"DB Connection check failed: {e}")
+            get_logger(__name__).error("DB Connection check failed: %s", e)
             return f"LightHouse Chatbot Flask server is running! Config: {config_name}. ERROR: Could not connect to DB."
 
+    # --- Prometheus-style metrics: stage latencies, intents, NLP errors, queue/cache stats ---
+    if app.config.get('METRICS_ENABLED') and app.config.get('METRICS_REQUIRE_TOKEN') and not app.config.get('METRICS_TOKEN'):
+        get_logger(__name__).warning("Not serving /metrics: METRICS_TOKEN is not set.")
+    elif app.config.get('METRICS_ENABLED'):
+        from .metrics import render_metrics
+
+        @app.route('/metrics')
+        def metrics():
+            token = app.config.get('METRICS_TOKEN')
+            if token and request.headers.get('Authorization') != f"Bearer {token}":
+                return Response("Forbidden", status=403)
+            return Response(render_metrics(app), mimetype='text/plain; version=0.0.4')
+
     # --- Utility function to create tables (can be called via Flask shell) ---
     @app.cli.command('create-db')
     def create_db_command():
         """Creates the database tables."""
         print("Creating database tables...")
         db.create_all()
+        # create_all skips existing tables, so add any nullable columns and indexes introduced since
+        inspector = db.inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns and column.nullable:
+                    column_type = column.type.compile(db.engine.dialect)
+                    db.session.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            db.session.commit()
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
+        # On PostgreSQL attendance_logs is partitioned by month (a plain table elsewhere)
+        from .attendance_partitions import ensure_partitions
+        created = ensure_partitions(db.session.connection(), app.config.get('ATTENDANCE_PARTITIONS_AHEAD', 3))
+        db.session.commit()
+        if created:
+            print(f"Created attendance_logs partitions: {', '.join(created)}.")
         print("Database tables created.")
 
+    @app.cli.command('rebuild-salary-summaries')
+    def rebuild_salary_summaries_command():
+        """Recomputes every worker's salary summary from salary_logs."""
+        from .commands import rebuild_salary_summaries
+        from .models import SalaryLog
+        worker_ids = [row[0] for row in db.session.query(SalaryLog.worker_user_id).distinct()]
+        print(f"Rebuilding salary summaries for {len(worker_ids)} workers...")
+        batch_size = app.config.get('IMPORT_CHUNK_SIZE', 5000)
+        for start in range(0, len(worker_ids), batch_size):
+            rebuild_salary_summaries(worker_ids[start:start + batch_size])
+            db.session.commit()
+        print("Salary summaries rebuilt.")
+
+    # --- `flask import users|attendance|salary FILE` for onboarding existing records ---
+    from .importer import import_cli
+    app.cli.add_command(import_cli)
+
+    # --- `flask attendance partitions|archive`: monthly partitions and archival of old months ---
+    from .attendance_partitions import attendance_cli
+    app.cli.add_command(attendance_cli)
+
+    @app.cli.command('kyc-previews')
+    def kyc_previews_command():
+        """Renders missing previews/thumbnails for stored KYC documents."""
+        from .models import KycDocument
+        pool = app.extensions.get('kyc_previews')
+        if pool is None:
+            print("KYC previews are disabled (KYC_PREVIEWS_ENABLED=0 or Pillow not installed).")
+            return
+        keys = [row[0] for row in db.session.query(KycDocument.storage_path).filter(KycDocument.preview_path.is_(None)).distinct()]
+        print(f"Rendering previews for {len(keys)} files...")
+        queued = sum(1 for key in keys if pool.submit(key, wait=True))
+        pool.drain()
+        print(f"Done ({queued} queued, {len(keys) - queued} unsupported).")
+
+    # --- Import the heavy SDKs and warm up the Dialogflow client (rebuilt automatically after fork) ---
+    # Last, so in 'background' mode the thread doesn't slow down the rest of start-up
+    from .lazy import init_preload
+    init_preload(app)
+
     return app
 
 # Import User model here AFTER db is defined, for convenience if needed elsewhere,
@@ -0,0 +1,337 @@
+# src/async_webhook.py
+# asyncio version of the WhatsApp webhook, served by the ASGI entry point (asgi.py).
+# - Dialogflow and Twilio media downloads are awaited on the event loop (nlp_async.py), so
+#   thousands of in-flight conversations don't each pin a worker thread.
+# - Blocking DB work (user lookup, command handlers) runs in a bounded thread pool
+#   (ASYNC_DB_WORKERS) inside an app context, which also caps concurrent DB connections. So do
+#   calls on the 'sqlite' dedup/conversation stores, job queue and Dialogflow text/voice caches,
+#   and KYC upload file writes (file I/O and commits); the in-process 'memory' backends are called
+#   inline.
+# - Every other route is the regular Flask app, served through asgiref's WSGI adapter.
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import aiohttp
+from asgiref.wsgi import WsgiToAsgi
+from twilio.twiml.messaging_response import MessagingResponse
+
+from .intents import match_local_intent
+from .nlp_async import (
+    detect_intent_text_async, detect_intent_audio_async, get_http_session, close_async_clients, call_inline,
+)
+from .commands import (
+    get_user, get_fallback_message, check_media_upload, record_kyc_upload, upload_too_large_reply, MEDIA_CHUNK_SIZE,
+    media_download_budget, MEDIA_TIMEOUT_REPLY,
+)
+from .storage import get_kyc_storage, StorageError, UploadTooLarge
+from .webhook import route_intent, reply_for_audio_intent, render_twiml
+from .log import get_logger, bind_request
+from .breaker import start_deadline, end_deadline
+from .metrics import INTENTS_TOTAL, REQUEST_SECONDS, stage_timer
+from .ratelimit import message_kind, RATE_LIMITED_REPLY, SHED_REPLY
+from .bulk_salary import is_salary_sheet, check_salary_sheet_upload, handle_salary_sheet
+
+log = get_logger(__name__)
+
+WEBHOOK_PATH = '/webhook/whatsapp'
+MAX_FORM_BYTES = 64 * 1024 # Twilio webhook posts are a few KB
+
+
+class DBExecutor:
+    """Bounded thread pool for blocking DB work; each call runs in its own app context."""
+
+    def __init__(self, app, workers=16):
+        self.app = app
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='async-db')
+
+    async def run(self, func, *args, **kwargs):
+        # Copy contextvars so log lines from the pool keep the message SID and sender
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, self._call_in_app_context, func, args, kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    def _call_in_app_context(self, func, args, kwargs):
+        with self.app.app_context():
+            return func(*args, **kwargs)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def runner_for(self, backend):
+        """Async callable(func, *args) for calls on a cache/queue backend: the pool if the backend
+        does blocking I/O, inline otherwise."""
+        return self.run if getattr(backend, 'blocking', True) else call_inline
+
+
+async def handle_media_upload_async(app, db, user, media_url, media_type):
+    """Async handle_media_upload: streams the download into the KYC store, returning (StoredObject, None)
+    or (None, error reply). File writes run in the DB pool; the KycDocument is recorded afterwards there too."""
+    file_extension, error_reply = check_media_upload(user, media_type)
+    if error_reply:
+        return None, error_reply
+    max_bytes = app.config.get('KYC_MAX_UPLOAD_BYTES')
+    budget = media_download_budget()
+    if budget is None:
+        return None, MEDIA_TIMEOUT_REPLY
+    upload = None
+    try:
+        with stage_timer('media_download'):
+            auth = aiohttp.BasicAuth(os.getenv('TWILIO_ACCOUNT_SID'), os.getenv('TWILIO_AUTH_TOKEN'))
+            # total= bounds the whole body, so the download can't outlive the request budget
+            async with get_http_session().get(media_url, auth=auth, timeout=aiohttp.ClientTimeout(total=budget[0])) as response:
+                response.raise_for_status()
+                if max_bytes and (response.content_length or 0) > max_bytes:
+                    raise UploadTooLarge(max_bytes)
+                # Chunks are hashed and written to disk in the DB pool, so a slow disk doesn't stall the loop
+                upload = await db.run(get_kyc_storage(app).begin, max_bytes)
+                async for chunk in response.content.iter_chunked(MEDIA_CHUNK_SIZE):
+                    await db.run(upload.write, chunk)
+            stored = await db.run(upload.commit, file_extension)
+            upload = None
+    except aiohttp.ClientResponseError as http_err:
+        log.error("Error downloading media (HTTP %s): %s", http_err.status, http_err)
+        return None, f"Error downloading file (HTTP {http_err.status})."
+    except asyncio.TimeoutError as timed_out: # Includes aiohttp's ServerTimeoutError
+        log.warning("Media download ran out of the request budget (%.1fs): %r", budget[0], timed_out)
+        return None, MEDIA_TIMEOUT_REPLY
+    except aiohttp.ClientError as req_err:
+        log.error("Error downloading media (Network): %s", req_err)
+        return None, "Network error downloading file."
+    except UploadTooLarge as too_large:
+        log.info("Rejected KYC upload from user %s: %s", user.id, too_large)
+        return None, upload_too_large_reply(too_large.max_bytes)
+    except (StorageError, IOError) as io_err:
+        log.error("Error saving file: %s", io_err)
+        return None, "Error saving file."
+    finally:
+        if upload is not None:
+            await db.run(upload.abort)
+    return stored, None
+
+
+async def fetch_media_async(media_url, max_bytes):
+    """Downloads a small media file into memory. Returns (bytes, None) or (None, error reply)."""
+    budget = media_download_budget()
+    if budget is None:
+        return None, MEDIA_TIMEOUT_REPLY
+    try:
+        with stage_timer('media_download'):
+            auth = aiohttp.BasicAuth(os.getenv('TWILIO_ACCOUNT_SID'), os.getenv('TWILIO_AUTH_TOKEN'))
+            async with get_http_session().get(media_url, auth=auth, timeout=aiohttp.ClientTimeout(total=budget[0])) as response:
+                response.raise_for_status()
+                data = bytearray()
+                async for chunk in response.content.iter_chunked(MEDIA_CHUNK_SIZE):
+                    data.extend(chunk)
+                    if len(data) > max_bytes:
+                        break
+    except aiohttp.ClientResponseError as http_err:
+        log.error("Error downloading media (HTTP %s): %s", http_err.status, http_err)
+        return None, f"Error downloading file (HTTP {http_err.status})."
+    except asyncio.TimeoutError as timed_out:
+        log.warning("Media download ran out of the request budget (%.1fs): %r", budget[0], timed_out)
+        return None, MEDIA_TIMEOUT_REPLY
+    except aiohttp.ClientError as req_err:
+        log.error("Error downloading media (Network): %s", req_err)
+        return None, "Network error downloading file."
+    if len(data) > max_bytes:
+        return None, f"That file is too large. Please send salary sheets up to {max_bytes // 1024} KB."
+    return bytes(data), None
+
+
+async def whatsapp_webhook_async(app, db, form, headers):
+    """Async counterpart of webhook.whatsapp_webhook; returns the TwiML string."""
+    kind = 'media' if int(form.get('NumMedia', 0) or 0) > 0 else 'text'
+    deadline = start_deadline(app.config.get('WEBHOOK_DEADLINE_SECONDS'))
+    try:
+        with REQUEST_SECONDS.time(kind=kind):
+            message_sid = form.get('MessageSid')
+            bind_request(message_sid, form.get('From', ''))
+            dedup = app.extensions.get('message_dedup')
+            if dedup is None or not message_sid:
+                return await _admit_and_handle(app, db, form, headers)
+            run_store = db.runner_for(dedup.store)
+            stored_twiml = await dedup.claim_async(message_sid, run_store)
+            if stored_twiml is not None:
+                return stored_twiml
+            try:
+                twiml = await _admit_and_handle(app, db, form, headers)
+            except Exception:
+                await run_store(dedup.release, message_sid)
+                raise
+            await run_store(dedup.complete, message_sid, twiml)
+            return twiml
+    finally:
+        end_deadline(deadline)
+
+
+async def _admit_and_handle(app, db, form, headers):
+    limiter = app.extensions.get('rate_limiter')
+    if limiter is not None:
+        kind = message_kind(int(form.get('NumMedia', 0) or 0), form.get('MediaContentType0'))
+        if not limiter.allow(form.get('From', ''), kind):
+            return render_twiml(RATE_LIMITED_REPLY)
+    shedder = app.extensions.get('load_shedder')
+    if shedder is None:
+        return await _handle_whatsapp_message(app, db, form, headers)
+    if not shedder.try_acquire():
+        return render_twiml(SHED_REPLY)
+    try:
+        return await _handle_whatsapp_message(app, db, form, headers)
+    finally:
+        shedder.release()
+
+
+async def _handle_whatsapp_message(app, db, form, headers):
+    incoming_msg_body = form.get('Body', '').strip()
+    sender_whatsapp_number = form.get('From', '')
+    num_media = int(form.get('NumMedia', 0) or 0)
+    media_url = form.get('MediaUrl0')
+    media_type = form.get('MediaContentType0')
+
+    token = app.config.get('LOG_DEBUG_TOKEN')
+    debug = sender_whatsapp_number in app.config.get('LOG_DEBUG_SENDERS', ()) or (bool(token) and headers.get('x-debug-log') == token)
+    bind_request(form.get('MessageSid'), sender_whatsapp_number, debug=debug)
+
+    reply_message = None
+    intent_name = parameters = dialogflow_reply = None
+    processing_step = "Start"
+
+    user = await db.run(get_user, sender_whatsapp_number)
+    language_code = user.language_preference if user and user.language_preference else 'en'
+
+    if num_media > 0 and media_url and media_type:
+        job_queue = app.extensions.get('job_queue')
+        if job_queue is not None and media_type.startswith(('audio/', 'image/', 'application/pdf')):
+            processing_step = "Media Enqueued"
+            queued = await db.runner_for(job_queue.backend)(job_queue.enqueue, {
+                'sender': sender_whatsapp_number, 'media_url': media_url, 'media_type': media_type,
+                'language_code': language_code, 'body': incoming_msg_body, 'message_sid': form.get('MessageSid'),
+            })
+            if queued:
+                log.info("Processing step: %s", processing_step)
+                return str(MessagingResponse())
+            log.warning("Media job queue is full, rejecting message.")
+            reply_message = "We're receiving a lot of messages right now. Please send your file or voice message again in a few minutes."
+        elif media_type.startswith('audio/'):
+            processing_step = "Audio Processing"
+            intent_name, parameters, dialogflow_reply = await detect_intent_audio_async(
+                sender_whatsapp_number, media_url, language_code, run=db.run
+            )
+            reply_message = await db.run(
+                reply_for_audio_intent, user, sender_whatsapp_number, intent_name, parameters, dialogflow_reply, incoming_msg_body
+            )
+        elif media_type.startswith(('image/', 'application/pdf')):
+            processing_step = "KYC/File Upload Processing"
+            if not user:
+                reply_message = "Please register before uploading files. Send: register <ID> <role>"
+            else:
+                stored, reply_message = await handle_media_upload_async(app, db, user, media_url, media_type)
+                if stored:
+                    reply_message = await db.run(record_kyc_upload, user, stored)
+        elif is_salary_sheet(media_type):
+            processing_step = "Salary Sheet Upload"
+            reply_message = check_salary_sheet_upload(user)
+            if reply_message is None:
+                data, reply_message = await fetch_media_async(media_url, app.config.get('BULK_SALARY_MAX_FILE_BYTES', 1024 * 1024))
+                if data is not None:
+                    reply_message = await db.run(handle_salary_sheet, user, data, media_type)
+        else:
+            processing_step = "Unsupported Media"
+            reply_message = "Sorry, I can only process voice messages, images, PDF files and salary sheets (CSV/Excel) right now."
+
+    elif incoming_msg_body:
+        processing_step = "Text Processing"
+        conversations = app.extensions.get('conversations')
+        if conversations is not None:
+            intent_name, parameters, reply_message = await db.runner_for(conversations.store)(
+                conversations.resume, sender_whatsapp_number, incoming_msg_body, language_code
+            )
+        if intent_name is None and reply_message is None and app.config.get('LOCAL_INTENT_MATCHING', True):
+            intent_name, parameters, dialogflow_reply = match_local_intent(incoming_msg_body, language_code)
+            if intent_name:
+                INTENTS_TOTAL.inc(intent=intent_name, source='local')
+        if intent_name is None and reply_message is None:
+            intent_name, parameters, dialogflow_reply = await detect_intent_text_async(
+                sender_whatsapp_number, incoming_msg_body, language_code, run=db.run
+            )
+            if intent_name is None and dialogflow_reply is None:
+                reply_message = "Sorry, I'm having trouble understanding that command (text error)."
+        if reply_message is None and intent_name:
+            processing_step = f"Intent Routing ({intent_name})"
+            reply_message = await db.run(
+                route_intent, user, sender_whatsapp_number, intent_name, parameters, dialogflow_reply, incoming_msg_body
+            )
+
+    if reply_message is None:
+        processing_step = "Final Fallback"
+        reply_message = get_fallback_message(user, incoming_msg_body)
+
+    final_twiml = render_twiml(reply_message)
+    log.info("Replied (step=%s, intent=%s)", processing_step, intent_name)
+    log.debug("Final TwiML Response:\n%s", final_twiml)
+    return final_twiml
+
+
+class LighthouseASGI:
+    """ASGI app: native async webhook route, everything else delegated to the Flask app."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.db = DBExecutor(flask_app, workers=flask_app.config.get('ASYNC_DB_WORKERS', 16))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['path'] == WEBHOOK_PATH and scope['method'] == 'POST':
+            await self._webhook(scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await close_async_clients()
+                self.db.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _webhook(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            body.extend(message.get('body', b''))
+            if len(body) > MAX_FORM_BYTES:
+                await self._respond(send, 413, b'Request body too large', 'text/plain')
+                return
+            if not message.get('more_body'):
+                break
+        form = {key: values[0] for key, values in parse_qs(body.decode('utf-8', 'replace'), keep_blank_values=True).items()}
+        headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope.get('headers', [])}
+        try:
+            twiml = await whatsapp_webhook_async(self.flask_app, self.db, form, headers)
+        except Exception as e:
+            log.exception("Unhandled error in async webhook: %s", e)
+            await self._respond(send, 500, b'Internal Server Error', 'text/plain')
+            return
+        await self._respond(send, 200, twiml.encode('utf-8'), 'text/xml; charset=utf-8')
+
+    @staticmethod
+    async def _respond(send, status, body, content_type):
+        await send({
+            'type': 'http.response.start', 'status': status,
+            'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def create_asgi_app(flask_app):
+    return LighthouseASGI(flask_app)
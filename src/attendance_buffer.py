@@ -0,0 +1,161 @@
+# src/attendance_buffer.py
+# Optional write-behind buffer for AttendanceLog rows.
+# At shift change thousands of checkins arrive within minutes; instead of one transaction per
+# message, rows are queued and bulk-inserted every ATTENDANCE_BUFFER_MAX_ROWS rows or
+# ATTENDANCE_BUFFER_MAX_WAIT_MS milliseconds. Callers block until their row's batch has been
+# committed, so the user is only told "logged" once the write is durable. A single flusher
+# thread drains the queue in FIFO order, which keeps checkin/checkout order per user.
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from .models import db, AttendanceLog
+from .log import get_logger
+
+log = get_logger(__name__)
+
+
+class AttendanceWriteBuffer:
+    """Batches AttendanceLog inserts; add() returns once the row is committed."""
+
+    def __init__(self, app, max_rows=200, max_wait_ms=50, timeout=10.0):
+        self.app = app
+        self.max_rows = max(1, max_rows)
+        self.max_wait = max_wait_ms / 1000.0
+        self.timeout = timeout
+        self._pending = deque() # (row dict, Future)
+        self._cond = threading.Condition()
+        self._pid = None
+        self._thread = None
+        # Stats
+        self.flushes = 0
+        self.rows_written = 0
+        self.failed_flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def add(self, user_id, log_type):
+        """
+        Queues a row and waits for its flush. Returns the committed timestamp; raises on failure.
+        After `timeout` a row that is still queued is withdrawn (so it is never written once the user
+        has been told it failed); a row whose batch is already being flushed waits for that outcome.
+        """
+        self._ensure_started()
+        row = {'user_id': user_id, 'log_type': log_type, 'timestamp': datetime.utcnow()}
+        future = Future()
+        with self._cond:
+            self._pending.append((row, future))
+            self._cond.notify()
+        try:
+            future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            if self._withdraw(future):
+                raise
+            future.result()
+        return row['timestamp']
+
+    def _withdraw(self, future):
+        """Removes a still-queued row from the queue. False if its batch was already taken for flushing."""
+        with self._cond:
+            for index, (_, queued) in enumerate(self._pending):
+                if queued is future:
+                    del self._pending[index]
+                    return True
+        return False
+
+    def _ensure_started(self):
+        # The flusher thread doesn't survive fork(), so start it in the serving process
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pending.clear()
+            self._thread = threading.Thread(target=self._run, name='attendance-flusher', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # Give the batch up to max_wait to fill before flushing
+                deadline = time.monotonic() + self.max_wait
+                while len(self._pending) < self.max_rows:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = [self._pending.popleft() for _ in range(min(self.max_rows, len(self._pending)))]
+            self._flush(batch)
+
+    def _flush(self, batch):
+        started = time.perf_counter()
+        rows = [row for row, _ in batch]
+        with self.app.app_context():
+            error = self._insert(rows)
+            if error is None:
+                results = [(future, None) for _, future in batch]
+            elif len(batch) == 1:
+                self.failed_flushes += 1
+                results = [(batch[0][1], error)]
+            else:
+                # One bad row (or a transient error) shouldn't fail the whole batch: retry row by row,
+                # in order, so only the rows the database rejects fail
+                self.failed_flushes += 1
+                log.warning("Flushing %s attendance rows failed (%s); retrying row by row.", len(rows), type(error).__name__)
+                results = [(future, self._insert([row])) for row, future in batch]
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.flushes += 1
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self.total_flush_ms += elapsed_ms
+        for future, error in results:
+            if error is None:
+                self.rows_written += 1
+                future.set_result(True)
+            else:
+                log.error("Error flushing attendance row: %s", error)
+                future.set_exception(error)
+
+    def _insert(self, rows):
+        """Inserts rows in one transaction. Returns the exception if it failed, else None."""
+        try:
+            db.session.execute(insert(AttendanceLog), rows)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            return e
+        return None
+
+    def depth(self):
+        return len(self._pending)
+
+    def stats(self):
+        return {
+            'depth': self.depth(), 'flushes': self.flushes, 'rows_written': self.rows_written,
+            'failed_flushes': self.failed_flushes, 'last_flush_ms': round(self.last_flush_ms, 2),
+            'max_flush_ms': round(self.max_flush_ms, 2),
+            'avg_flush_ms': round(self.total_flush_ms / self.flushes, 2) if self.flushes else 0.0,
+        }
+
+
+def init_attendance_buffer(app):
+    """Sets up the write-behind buffer when ATTENDANCE_WRITE_BEHIND is enabled."""
+    if not app.config.get('ATTENDANCE_WRITE_BEHIND'):
+        return None
+    buffer = AttendanceWriteBuffer(
+        app,
+        max_rows=app.config.get('ATTENDANCE_BUFFER_MAX_ROWS', 200),
+        max_wait_ms=app.config.get('ATTENDANCE_BUFFER_MAX_WAIT_MS', 50),
+    )
+    app.extensions['attendance_buffer'] = buffer
+    log.info("Attendance write-behind enabled (flush every %s rows or %.0f ms)", buffer.max_rows, buffer.max_wait * 1000)
+    return buffer
@@ -0,0 +1,392 @@
+# src/attendance_partitions.py
+# Monthly partitions, rollups and archival for attendance_logs.
+# On PostgreSQL attendance_logs is partitioned by RANGE (timestamp): one partition per month
+# (attendance_logs_y2025m01) plus a default partition for rows outside them. Checkins at shift
+# change only touch the current month's partition and its indexes, and the hours engine's
+# timestamp-bounded scans are pruned to the months they cover. On SQLite (development) it stays a
+# plain table and archiving deletes rows instead of dropping partitions.
+#   flask attendance partitions           # convert a plain table; create the next ATTENDANCE_PARTITIONS_AHEAD months
+#   flask attendance archive --dry-run    # months older than ATTENDANCE_KEEP_MONTHS that would be archived
+#   flask attendance archive              # run nightly (it also creates upcoming partitions)
+# Archiving a month: its rows are written to ATTENDANCE_ARCHIVE_DIR/attendance_logs_YYYY-MM.csv.gz
+# (columns accepted by `flask import attendance`, so a month can be restored), the hours engine
+# rolls them up into per-worker daily rows in attendance_daily_summaries, and then one short
+# transaction records the month in attendance_archives and detaches and drops its partition
+# (--keep-detached leaves the table in place). hours_by_worker reads the rollups for archived months.
+# drop_month refuses to run unless the month's attendance_archives row, export file and rollups are
+# all there and still match the rows about to be dropped.
+import csv
+import gzip
+import os
+import re
+from datetime import date, datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import Integer, cast, delete, func, insert, select, text
+
+from .cache import TTLCache
+from .hours import daily_hours_query, month_range, DEFAULT_MAX_SHIFT_HOURS
+from .log import get_logger
+from .models import db, User, AttendanceLog, AttendanceDailySummary, AttendanceArchive
+
+log = get_logger(__name__)
+
+TABLE = AttendanceLog.__tablename__
+DEFAULT_PARTITION = f"{TABLE}_default"
+_PARTITION_NAME = re.compile(rf'^{TABLE}_y(\d{{4}})m(\d{{2}})$')
+EXPORT_COLUMNS = ('id', 'user_id', 'sampatti_card_id', 'whatsapp_number', 'log_type', 'timestamp')
+EXPORT_BATCH = 10000
+# Detaching a partition needs a brief exclusive lock on attendance_logs; give up rather than queue
+# behind a long query, since every insert would then queue behind the detach
+DETACH_LOCK_TIMEOUT = '5s'
+
+
+# --- Months ---
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def add_months(month, count):
+    """The first day of the month count months after month."""
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"{TABLE}_y{month.year:04d}m{month.month:02d}"
+
+
+# --- PostgreSQL partitions ---
+
+def supports_partitioning(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def is_partitioned(connection):
+    return connection.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"), {'table': TABLE}
+    ).scalar() == 'p'
+
+
+def list_partitions(connection):
+    """{month: partition name} for the monthly partitions attached to attendance_logs."""
+    rows = connection.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = to_regclass(:table)"
+    ), {'table': TABLE})
+    partitions = {}
+    for (name,) in rows:
+        match = _PARTITION_NAME.match(name)
+        if match:
+            partitions[date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return partitions
+
+
+def _bounds_sql(month):
+    start, end = month_range(month)
+    return f"FROM ('{start.isoformat(' ')}') TO ('{end.isoformat(' ')}')"
+
+
+def create_partition(connection, month):
+    """Creates month's partition, moving in any rows for it that landed in the default partition."""
+    start, end = month_range(month)
+    name = partition_name(month)
+    stray = connection.execute(text(
+        f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE timestamp >= :start AND timestamp < :end)"
+    ), {'start': start, 'end': end}).scalar()
+    if not stray:
+        connection.execute(text(f"CREATE TABLE {name} PARTITION OF {TABLE} FOR VALUES {_bounds_sql(month)}"))
+        return name
+    # A range can't be attached while the default partition holds rows for it
+    connection.execute(text(f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)"))
+    connection.execute(text(
+        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE timestamp >= :start AND timestamp < :end RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved"
+    ), {'start': start, 'end': end})
+    connection.execute(text(f"ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES {_bounds_sql(month)}"))
+    return name
+
+
+def convert_to_partitioned(connection, ahead):
+    """
+    Rebuilds a plain attendance_logs as a partitioned table, in the caller's transaction: one partition
+    per month from the oldest row to `ahead` months from now, plus the default partition. Writes to
+    attendance_logs wait until the transaction commits. Assumes the SERIAL id create_all makes.
+    """
+    staging = f"{TABLE}_partitioned"
+    connection.execute(text(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE"))
+    connection.execute(text(f"CREATE TABLE {staging} (LIKE {TABLE} INCLUDING DEFAULTS) PARTITION BY RANGE (timestamp)"))
+    last = add_months(month_start(datetime.utcnow()), ahead)
+    oldest = connection.execute(text(f"SELECT min(timestamp) FROM {TABLE}")).scalar()
+    month = min(month_start(oldest), last) if oldest is not None else month_start(datetime.utcnow())
+    created = []
+    while month <= last:
+        connection.execute(text(f"CREATE TABLE {partition_name(month)} PARTITION OF {staging} FOR VALUES {_bounds_sql(month)}"))
+        created.append(partition_name(month))
+        month = add_months(month, 1)
+    connection.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {staging} DEFAULT"))
+    connection.execute(text(f"INSERT INTO {staging} SELECT * FROM {TABLE}"))
+    # The id sequence belongs to the old table's column; hand it over before dropping that table
+    sequence = connection.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {'table': TABLE}).scalar()
+    if sequence:
+        connection.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {staging}.id"))
+    connection.execute(text(f"DROP TABLE {TABLE}"))
+    connection.execute(text(f"ALTER TABLE {staging} RENAME TO {TABLE}"))
+    # Constraints and indexes go on last, built once per partition rather than maintained row by row.
+    # A unique key on a partitioned table has to include the partition key.
+    connection.execute(text(f"ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey PRIMARY KEY (id, timestamp)"))
+    connection.execute(text(f"ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (id)"))
+    for index in AttendanceLog.__table__.indexes:
+        index.create(connection)
+    log.info("Converted %s to a partitioned table (%d monthly partitions).", TABLE, len(created))
+    return created
+
+
+def ensure_partitions(connection, ahead):
+    """Partitions attendance_logs if it is a plain table and creates the partitions for the current
+    month and the next `ahead` months. Returns the names of the partitions created (PostgreSQL only)."""
+    if not supports_partitioning(connection):
+        return []
+    if not is_partitioned(connection):
+        return convert_to_partitioned(connection, ahead)
+    existing = list_partitions(connection)
+    current = month_start(datetime.utcnow())
+    return [
+        create_partition(connection, month)
+        for month in (add_months(current, offset) for offset in range(ahead + 1))
+        if month not in existing
+    ]
+
+
+# --- Rollup and archival ---
+
+class ArchiveIncomplete(RuntimeError):
+    """A month's rows can't be dropped: its export or rollups are missing or don't match them."""
+
+
+def month_rows(session, month):
+    """Rows month currently has in attendance_logs."""
+    start, end = month_range(month)
+    log_ = AttendanceLog
+    return session.scalar(select(func.count()).select_from(log_).where(log_.timestamp >= start, log_.timestamp < end))
+
+
+def archive_candidates(session, cutoff):
+    """[(month, rows)] for months before cutoff that still have rows in attendance_logs, oldest first."""
+    log_ = AttendanceLog
+    cutoff_at = month_range(cutoff)[0]
+    oldest = session.scalar(select(func.min(log_.timestamp)).where(log_.timestamp < cutoff_at))
+    candidates = []
+    month = month_start(oldest) if oldest is not None else cutoff
+    while month < cutoff:
+        rows = month_rows(session, month)
+        if rows:
+            candidates.append((month, rows))
+        month = add_months(month, 1)
+    return candidates
+
+
+def export_month(session, month, directory):
+    """Writes month's rows to <directory>/attendance_logs_YYYY-MM.csv.gz. Returns (path, rows written)."""
+    start, end = month_range(month)
+    log_ = AttendanceLog
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{TABLE}_{month:%Y-%m}.csv.gz")
+    partial = path + '.partial'
+    query = (
+        select(log_.id, log_.user_id, User.sampatti_card_id, User.whatsapp_number, log_.log_type, log_.timestamp)
+        .join(User, User.id == log_.user_id)
+        .where(log_.timestamp >= start, log_.timestamp < end)
+        .order_by(log_.timestamp, log_.id)
+        .execution_options(yield_per=EXPORT_BATCH)
+    )
+    written = 0
+    with gzip.open(partial, 'wt', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_COLUMNS)
+        for row in session.execute(query):
+            writer.writerow([row.id, row.user_id, row.sampatti_card_id or '', row.whatsapp_number, row.log_type, row.timestamp.isoformat()])
+            written += 1
+    with open(partial, 'rb') as f:
+        os.fsync(f.fileno()) # The rows are dropped next; make sure the file is on disk first
+    os.replace(partial, path)
+    return path, written
+
+
+def rollup_month(session, month, max_shift_hours=DEFAULT_MAX_SHIFT_HOURS):
+    """Replaces month's rows in attendance_daily_summaries with the hours engine's daily totals. Returns the row count."""
+    start, end = month_range(month)
+    summary = AttendanceDailySummary
+    session.execute(delete(summary).where(summary.day >= start.date(), summary.day < end.date()))
+    user_ids = select(AttendanceLog.user_id).where(AttendanceLog.timestamp >= start, AttendanceLog.timestamp < end).distinct()
+    daily = daily_hours_query(user_ids, start, end, max_shift_hours).subquery('daily')
+    result = session.execute(insert(summary).from_select(
+        ['user_id', 'day', 'worked_seconds', 'shifts', 'missing_checkouts'],
+        select(daily.c.user_id, daily.c.day, cast(func.round(daily.c.seconds), Integer), daily.c.shifts, daily.c.missing),
+    ))
+    return result.rowcount
+
+
+def count_exported_rows(path):
+    """Data rows in an export written by export_month (reading it through also checks the gzip stream)."""
+    with gzip.open(path, 'rt', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        if tuple(next(reader, ())) != EXPORT_COLUMNS:
+            raise ArchiveIncomplete(f"{path} is not an attendance export")
+        return sum(1 for _ in reader)
+
+
+def check_archived(session, month):
+    """Returns month's AttendanceArchive, raising ArchiveIncomplete unless its export file holds
+    row_count rows and its rollups are in attendance_daily_summaries."""
+    label = f"{month:%Y-%m}"
+    archive = session.get(AttendanceArchive, month)
+    if archive is None:
+        raise ArchiveIncomplete(f"{label} has no attendance_archives row")
+    if archive.row_count:
+        if not archive.file_path or not os.path.isfile(archive.file_path):
+            raise ArchiveIncomplete(f"{label}'s export {archive.file_path!r} is missing")
+        try:
+            exported = count_exported_rows(archive.file_path)
+        except (OSError, EOFError, csv.Error) as e:
+            raise ArchiveIncomplete(f"{label}'s export {archive.file_path} can't be read: {e}") from e
+        if exported != archive.row_count:
+            raise ArchiveIncomplete(f"{label}'s export {archive.file_path} has {exported} rows, expected {archive.row_count}")
+    start, end = month_range(month)
+    summary = AttendanceDailySummary
+    summaries = session.scalar(
+        select(func.count()).select_from(summary).where(summary.day >= start.date(), summary.day < end.date())
+    )
+    if summaries != archive.summary_rows:
+        raise ArchiveIncomplete(f"{label} has {summaries} daily summaries, expected {archive.summary_rows}")
+    return archive
+
+
+def drop_month(session, month, keep_detached=False):
+    """Removes month's rows from attendance_logs: detaches (and drops) its partition on PostgreSQL, and
+    deletes whatever is left, i.e. rows in the default partition or, on SQLite, the table. Returns the
+    name of a partition kept detached, if any. Raises ArchiveIncomplete unless the month is archived
+    (see check_archived) and has no rows besides the archived ones."""
+    archive = check_archived(session, month)
+    start, end = month_range(month)
+    connection = session.connection()
+    name = list_partitions(connection).get(month) if supports_partitioning(connection) else None
+    if name:
+        # The lock DETACH takes anyway, taken before the count so no insert lands in between
+        connection.execute(text(f"SET LOCAL lock_timeout = '{DETACH_LOCK_TIMEOUT}'"))
+        connection.execute(text(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE"))
+    rows = month_rows(session, month)
+    if rows != archive.row_count:
+        raise ArchiveIncomplete(f"{month:%Y-%m} has {rows} rows but {archive.row_count} were archived")
+    detached = None
+    if name:
+        connection.execute(text(f"ALTER TABLE {TABLE} DETACH PARTITION {name}"))
+        if keep_detached:
+            detached = name
+        else:
+            connection.execute(text(f"DROP TABLE {name}"))
+    session.execute(delete(AttendanceLog).where(AttendanceLog.timestamp >= start, AttendanceLog.timestamp < end))
+    return detached
+
+
+def archive_month(session, month, expected_rows, directory, keep_detached=False, max_shift_hours=DEFAULT_MAX_SHIFT_HOURS):
+    """Exports, rolls up and drops one month (committing as it goes). Returns its AttendanceArchive."""
+    path, written = export_month(session, month, directory)
+    if written != expected_rows:
+        raise RuntimeError(f"{month:%Y-%m}: exported {written} rows but counted {expected_rows}; rows are still being added")
+    summary_rows = rollup_month(session, month, max_shift_hours)
+    session.commit() # Rollups are rebuilt from scratch if the rest fails, so they can be committed first
+    archive = AttendanceArchive(month=month, row_count=written, summary_rows=summary_rows, file_path=os.path.abspath(path))
+    session.add(archive)
+    session.flush() # drop_month checks the export and rollups against this row
+    archive.detached_table = drop_month(session, month, keep_detached)
+    session.commit()
+    _archive_boundary.delete('until')
+    log.info("Archived attendance for %s: %d rows to %s, %d daily summaries.", f"{month:%Y-%m}", written, path, summary_rows)
+    return archive
+
+
+# --- Boundary used by the hours queries ---
+_archive_boundary = TTLCache(maxsize=1, ttl=300, name='attendance_archive_boundary')
+_UNSET = object()
+
+
+def archived_until(session):
+    """Start of the oldest month still held in attendance_logs when any month was archived, else None.
+    Read from attendance_archives at most every 5 minutes per process."""
+    until = _archive_boundary.get('until', _UNSET)
+    if until is _UNSET:
+        last = session.scalar(select(func.max(AttendanceArchive.month)))
+        until = month_range(last)[1] if last is not None else None
+        _archive_boundary.set('until', until)
+    return until
+
+
+# --- CLI ---
+
+attendance_cli = AppGroup('attendance', help="Monthly partitions, rollups and archival for attendance_logs.")
+
+
+@attendance_cli.command('partitions')
+@click.option('--ahead', type=click.IntRange(min=0), help='Months after the current one to create partitions for (default: ATTENDANCE_PARTITIONS_AHEAD).')
+def partitions_command(ahead):
+    """Partitions attendance_logs by month (PostgreSQL) and creates the upcoming months' partitions."""
+    ahead = current_app.config.get('ATTENDANCE_PARTITIONS_AHEAD', 3) if ahead is None else ahead
+    connection = db.session.connection()
+    if not supports_partitioning(connection):
+        click.echo(f"attendance_logs stays a plain table on {connection.dialect.name}; partitioning needs PostgreSQL.")
+        return
+    if not is_partitioned(connection):
+        click.echo("Converting attendance_logs to a partitioned table; writes to it wait until this finishes...")
+    created = ensure_partitions(connection, ahead)
+    db.session.commit()
+    partitions = sorted(list_partitions(db.session.connection()))
+    click.echo(f"Created {len(created)} partition(s). attendance_logs has {len(partitions)} monthly partitions"
+               + (f", {partitions[0]:%Y-%m} to {partitions[-1]:%Y-%m}." if partitions else "."))
+
+
+@attendance_cli.command('archive')
+@click.option('--keep-months', type=click.IntRange(min=1), help='Months kept as raw rows, the current one included (default: ATTENDANCE_KEEP_MONTHS).')
+@click.option('--archive-dir', type=click.Path(file_okay=False), help='Where the .csv.gz exports go (default: ATTENDANCE_ARCHIVE_DIR).')
+@click.option('--keep-detached', is_flag=True, help='Keep archived partitions as detached tables instead of dropping them (PostgreSQL).')
+@click.option('--dry-run', is_flag=True, help='Only list the months that would be archived.')
+def archive_command(keep_months, archive_dir, keep_detached, dry_run):
+    """Rolls months older than --keep-months up into daily summaries, exports their rows and drops them."""
+    config = current_app.config
+    keep_months = keep_months or config.get('ATTENDANCE_KEEP_MONTHS', 6)
+    archive_dir = archive_dir or config.get('ATTENDANCE_ARCHIVE_DIR', 'archive/attendance')
+    max_shift_hours = config.get('ATTENDANCE_MAX_SHIFT_HOURS', DEFAULT_MAX_SHIFT_HOURS)
+    cutoff = add_months(month_start(datetime.utcnow()), 1 - keep_months)
+
+    connection = db.session.connection()
+    if not dry_run and supports_partitioning(connection) and is_partitioned(connection):
+        created = ensure_partitions(connection, config.get('ATTENDANCE_PARTITIONS_AHEAD', 3))
+        db.session.commit()
+        if created:
+            click.echo(f"Created partition(s) {', '.join(created)}.")
+
+    archived = {row[0] for row in db.session.execute(select(AttendanceArchive.month))}
+    candidates = archive_candidates(db.session, cutoff)
+    if not candidates:
+        click.echo(f"Nothing to archive before {cutoff:%Y-%m}.")
+        return
+    for month, rows in candidates:
+        if month in archived:
+            # Hours for archived months come from the rollups, so these rows (e.g. imported later) are not counted
+            click.echo(f"{month:%Y-%m}: already archived but has {rows:,} new rows; skipped (restore the month's "
+                       f"archive, delete its attendance_archives row and re-run to include them).", err=True)
+            continue
+        if dry_run:
+            click.echo(f"{month:%Y-%m}: {rows:,} rows would be archived.")
+            continue
+        try:
+            archive = archive_month(db.session, month, rows, archive_dir, keep_detached, max_shift_hours)
+        except Exception as e:
+            db.session.rollback()
+            raise click.ClickException(f"Archiving {month:%Y-%m} failed (it can be re-run): {e}")
+        kept = f"; partition kept as {archive.detached_table}" if archive.detached_table else ''
+        click.echo(f"{month:%Y-%m}: {archive.row_count:,} rows -> {archive.file_path}, {archive.summary_rows:,} daily summaries{kept}.")
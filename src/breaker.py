@@ -0,0 +1,194 @@
+# src/breaker.py
+# Circuit breaker and per-request deadline budget for the Dialogflow calls in nlp.py / nlp_async.py.
+# - CircuitBreaker: after `failure_threshold` consecutive outage errors (UNAVAILABLE,
+#   DEADLINE_EXCEEDED) the circuit opens and calls are refused without touching the network, so
+#   an outage costs each message microseconds instead of a full timeout. After `reset_timeout`
+#   one probe call is let through (half-open): success closes the circuit, failure re-opens it.
+# - Deadline budget: the webhook records when Twilio's clock started; NLP calls are given at most
+#   the time that is left (minus a reserve for the command handler and the reply) as their timeout.
+#   Twilio media downloads are capped the same way (download_budget), and also checked against
+#   a deadline between chunks, since an HTTP read timeout only bounds each read.
+# The breaker is per worker process, like the load shedder in ratelimit.py.
+import contextvars
+import os
+import threading
+import time
+
+from .log import get_logger
+from .metrics import Counter
+
+log = get_logger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2} # Gauge values on /metrics
+
+BREAKER_TRANSITIONS_TOTAL = Counter(
+    'lighthouse_circuit_transitions_total', 'Circuit breaker state changes.', ['circuit', 'state']
+)
+BREAKER_REJECTED_TOTAL = Counter(
+    'lighthouse_circuit_rejected_total', 'Calls refused because the circuit was open.', ['circuit']
+)
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker counting consecutive failures (thread-safe)."""
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, half_open_max_calls=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probes = 0 # Half-open calls in flight
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    def _set_state(self, state, now):
+        # Caller holds self._lock
+        if state == self.state:
+            return
+        log.warning("Circuit '%s' %s -> %s (failures=%s).", self.name, self.state, state, self.failures)
+        self.state = state
+        if state == OPEN:
+            self._opened_at = now
+        self._probes = 0
+        BREAKER_TRANSITIONS_TOTAL.inc(circuit=self.name, state=state)
+
+    def allow(self):
+        """True if a call may go ahead. Every allowed call must end in record_success, record_failure or release."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == OPEN and now - self._opened_at >= self.reset_timeout:
+                self._set_state(HALF_OPEN, now)
+            if self.state == HALF_OPEN and now - self._probe_started >= self.reset_timeout:
+                self._probes = 0 # A probe that never reported back doesn't hold the circuit half-open forever
+            if self.state == HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                self._probe_started = now
+                return True
+        BREAKER_REJECTED_TOTAL.inc(circuit=self.name)
+        return False
+
+    def record_success(self):
+        """The service answered (any reply other than an outage error)."""
+        with self._lock:
+            self.failures = 0
+            self._set_state(CLOSED, time.monotonic())
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                # Also re-arms the reset timer for late failures of calls started before the circuit opened
+                self._opened_at = time.monotonic()
+                self._set_state(OPEN, self._opened_at)
+
+    def release(self):
+        """The call ended without saying anything about the service (e.g. it ran out of the request's budget)."""
+        with self._lock:
+            if self.state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def stats(self):
+        return {'name': self.name, 'state': self.state, 'failures': self.failures,
+                'rejected': BREAKER_REJECTED_TOTAL.value(circuit=self.name)}
+
+
+# --- Deadline budget ---
+_deadline = contextvars.ContextVar('lighthouse_deadline', default=None)
+
+
+def start_deadline(seconds):
+    """Starts this request's budget; returns a token for end_deadline. No budget if seconds is falsy."""
+    return _deadline.set(time.monotonic() + seconds if seconds else None)
+
+
+def end_deadline(token):
+    _deadline.reset(token)
+
+
+def remaining_time():
+    """Seconds left in the current request's budget, or None outside a budgeted request (e.g. media jobs)."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def budget_timeout(timeout, reserve=0.0):
+    """
+    Caps a call timeout to the remaining budget minus reserve.
+    Returns (timeout, capped); capped is True when the budget, not the configured timeout, set the limit.
+    """
+    remaining = remaining_time()
+    if remaining is None or remaining - reserve >= timeout:
+        return timeout, False
+    return max(0.0, remaining - reserve), True
+
+
+# --- Media downloads ---
+
+class BudgetExceeded(Exception):
+    """The request's budget ran out while a media download was still being read."""
+
+
+def download_budget(timeout, reserve=None, min_seconds=0.5):
+    """
+    Timeout for a media download, capped to the remaining budget minus reserve (by default
+    NLP_DEADLINE_RESERVE, for the handler and the reply). Returns (timeout, deadline), deadline being
+    the monotonic time the whole body must be read by, or None when less than min_seconds is left.
+    """
+    if reserve is None:
+        reserve = float(os.getenv('NLP_DEADLINE_RESERVE', 1.0))
+    timeout, _ = budget_timeout(timeout, reserve)
+    if timeout < min_seconds:
+        return None
+    return timeout, time.monotonic() + timeout
+
+
+def until_deadline(chunks, deadline):
+    """Yields chunks, raising BudgetExceeded once deadline (from download_budget) has passed."""
+    for chunk in chunks:
+        if time.monotonic() > deadline:
+            raise BudgetExceeded(f"download still running {time.monotonic() - deadline:.2f}s past its deadline")
+        yield chunk
+
+
+def iter_response(response, chunk_size, deadline):
+    """
+    Yields a streamed requests response body, raising BudgetExceeded once deadline has passed. Reads
+    with urllib3's read1, which returns what has arrived instead of blocking for a full chunk, so a
+    slow download is caught within one socket read of the deadline (iter_content waits for chunk_size).
+    """
+    read1 = getattr(getattr(response, 'raw', None), 'read1', None)
+    if read1 is None:
+        return until_deadline(response.iter_content(chunk_size=chunk_size), deadline)
+    return until_deadline(_read1_chunks(read1, chunk_size), deadline)
+
+
+def _read1_chunks(read1, chunk_size):
+    # Same error mapping as requests' iter_content, with read timeouts reported as timeouts
+    import requests
+    from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError
+    while True:
+        try:
+            chunk = read1(chunk_size, decode_content=True)
+        except ReadTimeoutError as e:
+            raise requests.exceptions.ReadTimeout(e) from e
+        except ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e) from e
+        except DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e) from e
+        if not chunk:
+            return
+        yield chunk
+
+
+def check_deadline(deadline):
+    """until_deadline for async downloads: raises BudgetExceeded once deadline has passed."""
+    if time.monotonic() > deadline:
+        raise BudgetExceeded(f"download still running {time.monotonic() - deadline:.2f}s past its deadline")
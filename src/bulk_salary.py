@@ -0,0 +1,303 @@
+# src/bulk_salary.py
+# Bulk salary logging for employers: many payments in one message or one CSV/Excel file.
+#   log salary
+#   ABC12345 5000
+#   DEF67890 4500 2025-05-01 May wages
+# Every row is validated in one pass, all Sampatti IDs are resolved with a single IN query, the
+# SalaryLog rows are inserted as one executemany, and the workers' salary summaries are updated
+# in the same transaction. Rows that fail validation are skipped and listed in the reply.
+import csv
+import io
+import os
+import re
+from collections import namedtuple
+from datetime import datetime, date
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+
+from .models import db, clean_sampatti_id, User, SalaryLog
+from .commands import (
+    _apply_payment_to_summary, _summary_is_current, lock_salary_summaries, rebuild_salary_summaries,
+    media_download_budget, MEDIA_TIMEOUT_REPLY,
+)
+from .breaker import BudgetExceeded, iter_response
+from .lazy import LazyModule
+from .log import get_logger
+from .metrics import timed, stage_timer
+
+log = get_logger(__name__)
+
+requests = LazyModule('requests') # Only sheet uploads need it (see lazy.py)
+
+SalaryRow = namedtuple('SalaryRow', ['line', 'sampatti_id', 'amount', 'payment_date', 'notes'])
+
+CSV_TYPES = ('text/csv', 'text/comma-separated-values', 'application/csv', 'text/x-csv')
+EXCEL_TYPES = ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'application/vnd.ms-excel')
+DATE_FORMATS = ('%Y-%m-%d', '%d-%m-%Y', '%d/%m/%Y')
+MAX_AMOUNT = Decimal('100000000') # SalaryLog.amount is Numeric(10, 2)
+MAX_ERROR_LINES = 15 # Keeps the reply under WhatsApp's message length limit
+
+# Header names accepted in CSV/Excel files (case-insensitive); without a header, columns are positional
+HEADER_ALIASES = {
+    'sampatti_id': {'sampatti_id', 'sampatti id', 'sampatti card id', 'card id', 'worker_id', 'worker id', 'worker', 'id'},
+    'amount': {'amount', 'salary', 'pay', 'wages'},
+    'date': {'date', 'payment_date', 'payment date'},
+    'notes': {'notes', 'note', 'remarks'},
+}
+COLUMNS = ('sampatti_id', 'amount', 'date', 'notes')
+_DATE_LIKE = re.compile(r'^\d{1,4}[-/.]\d{1,2}[-/.]\d{1,4}$')
+
+
+def is_salary_sheet(media_type):
+    main_type = (media_type or '').split(';')[0].strip().lower()
+    return main_type in CSV_TYPES or main_type in EXCEL_TYPES
+
+
+# --- Parsing: every source becomes (line number, [id, amount, date, notes]) ---
+
+def parse_message_lines(text):
+    """Rows from the lines of a bulk message (after the 'log salary' line). Lines may also be split with ';'."""
+    rows = []
+    for number, line in enumerate(text.replace(';', '\n').splitlines(), start=1):
+        tokens = line.replace(':', ' ').split()
+        if tokens and tokens[0] in ('-', '*', '•'):
+            tokens = tokens[1:]
+        if not tokens:
+            continue
+        values = tokens[:2]
+        rest = tokens[2:]
+        if rest and _DATE_LIKE.match(rest[0]): # Validated later, so a bad date is reported, not taken as a note
+            values.append(rest.pop(0))
+        else:
+            values.append(None)
+        values.append(' '.join(rest) or None)
+        rows.append((number, values))
+    return rows
+
+
+def _columns_from_header(header):
+    names = [str(cell or '').strip().lower() for cell in header]
+    mapping = {}
+    for column, aliases in HEADER_ALIASES.items():
+        for index, name in enumerate(names):
+            if name in aliases:
+                mapping[column] = index
+                break
+    return mapping if 'sampatti_id' in mapping and 'amount' in mapping else None
+
+
+def _table_rows(table):
+    """Rows from a table (CSV or worksheet); the first row is a header if it names the columns."""
+    rows = []
+    mapping = None
+    for number, cells in enumerate(table, start=1):
+        cells = list(cells)
+        if not any(cell not in (None, '') for cell in cells):
+            continue
+        if number == 1:
+            mapping = _columns_from_header(cells)
+            if mapping is not None:
+                continue
+        positions = mapping or {column: index for index, column in enumerate(COLUMNS)}
+        rows.append((number, [cells[positions[c]] if c in positions and positions[c] < len(cells) else None for c in COLUMNS]))
+    return rows
+
+
+def parse_csv(data):
+    text = data.decode('utf-8-sig', errors='replace')
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    return _table_rows(csv.reader(io.StringIO(text), dialect))
+
+
+def parse_excel(data):
+    import openpyxl # Optional dependency, only needed for .xlsx uploads
+
+    workbook = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        return _table_rows(workbook.active.iter_rows(values_only=True))
+    finally:
+        workbook.close()
+
+
+def parse_salary_sheet(data):
+    """Parses an uploaded CSV or .xlsx file. Raises ValueError for formats that can't be read."""
+    if data[:4] == b'PK\x03\x04': # .xlsx is a zip archive, whatever the declared type
+        try:
+            return parse_excel(data)
+        except ImportError:
+            raise ValueError("Excel files aren't supported yet. Please send the list as a CSV file.") from None
+    if data[:8] == b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1': # Legacy .xls
+        raise ValueError("Old .xls files aren't supported. Please save the sheet as .xlsx or CSV.")
+    return parse_csv(data)
+
+
+# --- Validation ---
+
+def _parse_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(str(value).strip(), date_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_amount(value):
+    """A non-negative amount rounded to paise that fits SalaryLog.amount, or None."""
+    try:
+        amount = Decimal(str(value).replace(',', '').strip()).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+    except (InvalidOperation, ValueError, TypeError):
+        return None
+    return amount if amount.is_finite() and Decimal('0') <= amount < MAX_AMOUNT else None
+
+
+def validate_rows(rows, default_date):
+    """One pass over parsed rows. Returns ([SalaryRow], [(line, error)])."""
+    valid, errors = [], []
+    for line, (sampatti_id, amount_raw, date_raw, notes) in rows:
+        sampatti_id = clean_sampatti_id(sampatti_id)
+        if not sampatti_id:
+            errors.append((line, "missing Sampatti ID"))
+            continue
+        amount = parse_amount(amount_raw)
+        if amount is None:
+            errors.append((line, f"invalid amount '{amount_raw}' for {sampatti_id}"))
+            continue
+        payment_date = default_date
+        if date_raw not in (None, ''):
+            payment_date = _parse_date(date_raw)
+            if payment_date is None:
+                errors.append((line, f"invalid date '{date_raw}' for {sampatti_id} (use YYYY-MM-DD)"))
+                continue
+        valid.append(SalaryRow(line, sampatti_id, amount, payment_date, str(notes).strip() if notes not in (None, '') else None))
+    return valid, errors
+
+
+# --- Logging ---
+
+@timed('handler_bulk_salary')
+def handle_bulk_log_salary(employer_user, rows, source='message'):
+    """Validates and logs many payments in one transaction; returns the per-row summary reply."""
+    if not employer_user:
+        return "Error: Could not identify sender. Please register."
+    if employer_user.role != 'employer':
+        return f"Salary logging requires an 'employer' role. Your role is '{employer_user.role}'."
+    if not rows:
+        return "No salary rows found. Send one worker per line: <WorkerID> <Amount> [YYYY-MM-DD] [notes]"
+    max_rows = current_app.config.get('BULK_SALARY_MAX_ROWS', 500)
+    if len(rows) > max_rows:
+        return f"That {source} has {len(rows)} rows; please send at most {max_rows} at a time."
+
+    valid, errors = validate_rows(rows, date.today())
+    try:
+        # One IN query for every worker in the batch
+        sampatti_ids = {row.sampatti_id for row in valid}
+        worker_ids = dict(db.session.execute(
+            db.select(User.sampatti_card_id, User.id).where(User.sampatti_card_id.in_(sampatti_ids), User.role == 'worker')
+        ).all()) if sampatti_ids else {}
+        payments = []
+        for row in valid:
+            if row.sampatti_id not in worker_ids:
+                errors.append((row.line, f"no worker found with Sampatti ID '{row.sampatti_id}'"))
+            else:
+                payments.append(row)
+
+        if payments:
+            rebuild_ids = _update_summaries(payments, worker_ids)
+            # Core insert: a single executemany, whichever optional columns each row fills
+            db.session.execute(SalaryLog.__table__.insert(), [
+                {'employer_user_id': employer_user.id, 'worker_user_id': worker_ids[row.sampatti_id],
+                 'amount': row.amount, 'payment_date': row.payment_date, 'notes': row.notes}
+                for row in payments
+            ])
+            rebuild_salary_summaries(rebuild_ids) # Sees the rows just inserted
+            db.session.commit()
+    except SQLAlchemyError as e: db.session.rollback(); log.error("Error bulk logging salary DB %s: %s", employer_user.id, e); return "A database error occurred. No payments were logged."
+    except Exception as e: db.session.rollback(); log.error("Error bulk logging salary %s: %s", employer_user.id, e); return "An unexpected error occurred. No payments were logged."
+
+    log.info("Bulk salary logged by employer %s: %d payments, %d rows skipped", employer_user.id, len(payments), len(errors))
+    total = sum((row.amount for row in payments), Decimal('0'))
+    workers = len({row.sampatti_id for row in payments})
+    reply_lines = [f"Logged {len(payments)} of {len(rows)} salary payments (total {total:.2f}) for {workers} worker{'s' if workers != 1 else ''}."]
+    if errors:
+        label = 'line' if source == 'message' else 'row'
+        reply_lines.append("Not logged:")
+        for line, error in sorted(errors)[:MAX_ERROR_LINES]:
+            reply_lines.append(f"- {label} {line}: {error}")
+        if len(errors) > MAX_ERROR_LINES:
+            reply_lines.append(f"...and {len(errors) - MAX_ERROR_LINES} more.")
+    return "\n".join(reply_lines)
+
+
+def _update_summaries(payments, worker_ids):
+    """Folds the batch into the workers' summary rows (created if missing and locked in id order by
+    lock_salary_summaries). Returns the workers whose summary must be rebuilt from salary_logs after the insert."""
+    summaries, created = lock_salary_summaries(worker_ids[row.sampatti_id] for row in payments)
+    today = date.today()
+    # New rows, and rows last written in an earlier month, are rebuilt for this month instead
+    rebuild = created | {worker_id for worker_id, summary in summaries.items() if not _summary_is_current(summary, today)}
+    for row in payments:
+        worker_id = worker_ids[row.sampatti_id]
+        if worker_id not in rebuild:
+            _apply_payment_to_summary(summaries[worker_id], row.amount, row.payment_date)
+    return sorted(rebuild)
+
+
+# --- Entry points ---
+
+def check_salary_sheet_upload(user):
+    """Returns an error reply if this sender can't upload a salary sheet, else None."""
+    if not user:
+        return "Please register before uploading files. Send: register <ID> <role>"
+    if user.role != 'employer':
+        return "Salary sheets can only be uploaded by employers."
+    return None
+
+
+def handle_salary_sheet(user, data, media_type):
+    """Parses a downloaded CSV/Excel salary sheet and logs its rows."""
+    try:
+        rows = parse_salary_sheet(data)
+    except ValueError as e:
+        return str(e)
+    except Exception as e:
+        log.warning("Could not read salary sheet (%s): %s", media_type, e)
+        return "Sorry, I couldn't read that file. Please send a CSV or .xlsx with columns: WorkerID, Amount, Date (optional), Notes (optional)."
+    return handle_bulk_log_salary(user, rows, source='file')
+
+
+def handle_salary_sheet_upload(user, media_url, media_type):
+    """Downloads a salary sheet from Twilio (size-limited) and logs it."""
+    error_reply = check_salary_sheet_upload(user)
+    if error_reply:
+        return error_reply
+    max_bytes = current_app.config.get('BULK_SALARY_MAX_FILE_BYTES', 1024 * 1024)
+    budget = media_download_budget()
+    if budget is None:
+        return MEDIA_TIMEOUT_REPLY
+    timeout, deadline = budget
+    try:
+        with stage_timer('media_download'):
+            response = requests.get(
+                media_url, auth=(os.getenv('TWILIO_ACCOUNT_SID'), os.getenv('TWILIO_AUTH_TOKEN')),
+                stream=True, timeout=timeout,
+            )
+            response.raise_for_status()
+            data = bytearray()
+            for chunk in iter_response(response, 64 * 1024, deadline):
+                data.extend(chunk)
+                if len(data) > max_bytes:
+                    return f"That file is too large. Please send salary sheets up to {max_bytes // 1024} KB."
+    except requests.exceptions.HTTPError as http_err: log.error("Error downloading salary sheet (HTTP %s): %s", http_err.response.status_code, http_err); return f"Error downloading file (HTTP {http_err.response.status_code})."
+    except (BudgetExceeded, requests.exceptions.Timeout) as timed_out: log.warning("Salary sheet download ran out of the request budget: %s", timed_out); return MEDIA_TIMEOUT_REPLY
+    except requests.exceptions.RequestException as req_err: log.error("Error downloading salary sheet (Network): %s", req_err); return "Network error downloading file."
+    return handle_salary_sheet(user, bytes(data), media_type)
@@ -0,0 +1,240 @@
+# src/cache.py
+# Small bounded caches shared by the NLP layer and command handlers.
+# TTLCache lives in the worker process; SQLiteCache is a local file shared by every
+# worker process on the host (values must be JSON-serializable).
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+
+class TTLCache:
+    """Thread-safe in-process cache with LRU eviction and a per-entry TTL (seconds)."""
+
+    blocking = False # Calls never wait on I/O, so the asyncio webhook makes them inline
+
+    def __init__(self, maxsize=1024, ttl=300, name='cache'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._data = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._store(key, value, expires_at)
+
+    def add(self, key, value, ttl=None):
+        """Atomically stores value only if key is absent or expired; returns True if it was stored."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                return False
+            self._store(key, value, now + (self.ttl if ttl is None else ttl))
+            return True
+
+    def _store(self, key, value, expires_at):
+        # Caller holds self._lock
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'name': self.name, 'backend': 'memory', 'size': len(self._data), 'maxsize': self.maxsize,
+            'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions, 'expirations': self.expirations,
+        }
+
+
+class SQLiteCache:
+    """
+    Cache stored in a local SQLite file so all worker processes on a host share entries.
+    Same interface as TTLCache. Uses wall-clock time (monotonic clocks differ per process).
+    """
+
+    blocking = True # Every call is SQLite file I/O (writes commit)
+
+    def __init__(self, path, maxsize=1024, ttl=300, name='cache'):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _conn(self):
+        # One connection per thread, and never reuse a connection across fork()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and getattr(self._local, 'pid', None) == os.getpid():
+            return conn
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache_entries ('
+            ' cache TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,'
+            ' expires_at REAL NOT NULL, accessed_at REAL NOT NULL,'
+            ' PRIMARY KEY (cache, key))'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_entries_accessed ON cache_entries (cache, accessed_at)')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key, default=None):
+        now = time.time()
+        try:
+            conn = self._conn()
+            row = conn.execute(
+                'SELECT value, expires_at FROM cache_entries WHERE cache = ? AND key = ?', (self.name, key)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return default
+            if row[1] <= now:
+                conn.execute('DELETE FROM cache_entries WHERE cache = ? AND key = ?', (self.name, key))
+                self.expirations += 1
+                self.misses += 1
+                return default
+            conn.execute(
+                'UPDATE cache_entries SET accessed_at = ? WHERE cache = ? AND key = ?', (now, self.name, key)
+            )
+            self.hits += 1
+            return json.loads(row[0])
+        except sqlite3.Error as e:
+            log.warning("%s cache read failed: %s", self.name, e)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        try:
+            conn = self._conn()
+            conn.execute(
+                'INSERT OR REPLACE INTO cache_entries (cache, key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                (self.name, key, json.dumps(value), expires_at, now)
+            )
+            self._evict_overflow(conn)
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            log.warning("%s cache write failed: %s", self.name, e)
+
+    def _evict_overflow(self, conn):
+        overflow = conn.execute(
+            'SELECT COUNT(*) FROM cache_entries WHERE cache = ?', (self.name,)
+        ).fetchone()[0] - self.maxsize
+        if overflow > 0:
+            conn.execute(
+                'DELETE FROM cache_entries WHERE cache = ? AND key IN ('
+                ' SELECT key FROM cache_entries WHERE cache = ? ORDER BY accessed_at LIMIT ?)',
+                (self.name, self.name, overflow)
+            )
+            self.evictions += overflow
+
+    def add(self, key, value, ttl=None):
+        """Atomically stores value only if key is absent or expired (across processes); returns True if stored."""
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        try:
+            conn = self._conn()
+            cur = conn.execute(
+                'INSERT INTO cache_entries (cache, key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)'
+                ' ON CONFLICT (cache, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at,'
+                ' accessed_at = excluded.accessed_at WHERE cache_entries.expires_at <= excluded.accessed_at',
+                (self.name, key, json.dumps(value), expires_at, now)
+            )
+            if cur.rowcount <= 0:
+                return False
+            self._evict_overflow(conn)
+            return True
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            log.warning("%s cache add failed: %s", self.name, e)
+            return True # Fail open: behave as if nothing was cached
+
+    def delete(self, key):
+        try:
+            cur = self._conn().execute('DELETE FROM cache_entries WHERE cache = ? AND key = ?', (self.name, key))
+            return cur.rowcount > 0
+        except sqlite3.Error as e:
+            log.warning("%s cache delete failed: %s", self.name, e)
+            return False
+
+    def clear(self):
+        try:
+            self._conn().execute('DELETE FROM cache_entries WHERE cache = ?', (self.name,))
+        except sqlite3.Error as e:
+            log.warning("%s cache clear failed: %s", self.name, e)
+
+    def __len__(self):
+        try:
+            return self._conn().execute('SELECT COUNT(*) FROM cache_entries WHERE cache = ?', (self.name,)).fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+    def stats(self):
+        return {
+            'name': self.name, 'backend': 'sqlite', 'size': len(self), 'maxsize': self.maxsize,
+            'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions, 'expirations': self.expirations,
+        }
+
+
+def make_cache(backend, name, maxsize=1024, ttl=300, path=None):
+    """Builds a cache for backend 'memory' or 'sqlite'; returns None for 'off'."""
+    backend = (backend or 'memory').lower()
+    if backend in ('off', 'none', 'disabled', '0'):
+        return None
+    if backend == 'sqlite':
+        return SQLiteCache(path or os.path.join('/tmp', 'lighthouse_cache.sqlite3'), maxsize=maxsize, ttl=ttl, name=name)
+    if backend != 'memory':
+        log.warning("Unknown cache backend '%s' for %s, using in-process memory.", backend, name)
+    return TTLCache(maxsize=maxsize, ttl=ttl, name=name)
@@ -1,18 +1,34 @@
 # src/commands.py (Complete, Corrected Parameter Handling)
 import os
 import re
-import uuid
-import requests
-from datetime import datetime, date
+from collections import namedtuple
+from datetime import datetime, date, timedelta
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
-from flask import current_app # Unused currently
+from flask import current_app
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.exc import SQLAlchemyError
 
 # Relative import for models and db instance
-from .models import db, User, AttendanceLog, SalaryLog, KycDocument
-
-# Define upload path constant
-UPLOAD_FOLDER = '/app/uploads'
+from .models import db, read_session, clean_sampatti_id, User, AttendanceLog, SalaryLog, KycDocument, WorkerSalarySummary
+from .cache import TTLCache
+from .lazy import LazyModule
+from .log import get_logger
+from .metrics import timed, stage_timer
+from .storage import get_kyc_storage, StorageError, UploadTooLarge
+from .previews import schedule_previews
+from .hours import hours_by_worker, month_range, previous_month_range, day_range, DEFAULT_MAX_SHIFT_HOURS
+from .attendance_partitions import archived_until
+from .breaker import BudgetExceeded, download_budget, iter_response
+
+log = get_logger(__name__)
+
+requests = LazyModule('requests') # Only media uploads need it (see lazy.py)
+
+# Chunk size used when streaming KYC downloads into the upload store
+MEDIA_CHUNK_SIZE = 64 * 1024
+# Seconds allowed for a Twilio media download; capped to what is left of the request budget
+MEDIA_DOWNLOAD_TIMEOUT = 20.0
+MEDIA_TIMEOUT_REPLY = "That file took too long to download. Please send it again."
 
 # --- >>> HELPER FUNCTION DEFINED AT TOP <<< ---
 def get_dialogflow_param(param):
@@ -30,25 +46,109 @@ def get_dialogflow_param(param):
 # --- >>> END HELPER FUNCTION <<< ---
 
 
+# --- User Lookup Cache ---
+# Every message starts with a user lookup, so users are cached per process as detached,
+# read-only snapshots keyed by WhatsApp number and by Sampatti card ID. Entries expire after
+# USER_CACHE_TTL seconds (which also bounds staleness across worker processes) and are
+# invalidated explicitly when registration changes a user. Unknown numbers and IDs are cached
+# only for USER_CACHE_MISS_TTL seconds: a registration is invalidated in the process that handled
+# it, and the user's next message may well reach another worker.
+UserSnapshot = namedtuple('UserSnapshot', ['id', 'whatsapp_number', 'sampatti_card_id', 'role', 'language_preference'])
+
+_NO_USER = object() # Negative-cache marker
+_users_by_number = TTLCache(maxsize=10000, ttl=60, name='users_by_number')
+_users_by_card = TTLCache(maxsize=10000, ttl=60, name='users_by_card')
+_miss_ttl = 3.0
+
+
+def init_user_cache(app):
+    """Sizes the user lookup caches from USER_CACHE_SIZE, USER_CACHE_TTL and USER_CACHE_MISS_TTL."""
+    global _miss_ttl
+    for cache in (_users_by_number, _users_by_card):
+        cache.maxsize = app.config.get('USER_CACHE_SIZE', 10000)
+        cache.ttl = app.config.get('USER_CACHE_TTL', 60)
+        cache.clear()
+    _miss_ttl = app.config.get('USER_CACHE_MISS_TTL', 3.0)
+
+
+def _cache_miss(cache, key):
+    if _miss_ttl > 0:
+        cache.set(key, _NO_USER, ttl=_miss_ttl)
+
+
+def _snapshot(user):
+    return UserSnapshot(user.id, user.whatsapp_number, user.sampatti_card_id, user.role, user.language_preference)
+
+
+def _cache_user(snapshot):
+    _users_by_number.set(snapshot.whatsapp_number, snapshot)
+    if snapshot.sampatti_card_id:
+        _users_by_card.set(snapshot.sampatti_card_id, snapshot)
+
+
+def invalidate_user(whatsapp_number=None, sampatti_card_id=None):
+    """Drops cached entries for a user; call after any change to a User row."""
+    if whatsapp_number:
+        _users_by_number.delete(whatsapp_number)
+    if sampatti_card_id:
+        _users_by_card.delete(sampatti_card_id)
+
+
+def get_user_cache_stats():
+    """Hit/miss counters for the user lookup caches."""
+    return [_users_by_number.stats(), _users_by_card.stats()]
+
+
 # --- Helper Function to Get User ---
+@timed('user_lookup')
 def get_user(whatsapp_number):
-    """Fetches user from DB based on WhatsApp number."""
-    return User.query.filter_by(whatsapp_number=whatsapp_number).first()
+    """Fetches a (cached, read-only) user snapshot based on WhatsApp number."""
+    cached = _users_by_number.get(whatsapp_number)
+    if cached is not None:
+        return None if cached is _NO_USER else cached
+    with read_session() as session:
+        user = session.query(User).filter_by(whatsapp_number=whatsapp_number).first()
+        snapshot = _snapshot(user) if user is not None else None
+    if snapshot is None:
+        # The replica may not have a just-registered user yet; confirm on the primary before negative-caching
+        user = User.query.filter_by(whatsapp_number=whatsapp_number).first()
+        snapshot = _snapshot(user) if user is not None else None
+    if snapshot is None:
+        _cache_miss(_users_by_number, whatsapp_number)
+        return None
+    _cache_user(snapshot)
+    return snapshot
+
+
+def get_user_by_sampatti_id(sampatti_card_id):
+    """Fetches a (cached, read-only) user snapshot based on Sampatti card ID."""
+    sampatti_card_id = clean_sampatti_id(sampatti_card_id)
+    cached = _users_by_card.get(sampatti_card_id)
+    if cached is not None:
+        return None if cached is _NO_USER else cached
+    user = User.query.filter_by(sampatti_card_id=sampatti_card_id).first()
+    if user is None:
+        _cache_miss(_users_by_card, sampatti_card_id)
+        return None
+    snapshot = _snapshot(user)
+    _cache_user(snapshot)
+    return snapshot
 
 
 # --- Command Handler Functions (Using Parameters) ---
 
+@timed('handler_register')
 def handle_register_params(sender_number, sampatti_id_param, role_param):
     """Handles registration logic using pre-extracted parameters."""
     reply_message = ""
 
     # Extract single values safely using helper
-    sampatti_id = get_dialogflow_param(sampatti_id_param)
+    sampatti_id = clean_sampatti_id(get_dialogflow_param(sampatti_id_param))
     user_role_raw = get_dialogflow_param(role_param)
 
     # Basic validation on received params
     if not sampatti_id or not user_role_raw:
-         print(f"ERROR: Missing parameters after extraction. ID: {sampatti_id}, Role Raw: {user_role_raw}")
+         log.error("Missing parameters after extraction. ID: %s, Role Raw: %s", sampatti_id, user_role_raw)
          return "Missing required registration details (ID or Role)."
 
     # Ensure role is lowercase string
@@ -59,7 +159,7 @@ def handle_register_params(sender_number, sampatti_id_param, role_param):
         try:
              user_role = str(user_role_raw).lower()
         except Exception as e:
-             print(f"ERROR: Could not process/convert extracted role: {user_role_raw} ({type(user_role_raw)}). Error: {e}")
+             log.error("Could not process/convert extracted role: %s (%s). Error: %s", user_role_raw, type(user_role_raw), e)
 
     # Validation after conversion attempt
     if not user_role:
@@ -70,7 +170,8 @@ def handle_register_params(sender_number, sampatti_id_param, role_param):
     # Optional: Backend regex validation
     # if not re.match(r'^[A-Za-z]{3}\d{5}$', sampatti_id): return f"Invalid Sampatti ID format received: {sampatti_id}"
 
-    user = get_user(sender_number)
+    # Load the ORM row (not the cached snapshot) since it may be updated below
+    user = User.query.filter_by(whatsapp_number=sender_number).first()
 
     try:
         existing_id_link = User.query.filter_by(sampatti_card_id=sampatti_id).first()
@@ -84,23 +185,26 @@ def handle_register_params(sender_number, sampatti_id_param, role_param):
                 user.sampatti_card_id = sampatti_id
                 user.role = user_role
                 db.session.commit()
+                invalidate_user(sender_number, sampatti_id)
                 reply_message = f"Successfully linked WhatsApp to Sampatti Card ID: {sampatti_id} as a {user_role}."
         else:
             new_user = User(whatsapp_number=sender_number, sampatti_card_id=sampatti_id, role=user_role)
             db.session.add(new_user)
             db.session.commit()
+            invalidate_user(sender_number, sampatti_id)
             reply_message = f"Welcome! Registered with Sampatti Card ID: {sampatti_id} as a {user_role}."
 
     except SQLAlchemyError as e:
-        db.session.rollback(); print(f"ERROR during registration DB: {e}")
+        db.session.rollback(); log.error("Error during registration DB: %s", e)
         reply_message = "A database error occurred during registration."
     except Exception as e:
-        db.session.rollback(); print(f"ERROR during registration: {e}")
+        db.session.rollback(); log.error("Error during registration: %s", e)
         reply_message = "An error occurred during registration."
 
     return reply_message
 
 
+@timed('handler_attendance')
 def handle_attendance(user, command):
     """Handles 'checkin' and 'checkout' commands."""
     if not user: return "You need to register first before logging attendance."
@@ -108,35 +212,279 @@ def handle_attendance(user, command):
 
     log_type = command
     try:
-        new_log = AttendanceLog(user_id=user.id, log_type=log_type)
-        db.session.add(new_log); db.session.commit()
-        log_time_str = new_log.timestamp.strftime("%Y-%m-%d %H:%M:%S UTC")
-        print(f"Attendance logged for user {user.id}: {log_type}")
+        attendance_buffer = current_app.extensions.get('attendance_buffer')
+        if attendance_buffer is not None:
+            # Write-behind mode: returns once the batch containing this row is committed.
+            # Hand this request's pooled connection back first so the flusher can't be starved of one.
+            db.session.close()
+            log_timestamp = attendance_buffer.add(user.id, log_type)
+        else:
+            new_log = AttendanceLog(user_id=user.id, log_type=log_type)
+            db.session.add(new_log); db.session.commit()
+            log_timestamp = new_log.timestamp
+        log_time_str = log_timestamp.strftime("%Y-%m-%d %H:%M:%S UTC")
+        log.debug("Attendance logged for user %s: %s", user.id, log_type)
         return f"Successfully logged '{log_type}' at {log_time_str}."
-    except SQLAlchemyError as e: db.session.rollback(); print(f"ERROR logging attendance DB for user {user.id}: {e}"); return "A database error occurred."
-    except Exception as e: db.session.rollback(); print(f"ERROR logging attendance for user {user.id}: {e}"); return "An error occurred."
+    except SQLAlchemyError as e: db.session.rollback(); log.error("Error logging attendance DB for user %s: %s", user.id, e); return "A database error occurred."
+    except Exception as e: db.session.rollback(); log.error("Error logging attendance for user %s: %s", user.id, e); return "An error occurred."
 
 
+@timed('handler_salary_inquiry')
 def handle_salary_inquiry(user):
-    """Handles the 'salary' inquiry command."""
+    """Handles the 'salary' inquiry command (reads the worker's precomputed summary row)."""
     if not user: return "You need to register first to inquire about salary."
     if user.role != 'worker': return f"Salary inquiry is only for 'worker' role. Your role is '{user.role}'."
 
     try:
-        salary_logs = SalaryLog.query.filter_by(worker_user_id=user.id)\
-                                     .order_by(SalaryLog.payment_date.desc())\
-                                     .limit(5).all()
-        if not salary_logs: return "No salary records found for you."
+        with read_session() as session:
+            summary = session.get(WorkerSalarySummary, user.id)
+        today = date.today()
+        if summary is None or not _summary_is_current(summary, today):
+            summary = db.session.get(WorkerSalarySummary, user.id) # Not on the replica yet, or never built
+        if summary is None or not _summary_is_current(summary, today):
+            # Records logged before summaries existed, or no payment logged yet this month: build the
+            # row (for this month) once, later inquiries just read it
+            summary = rebuild_salary_summary(user.id, today)
+            db.session.commit()
+        if not summary.payment_count: return "No salary records found for you."
         else:
             reply_lines = ["Your recent salary records:"]
-            for log in salary_logs:
-                amount = log.amount if isinstance(log.amount, Decimal) else Decimal(str(log.amount))
-                amount_formatted = f"{amount:.2f}"
-                date_formatted = log.payment_date.strftime("%Y-%m-%d")
-                reply_lines.append(f"- {date_formatted}: {amount_formatted}")
+            for payment in summary.recent_payments:
+                reply_lines.append(f"- {payment['date']}: {payment['amount']}")
+            reply_lines.append(f"Total this month: {Decimal(summary.month_to_date):.2f}")
+            reply_lines.append(f"Total this year: {Decimal(summary.year_to_date):.2f}")
             return "\n".join(reply_lines)
-    except SQLAlchemyError as e: print(f"ERROR querying salary logs DB for user {user.id}: {e}"); return "A database error occurred."
-    except Exception as e: print(f"ERROR querying salary logs for user {user.id}: {e}"); return "An error occurred."
+    except SQLAlchemyError as e: db.session.rollback(); log.error("Error querying salary logs DB for user %s: %s", user.id, e); return "A database error occurred."
+    except Exception as e: db.session.rollback(); log.error("Error querying salary logs for user %s: %s", user.id, e); return "An error occurred."
+
+
+# --- Hours Worked ---
+HOURS_PERIODS = {
+    'this_month': ('this month', month_range),
+    'last_month': ('last month', previous_month_range),
+    'today': ('today', day_range),
+}
+ROSTER_MAX_LINES = 30 # Keeps the roster reply under WhatsApp's message length limit
+
+
+def _hours_period(period):
+    period = get_dialogflow_param(period)
+    period = str(period).strip().lower().replace(' ', '_') if period else 'this_month'
+    label, range_for = HOURS_PERIODS.get(period, HOURS_PERIODS['this_month'])
+    start, end = range_for(datetime.utcnow().date())
+    span = f"{start:%Y-%m-%d}" if period == 'today' else f"{start:%B %Y}"
+    return label, span, start, end
+
+
+def _max_shift_hours():
+    return current_app.config.get('ATTENDANCE_MAX_SHIFT_HOURS', DEFAULT_MAX_SHIFT_HOURS)
+
+
+@timed('handler_hours_inquiry')
+def handle_hours_inquiry(user, period=None):
+    """Handles 'hours' for workers: hours worked this month (or last month / today) from attendance logs."""
+    if not user: return "You need to register first to see your hours."
+    if user.role != 'worker': return f"Hours are only tracked for the 'worker' role. Your role is '{user.role}'."
+
+    label, span, start, end = _hours_period(period)
+    try:
+        with read_session() as session:
+            summary = hours_by_worker(session, [user.id], start, end, _max_shift_hours(), archived_until=archived_until(session)).get(user.id)
+        if summary is None:
+            return f"No attendance found for {label}. Send 'checkin' when you start work and 'checkout' when you finish."
+        days = f" over {summary.days_worked} day{'s' if summary.days_worked != 1 else ''}" if label != 'today' else ''
+        reply_lines = [f"Hours worked {label} ({span} UTC): {summary.hours:.1f} h{days} ({summary.shifts} shift{'s' if summary.shifts != 1 else ''})."]
+        if summary.in_progress_since:
+            reply_lines.append(f"You're checked in since {summary.in_progress_since:%Y-%m-%d %H:%M} UTC; that shift counts once you check out.")
+        if summary.missing_checkouts:
+            reply_lines.append(f"{summary.missing_checkouts} check-in(s) without a checkout were not counted.")
+        return "\n".join(reply_lines)
+    except SQLAlchemyError as e: db.session.rollback(); log.error("Error computing hours DB for user %s: %s", user.id, e); return "A database error occurred."
+    except Exception as e: db.session.rollback(); log.error("Error computing hours for user %s: %s", user.id, e); return "An error occurred."
+
+
+@timed('handler_roster_summary')
+def handle_roster_summary(user, period=None):
+    """Handles 'roster' for employers: hours per worker they have logged salary for."""
+    if not user: return "You need to register first to see your roster."
+    if user.role != 'employer': return f"The roster is only for the 'employer' role. Your role is '{user.role}'."
+
+    label, span, start, end = _hours_period(period)
+    worker_ids = db.select(SalaryLog.worker_user_id).where(SalaryLog.employer_user_id == user.id).distinct()
+    try:
+        with read_session() as session:
+            workers = session.execute(
+                db.select(User.id, User.sampatti_card_id).where(User.id.in_(worker_ids)).order_by(User.sampatti_card_id)
+            ).all()
+            if not workers:
+                return "No workers on your roster yet. Workers appear here once you log a salary for them."
+            summaries = hours_by_worker(session, worker_ids, start, end, _max_shift_hours(), archived_until=archived_until(session))
+        rows = sorted(workers, key=lambda w: -(summaries[w.id].hours if w.id in summaries else 0))
+        reply_lines = [f"Roster hours {label} ({span} UTC), {len(workers)} worker{'s' if len(workers) != 1 else ''}:"]
+        for worker in rows[:ROSTER_MAX_LINES]:
+            summary = summaries.get(worker.id)
+            if summary is None:
+                reply_lines.append(f"- {worker.sampatti_card_id}: no attendance")
+                continue
+            line = f"- {worker.sampatti_card_id}: {summary.hours:.1f} h, {summary.days_worked} day{'s' if summary.days_worked != 1 else ''}"
+            if summary.in_progress_since:
+                line += ", on shift now"
+            if summary.missing_checkouts:
+                line += f", {summary.missing_checkouts} missing checkout(s)"
+            reply_lines.append(line)
+        if len(rows) > ROSTER_MAX_LINES:
+            reply_lines.append(f"...and {len(rows) - ROSTER_MAX_LINES} more.")
+        total = sum(s.hours for s in summaries.values())
+        reply_lines.append(f"Total: {total:.1f} h")
+        return "\n".join(reply_lines)
+    except SQLAlchemyError as e: db.session.rollback(); log.error("Error computing roster DB for user %s: %s", user.id, e); return "A database error occurred."
+    except Exception as e: db.session.rollback(); log.error("Error computing roster for user %s: %s", user.id, e); return "An error occurred."
+
+
+# --- Salary Summary Maintenance ---
+SUMMARY_RECENT_PAYMENTS = 5 # Payments listed in the 'salary' reply
+
+def _summary_is_current(summary, today):
+    """
+    Month and year to date are kept for the calendar month and year the row was last rebuilt in, not
+    for the latest payment date (which may be back- or future-dated). Once a new month starts, the
+    row's totals are recomputed before the next payment is folded in (and by the next inquiry).
+    """
+    return summary.month_key == today.strftime('%Y-%m') and summary.year_key == today.year
+
+
+def _period_starts(today):
+    """(month start, next month start, year start, next year start) of today's calendar month and year."""
+    month_start = today.replace(day=1)
+    next_month = (month_start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return month_start, next_month, today.replace(month=1, day=1), today.replace(year=today.year + 1, month=1, day=1)
+
+
+def _apply_payment_to_summary(summary, amount, payment_date):
+    """Folds one payment into a current summary row (see _summary_is_current). Payments dated in
+    another month or year only count towards that period's totals, which the row doesn't hold."""
+    if payment_date.strftime('%Y-%m') == summary.month_key:
+        summary.month_to_date = Decimal(summary.month_to_date or 0) + amount
+    if payment_date.year == summary.year_key:
+        summary.year_to_date = Decimal(summary.year_to_date or 0) + amount
+
+    recent = list(summary.recent_payments or [])
+    recent.insert(0, {'date': payment_date.strftime("%Y-%m-%d"), 'amount': f"{amount:.2f}"})
+    recent.sort(key=lambda p: p['date'], reverse=True) # Stable: newest-logged first within a date
+    summary.recent_payments = recent[:SUMMARY_RECENT_PAYMENTS] # Reassign so the JSON change is persisted
+    summary.payment_count = (summary.payment_count or 0) + 1
+
+
+# INSERT ... ON CONFLICT DO NOTHING for the dialects the app runs on
+_UPSERT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def lock_salary_summaries(worker_user_ids):
+    """
+    Locks the workers' summary rows in id order, first creating the missing ones with
+    INSERT ... ON CONFLICT DO NOTHING: a concurrent first payment for the same worker then waits for
+    this transaction instead of failing it on the primary key. Returns ({worker_user_id: summary},
+    set of the ids whose rows were created here; these are empty and must be rebuilt from salary_logs).
+    """
+    worker_user_ids = sorted(set(worker_user_ids))
+    if not worker_user_ids:
+        return {}, set()
+    insert = _UPSERT_INSERTS[db.session.get_bind().dialect.name]
+    created = set(db.session.scalars(
+        insert(WorkerSalarySummary).values([
+            {'worker_user_id': worker_id, 'recent_payments': [], 'payment_count': 0} for worker_id in worker_user_ids
+        ]).on_conflict_do_nothing(index_elements=['worker_user_id']).returning(WorkerSalarySummary.worker_user_id)
+    ))
+    summaries = {
+        summary.worker_user_id: summary
+        for summary in WorkerSalarySummary.query.filter(WorkerSalarySummary.worker_user_id.in_(worker_user_ids))
+                                                .order_by(WorkerSalarySummary.worker_user_id)
+                                                .with_for_update().populate_existing()
+    }
+    return summaries, created
+
+
+def rebuild_salary_summary(worker_user_id, today=None):
+    """Recomputes a worker's summary row from salary_logs for today's month and year, creating and
+    locking the row first (caller commits). Returns the row."""
+    summaries, _ = lock_salary_summaries([worker_user_id])
+    summary = summaries[worker_user_id]
+    month_start, next_month, year_start, next_year = _period_starts(today or date.today())
+
+    recent_logs = SalaryLog.query.filter_by(worker_user_id=worker_user_id)\
+                                 .order_by(SalaryLog.payment_date.desc(), SalaryLog.id.desc())\
+                                 .limit(SUMMARY_RECENT_PAYMENTS).all()
+    summary.recent_payments = [
+        {'date': salary_log.payment_date.strftime("%Y-%m-%d"), 'amount': f"{Decimal(str(salary_log.amount)):.2f}"}
+        for salary_log in recent_logs
+    ]
+    summary.payment_count = SalaryLog.query.filter_by(worker_user_id=worker_user_id).count()
+    totals = db.session.query(
+        db.func.sum(db.case((db.and_(SalaryLog.payment_date >= month_start, SalaryLog.payment_date < next_month), SalaryLog.amount), else_=0)),
+        db.func.sum(SalaryLog.amount),
+    ).filter(
+        SalaryLog.worker_user_id == worker_user_id,
+        SalaryLog.payment_date >= year_start,
+        SalaryLog.payment_date < next_year,
+    ).one()
+    summary.month_key, summary.month_to_date = month_start.strftime('%Y-%m'), Decimal(str(totals[0] or 0))
+    summary.year_key, summary.year_to_date = year_start.year, Decimal(str(totals[1] or 0))
+    return summary
+
+
+def rebuild_salary_summaries(worker_user_ids, today=None):
+    """rebuild_salary_summary for many workers at once: two queries on salary_logs for the whole batch
+    rather than three per worker (caller commits). Returns {worker_user_id: summary row}."""
+    worker_user_ids = sorted(set(worker_user_ids))
+    if not worker_user_ids:
+        return {}
+    in_batch = SalaryLog.worker_user_id.in_(worker_user_ids)
+    ranked = db.select(
+        SalaryLog.worker_user_id, SalaryLog.payment_date, SalaryLog.amount,
+        db.func.row_number().over(
+            partition_by=SalaryLog.worker_user_id, order_by=(SalaryLog.payment_date.desc(), SalaryLog.id.desc()),
+        ).label('position'),
+    ).where(in_batch).subquery('ranked')
+    recent = {}
+    for row in db.session.execute(
+        db.select(ranked).where(ranked.c.position <= SUMMARY_RECENT_PAYMENTS).order_by(ranked.c.worker_user_id, ranked.c.position)
+    ):
+        recent.setdefault(row.worker_user_id, []).append(row)
+    # Totals per payment date; month and year to date are summed from these below
+    by_date = {}
+    for worker_id, payment_date, count, amount in db.session.execute(
+        db.select(SalaryLog.worker_user_id, SalaryLog.payment_date, db.func.count(), db.func.sum(SalaryLog.amount))
+          .where(in_batch).group_by(SalaryLog.worker_user_id, SalaryLog.payment_date)
+    ):
+        by_date.setdefault(worker_id, []).append((payment_date, count, Decimal(str(amount or 0))))
+
+    summaries, _ = lock_salary_summaries(worker_user_ids)
+    month_start, next_month, year_start, next_year = _period_starts(today or date.today())
+    for worker_id in worker_user_ids:
+        summary = summaries[worker_id]
+        payments = recent.get(worker_id, [])
+        days = by_date.get(worker_id, [])
+        summary.recent_payments = [
+            {'date': row.payment_date.strftime("%Y-%m-%d"), 'amount': f"{Decimal(str(row.amount)):.2f}"} for row in payments
+        ]
+        summary.payment_count = sum(count for _, count, _ in days)
+        summary.month_key = month_start.strftime('%Y-%m')
+        summary.month_to_date = sum((amount for day, _, amount in days if month_start <= day < next_month), Decimal('0'))
+        summary.year_key = year_start.year
+        summary.year_to_date = sum((amount for day, _, amount in days if year_start <= day < next_year), Decimal('0'))
+    return summaries
+
+
+def record_payment_in_summary(worker_user_id, amount, payment_date):
+    """Updates the worker's summary for a SalaryLog already added to the session (caller commits)."""
+    summaries, created = lock_salary_summaries([worker_user_id])
+    summary = summaries[worker_user_id]
+    if created or not _summary_is_current(summary, date.today()):
+        # First summary for this worker, or the first payment of a new month: build it from the log
+        # table (autoflush includes the new row)
+        return rebuild_salary_summary(worker_user_id)
+    _apply_payment_to_summary(summary, amount, payment_date)
+    return summary
 
 
 # --- Local date formatting helper (used only within handle_log_salary_params) ---
@@ -149,20 +497,21 @@ def _format_dialogflow_date_local(dp):
         dt_obj = datetime.fromisoformat(iso_date_str.split('T')[0].split('+')[0].split('Z')[0])
         return dt_obj.strftime("%Y-%m-%d")
     except Exception as e:
-        print(f"Error parsing date param in _format_dialogflow_date_local: {dp}. Error: {e}")
+        log.warning("Error parsing date param in _format_dialogflow_date_local: %s. Error: %s", dp, e)
         return None
 # --- End date helper ---
 
+@timed('handler_log_salary')
 def handle_log_salary_params(employer_user, worker_sampatti_id_param, amount_param, date_param=None, notes_param=None):
     """Handles log salary logic using pre-extracted parameters from Dialogflow."""
     if not employer_user:
-         print("ERROR: handle_log_salary_params called without employer_user")
+         log.error("handle_log_salary_params called without employer_user")
          return "Error: Could not identify sender. Please register."
     if employer_user.role != 'employer':
         return f"Salary logging requires an 'employer' role. Your role is '{employer_user.role}'."
 
     # Safely extract single values using helper
-    worker_sampatti_id = get_dialogflow_param(worker_sampatti_id_param)
+    worker_sampatti_id = clean_sampatti_id(get_dialogflow_param(worker_sampatti_id_param))
     amount_raw = get_dialogflow_param(amount_param)
     notes_text = get_dialogflow_param(notes_param)
 
@@ -186,90 +535,134 @@ def handle_log_salary_params(employer_user, worker_sampatti_id_param, amount_par
          try:
              payment_date_obj = datetime.strptime(date_str, "%Y-%m-%d").date()
          except ValueError:
-              print(f"ERROR: Could not parse formatted date string '{date_str}'")
+              log.error("Could not parse formatted date string '%s'", date_str)
               return "Error processing received date."
 
     # --- Database Logic ---
     try:
-        worker_user = User.query.filter_by(sampatti_card_id=worker_sampatti_id, role='worker').first()
-        if not worker_user:
+        worker_user = get_user_by_sampatti_id(worker_sampatti_id)
+        if not worker_user or worker_user.role != 'worker':
             return f"Error: No worker found with Sampatti Card ID '{worker_sampatti_id}'."
 
         new_salary_log = SalaryLog(
             employer_user_id=employer_user.id, worker_user_id=worker_user.id,
             amount=amount_decimal, payment_date=payment_date_obj, notes=notes_text
         )
-        db.session.add(new_salary_log); db.session.commit()
+        db.session.add(new_salary_log)
+        record_payment_in_summary(worker_user.id, amount_decimal, payment_date_obj)
+        db.session.commit()
         amount_formatted = f"{amount_decimal:.2f}"
         date_formatted = payment_date_obj.strftime("%Y-%m-%d")
-        print(f"Salary logged by employer {employer_user.id} for worker {worker_user.id}")
+        log.info("Salary logged by employer %s for worker %s", employer_user.id, worker_user.id)
         return f"Successfully logged salary of {amount_formatted} for worker {worker_sampatti_id} on {date_formatted}."
 
-    except SQLAlchemyError as e: db.session.rollback(); print(f"ERROR logging salary DB {employer_user.id}: {e}"); return "A database error occurred."
-    except Exception as e: db.session.rollback(); print(f"ERROR logging salary {employer_user.id}: {e}"); return "An unexpected error occurred."
+    except SQLAlchemyError as e: db.session.rollback(); log.error("Error logging salary DB %s: %s", employer_user.id, e); return "A database error occurred."
+    except Exception as e: db.session.rollback(); log.error("Error logging salary %s: %s", employer_user.id, e); return "An unexpected error occurred."
 
 
-def handle_media_upload(user, media_url, media_type):
-    """Handles incoming media files (Image/PDF), saves locally, creates DB record."""
+def check_media_upload(user, media_type):
+    """Validates a KYC upload before downloading it. Returns (file_extension, None) or (None, error reply)."""
     if not user:
-        print("ERROR: handle_media_upload called without valid user.")
-        return "Cannot process file upload without user registration."
+        log.error("handle_media_upload called without valid user.")
+        return None, "Cannot process file upload without user registration."
     if user.role != 'worker':
-        print(f"INFO: File upload attempt by non-worker role: User {user.id}, Role {user.role}")
-        return f"File upload is currently only enabled for the 'worker' role."
-
-    print(f"Attempting media download for user {user.id}: {media_url} ({media_type})")
+        log.info("File upload attempt by non-worker role: User %s, Role %s", user.id, user.role)
+        return None, f"File upload is currently only enabled for the 'worker' role."
 
     allowed_extensions = {'png', 'jpg', 'jpeg', 'pdf'}
     try: main_type = media_type.split(';')[0].strip(); file_extension = main_type.split('/')[-1].lower()
     except Exception: file_extension = None
 
     if file_extension not in allowed_extensions:
-        print(f"Unsupported file type: {media_type} (ext: {file_extension})")
-        return f"Unsupported file type: {media_type}. Please upload PDF, PNG, JPG, or JPEG."
+        log.info("Unsupported file type: %s (ext: %s)", media_type, file_extension)
+        return None, f"Unsupported file type: {media_type}. Please upload PDF, PNG, JPG, or JPEG."
 
-    twilio_account_sid = os.getenv('TWILIO_ACCOUNT_SID')
-    twilio_auth_token = os.getenv('TWILIO_AUTH_TOKEN')
-    if not twilio_account_sid or not twilio_auth_token:
-        print("ERROR: Missing Twilio credentials for media download."); return "Error: System config issue."
+    if not os.getenv('TWILIO_ACCOUNT_SID') or not os.getenv('TWILIO_AUTH_TOKEN'):
+        log.error("Missing Twilio credentials for media download."); return None, "Error: System config issue."
+    return file_extension, None
+
+
+def media_download_budget():
+    """(timeout, deadline) for a Twilio media download (see breaker.download_budget), or None when the
+    request budget is already spent."""
+    budget = download_budget(MEDIA_DOWNLOAD_TIMEOUT)
+    if budget is None:
+        log.warning("Skipping media download: the request budget is spent.")
+    return budget
 
-    try:
-        response = requests.get(
-            media_url, auth=(twilio_account_sid, twilio_auth_token), stream=True, timeout=20
-        )
-        response.raise_for_status()
 
-        unique_id = uuid.uuid4()
-        filename = f"user_{user.id}_kyc_{unique_id}.{file_extension}"
-        save_path = os.path.join(UPLOAD_FOLDER, filename)
-        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+def upload_too_large_reply(max_bytes):
+    return f"That file is too large. Please send files up to {max(1, max_bytes // (1024 * 1024))} MB."
 
-        print(f"Saving file to: {save_path}")
-        with open(save_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192): f.write(chunk)
-        print(f"File saved successfully.")
 
+def record_kyc_upload(user, stored):
+    """Creates the pending KycDocument row for a stored upload and returns the reply.
+    The same file sent again by the same user is answered from the existing row."""
+    reference = stored.sha256[:12]
+    try:
+        existing = KycDocument.query.filter_by(user_id=user.id, storage_path=stored.key).first()
+        if existing:
+            log.info("Duplicate KYC upload for user %s, file %s (document %s)", user.id, stored.key, existing.id)
+            return f"You already sent this file (ref {reference}) on {existing.uploaded_at:%Y-%m-%d}. It is {existing.status}."
         doc_type = "Uploaded Document" # Placeholder
         new_kyc_doc = KycDocument(
-            user_id=user.id, document_type=doc_type, storage_path=filename, status='pending'
+            user_id=user.id, document_type=doc_type, storage_path=stored.key, status='pending'
         )
         db.session.add(new_kyc_doc); db.session.commit()
-        print(f"KYC DB record created for user {user.id}, file {filename}")
+        log.info("KYC DB record created for user %s, file %s (%d bytes)", user.id, stored.key, stored.size)
+        schedule_previews(stored.key) # Thumbnails/previews are rendered in the background
+        return f"Received your file (ref {reference}). It is pending review."
+    except SQLAlchemyError as db_err: db.session.rollback(); log.error("Error saving KYC record DB: %s", db_err); return "Received file, but failed to record it."
 
-        return f"Received your file ({filename}). It is pending review."
 
-    except requests.exceptions.HTTPError as http_err: print(f"ERROR downloading media (HTTP {http_err.response.status_code}): {http_err}"); return f"Error downloading file (HTTP {http_err.response.status_code})."
-    except requests.exceptions.RequestException as req_err: print(f"ERROR downloading media (Network): {req_err}"); return "Network error downloading file."
-    except IOError as io_err: print(f"ERROR saving file: {io_err}"); return "Error saving file."
-    except SQLAlchemyError as db_err: db.session.rollback(); print(f"ERROR saving KYC record DB: {db_err}"); return "Received file, but failed to record it."
-    except Exception as e: db.session.rollback(); print(f"ERROR processing media: {e}"); return "Unexpected error processing file."
+@timed('handler_media_upload')
+def handle_media_upload(user, media_url, media_type):
+    """Handles incoming media files (Image/PDF), streams them into the KYC store, creates DB record."""
+    file_extension, error_reply = check_media_upload(user, media_type)
+    if error_reply:
+        return error_reply
+
+    log.debug("Attempting media download for user %s: %s (%s)", user.id, media_url, media_type)
+    twilio_account_sid = os.getenv('TWILIO_ACCOUNT_SID')
+    twilio_auth_token = os.getenv('TWILIO_AUTH_TOKEN')
+    max_bytes = current_app.config.get('KYC_MAX_UPLOAD_BYTES')
+    budget = media_download_budget()
+    if budget is None:
+        return MEDIA_TIMEOUT_REPLY
+    timeout, deadline = budget
+
+    try:
+        with stage_timer('media_download'):
+            response = requests.get(
+                media_url, auth=(twilio_account_sid, twilio_auth_token), stream=True, timeout=timeout
+            )
+            response.raise_for_status()
+            # Reject early when Twilio tells us the size; the streamed byte count is checked regardless
+            if max_bytes and int(response.headers.get('Content-Length') or 0) > max_bytes:
+                raise UploadTooLarge(max_bytes)
+            stored = get_kyc_storage().save_stream(
+                iter_response(response, MEDIA_CHUNK_SIZE, deadline), file_extension, max_bytes=max_bytes
+            )
+        log.debug("File stored as %s (new=%s).", stored.key, stored.created)
+
+        return record_kyc_upload(user, stored)
+
+    except requests.exceptions.HTTPError as http_err: log.error("Error downloading media (HTTP %s): %s", http_err.response.status_code, http_err); return f"Error downloading file (HTTP {http_err.response.status_code})."
+    except (BudgetExceeded, requests.exceptions.Timeout) as timed_out: log.warning("Media download ran out of the request budget: %s", timed_out); return MEDIA_TIMEOUT_REPLY
+    except requests.exceptions.RequestException as req_err: log.error("Error downloading media (Network): %s", req_err); return "Network error downloading file."
+    except UploadTooLarge as too_large: log.info("Rejected KYC upload from user %s: %s", user.id, too_large); return upload_too_large_reply(too_large.max_bytes)
+    except (StorageError, IOError) as io_err: log.error("Error saving file: %s", io_err); return "Error saving file."
+    except Exception as e: db.session.rollback(); log.error("Error processing media: %s", e); return "Unexpected error processing file."
 
 
 def get_fallback_message(user, message_body):
     """Generates the fallback message when no command is recognized."""
     available_commands_base = ["'register <ID> <role>'", "'checkin'", "'checkout'", "'salary'"]
+    if user and user.role == 'worker':
+        available_commands_base.append("'hours'")
     if user and user.role == 'employer':
         available_commands_base.append("'log salary <WorkerID> <Amt> [Date]'")
+        available_commands_base.append("'roster'")
     # Add placeholder for KYC upload trigger command
     if user and user.role == 'worker':
         available_commands_base.append("'upload kyc <type>' (Coming soon)")
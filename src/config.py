@@ -14,6 +14,109 @@ class Config:
     TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
     TWILIO_WHATSAPP_NUMBER = os.environ.get('TWILIO_WHATSAPP_NUMBER')
 
+    # Logging: level gate, 'text' or 'json' lines, and per-request debug overrides
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+    LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000)) # Records beyond this are dropped, never blocking requests
+    LOG_DEBUG_SENDERS = [n.strip() for n in os.environ.get('LOG_DEBUG_SENDERS', '').split(',') if n.strip()]
+    LOG_DEBUG_TOKEN = os.environ.get('LOG_DEBUG_TOKEN') # Requests with header X-Debug-Log: <token> log at DEBUG
+
+    # Create the Dialogflow client as part of the SDK preload so the first message doesn't pay for channel setup
+    DIALOGFLOW_WARM_UP = os.environ.get('DIALOGFLOW_WARM_UP', '1') == '1'
+    # Heavy SDKs (Dialogflow/gRPC) load on first use; 'background' warms them up in a thread after
+    # start-up, 'eager' before create_app returns, 'off' leaves it to the first message that needs them
+    SDK_PRELOAD = os.environ.get('SDK_PRELOAD', 'background')
+    # Per-process user lookup cache; unknown numbers/IDs are cached for USER_CACHE_MISS_TTL only (0 disables)
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+    USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60))
+    USER_CACHE_MISS_TTL = float(os.environ.get('USER_CACHE_MISS_TTL', 3))
+    # Resolve literal commands (checkin, salary, register ...) locally before calling Dialogflow
+    LOCAL_INTENT_MATCHING = os.environ.get('LOCAL_INTENT_MATCHING', '1') == '1'
+    # Per-request time budget from webhook entry (Twilio gives up at 15s); Dialogflow timeouts are capped
+    # to what is left of it, so a slow call can't push the reply past Twilio's deadline (0 disables)
+    WEBHOOK_DEADLINE_SECONDS = float(os.environ.get('WEBHOOK_DEADLINE_SECONDS', 13))
+
+    # Async media mode: ack Twilio immediately, process voice notes/KYC files in a worker pool
+    ASYNC_MEDIA_PROCESSING = os.environ.get('ASYNC_MEDIA_PROCESSING', '0') == '1'
+    JOB_QUEUE_BACKEND = os.environ.get('JOB_QUEUE_BACKEND', 'memory') # 'memory' or 'sqlite'
+    JOB_QUEUE_PATH = os.environ.get('JOB_QUEUE_PATH', '/tmp/lighthouse_jobs.sqlite3')
+    JOB_QUEUE_MAXSIZE = int(os.environ.get('JOB_QUEUE_MAXSIZE', 100)) # Backpressure limit
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+    JOB_RETRY_BACKOFF = float(os.environ.get('JOB_RETRY_BACKOFF', 2.0)) # Seconds, doubled per attempt
+
+    # Slot filling: commands missing details ('register', 'log salary W0000012') are kept per sender and
+    # follow-up answers are read locally; 'memory' per process, or 'sqlite' shared by the host's workers
+    CONVERSATION_STATE_ENABLED = os.environ.get('CONVERSATION_STATE_ENABLED', '1') == '1'
+    CONVERSATION_BACKEND = os.environ.get('CONVERSATION_BACKEND', 'memory')
+    CONVERSATION_PATH = os.environ.get('CONVERSATION_PATH', '/tmp/lighthouse_conversations.sqlite3')
+    CONVERSATION_TTL = int(os.environ.get('CONVERSATION_TTL', 300)) # Seconds an unfinished command is remembered
+    CONVERSATION_MAX_SENDERS = int(os.environ.get('CONVERSATION_MAX_SENDERS', 50000))
+
+    # Write-behind batching of attendance inserts for shift-change spikes
+    ATTENDANCE_WRITE_BEHIND = os.environ.get('ATTENDANCE_WRITE_BEHIND', '0') == '1'
+    ATTENDANCE_BUFFER_MAX_ROWS = int(os.environ.get('ATTENDANCE_BUFFER_MAX_ROWS', 200))
+    ATTENDANCE_BUFFER_MAX_WAIT_MS = int(os.environ.get('ATTENDANCE_BUFFER_MAX_WAIT_MS', 50))
+
+    # Bulk salary logging (multi-line 'log salary' messages and CSV/Excel uploads)
+    BULK_SALARY_MAX_ROWS = int(os.environ.get('BULK_SALARY_MAX_ROWS', 500))
+    BULK_SALARY_MAX_FILE_BYTES = int(os.environ.get('BULK_SALARY_MAX_FILE_BYTES', 1024 * 1024))
+
+    # `flask import` bulk loading: records per transaction, and COPY for appends on PostgreSQL
+    IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 5000))
+    IMPORT_USE_COPY = os.environ.get('IMPORT_USE_COPY', '1') == '1'
+
+    # Hours engine: a checkin with no checkout within this many hours counts as a missing checkout
+    ATTENDANCE_MAX_SHIFT_HOURS = float(os.environ.get('ATTENDANCE_MAX_SHIFT_HOURS', 16))
+
+    # attendance_logs partitions (PostgreSQL) and `flask attendance archive`
+    ATTENDANCE_PARTITIONS_AHEAD = int(os.environ.get('ATTENDANCE_PARTITIONS_AHEAD', 3)) # Months created ahead of the current one
+    ATTENDANCE_KEEP_MONTHS = int(os.environ.get('ATTENDANCE_KEEP_MONTHS', 6)) # Months kept as raw rows, the current one included
+    ATTENDANCE_ARCHIVE_DIR = os.environ.get('ATTENDANCE_ARCHIVE_DIR', 'archive/attendance') # Exported .csv.gz files
+
+    # Deduplicate Twilio retries on MessageSid and replay the stored TwiML
+    IDEMPOTENCY_ENABLED = os.environ.get('IDEMPOTENCY_ENABLED', '1') == '1'
+    IDEMPOTENCY_BACKEND = os.environ.get('IDEMPOTENCY_BACKEND', 'memory') # 'memory' or 'sqlite' (shared by workers)
+    IDEMPOTENCY_PATH = os.environ.get('IDEMPOTENCY_PATH', '/tmp/lighthouse_idempotency.sqlite3')
+    IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 3600)) # Seconds a reply is kept for retries
+    IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get('IDEMPOTENCY_MAX_ENTRIES', 50000))
+    IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 1)) # Retry waits this long for an in-flight original
+
+    # Per-sender token buckets (messages per minute / burst), checked before user lookup and NLP
+    RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+    RATE_LIMIT_TEXT_PER_MIN = float(os.environ.get('RATE_LIMIT_TEXT_PER_MIN', 20))
+    RATE_LIMIT_TEXT_BURST = int(os.environ.get('RATE_LIMIT_TEXT_BURST', 10))
+    RATE_LIMIT_AUDIO_PER_MIN = float(os.environ.get('RATE_LIMIT_AUDIO_PER_MIN', 6))
+    RATE_LIMIT_AUDIO_BURST = int(os.environ.get('RATE_LIMIT_AUDIO_BURST', 3))
+    RATE_LIMIT_MEDIA_PER_MIN = float(os.environ.get('RATE_LIMIT_MEDIA_PER_MIN', 6))
+    RATE_LIMIT_MEDIA_BURST = int(os.environ.get('RATE_LIMIT_MEDIA_BURST', 3))
+    RATE_LIMIT_MAX_SENDERS = int(os.environ.get('RATE_LIMIT_MAX_SENDERS', 100000))
+    # Load shedding: concurrent webhook requests per process (0 disables), and the lower cap used
+    # while the Dialogflow error rate is at or above SHED_NLP_ERROR_RATE
+    MAX_IN_FLIGHT_REQUESTS = int(os.environ.get('MAX_IN_FLIGHT_REQUESTS', 64))
+    DEGRADED_IN_FLIGHT_REQUESTS = int(os.environ.get('DEGRADED_IN_FLIGHT_REQUESTS', 0)) # 0 = a quarter of the cap
+    SHED_NLP_ERROR_RATE = float(os.environ.get('SHED_NLP_ERROR_RATE', 0.5))
+
+    # KYC uploads: content-addressed store (files kept under their SHA-256, sharded by prefix)
+    KYC_STORAGE_BACKEND = os.environ.get('KYC_STORAGE_BACKEND', 'local')
+    KYC_STORAGE_ROOT = os.environ.get('UPLOAD_FOLDER', '/app/uploads')
+    KYC_MAX_UPLOAD_BYTES = int(os.environ.get('KYC_MAX_UPLOAD_BYTES', 16 * 1024 * 1024)) # WhatsApp's own media limit
+
+    # KYC previews: background process pool (needs Pillow; pypdfium2 for PDF first pages)
+    KYC_PREVIEWS_ENABLED = os.environ.get('KYC_PREVIEWS_ENABLED', '1') == '1'
+    KYC_PREVIEW_WORKERS = int(os.environ.get('KYC_PREVIEW_WORKERS', 0)) # 0 = a quarter of the CPUs
+    KYC_PREVIEW_QUEUE_MAXSIZE = int(os.environ.get('KYC_PREVIEW_QUEUE_MAXSIZE', 32))
+    KYC_PREVIEW_SIZE = int(os.environ.get('KYC_PREVIEW_SIZE', 1600)) # Longest edge in pixels
+    KYC_THUMBNAIL_SIZE = int(os.environ.get('KYC_THUMBNAIL_SIZE', 320))
+
+    # ASGI entry point (asgi.py): threads for blocking DB work; keep <= DB pool size + overflow
+    ASYNC_DB_WORKERS = int(os.environ.get('ASYNC_DB_WORKERS', 16))
+
+    # Prometheus-style /metrics route (per worker process); set METRICS_TOKEN to require a bearer token
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_REQUIRE_TOKEN = False # Don't serve /metrics at all without METRICS_TOKEN
+
     @staticmethod
     def init_app(app):
         pass
@@ -21,6 +124,7 @@ class Config:
 class DevelopmentConfig(Config):
     """Development configuration."""
     DEBUG = True
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG')
     db_url = os.environ.get('DATABASE_URL')
     if db_url and db_url.startswith("postgres://"):
         db_url = db_url.replace("postgres://", "postgresql://", 1)
@@ -29,6 +133,7 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
     """Testing configuration."""
     TESTING = True
+    DIALOGFLOW_WARM_UP = False # Tests shouldn't need Google credentials
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or 'sqlite:///:memory:' # Use in-memory SQLite for tests
 
 class ProductionConfig(Config):
@@ -40,6 +145,24 @@ class ProductionConfig(Config):
         db_url = db_url.replace("postgres://", "postgresql://", 1)
     SQLALCHEMY_DATABASE_URI = db_url
 
+    # Connection pool per worker process (also used for the replica bind)
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)), # Seconds to wait for a free connection
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)), # Reconnect before server/proxy idle timeouts
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1', # Drop dead connections instead of failing a request
+    }
+
+    # Optional read replica for read-only paths (user lookup, salary inquiry, '/' user count)
+    replica_url = os.environ.get('DATABASE_REPLICA_URL')
+    if replica_url and replica_url.startswith("postgres://"):
+        replica_url = replica_url.replace("postgres://", "postgresql://", 1)
+    SQLALCHEMY_BINDS = {'replica': replica_url} if replica_url else {}
+
+    # /metrics exposes cache and queue sizes; never serve it publicly
+    METRICS_REQUIRE_TOKEN = True
+
     @classmethod
     def init_app(cls, app):
         Config.init_app(app)
@@ -0,0 +1,139 @@
+# src/conversation.py
+# Local slot filling for commands that arrive without all their details.
+# 'register', 'register ABC12345' or 'log salary W0000012' (from the local matcher, or a Dialogflow
+# result with missing parameters) starts a conversation: the parameters filled so far are kept per
+# sender for CONVERSATION_TTL seconds and the user is asked for the next one. Follow-up answers
+# ('ABC12345', 'worker', 'Rs 5000', '2025-01-31') are read locally by intents.match_slot_answer, so a
+# multi-turn command costs no Dialogflow round trips; only text that isn't an answer goes on to the
+# local matcher and Dialogflow. The store is a bounded TTL cache: in-process ('memory') or shared by
+# all workers on the host ('sqlite'), since a follow-up may be served by any worker.
+from collections.abc import Mapping
+
+from .cache import make_cache
+from .commands import get_dialogflow_param
+from .intents import match_slot_answer, is_cancel
+from .log import get_logger
+from .metrics import Counter, INTENTS_TOTAL
+from .nlp import reset_session_context
+
+log = get_logger(__name__)
+
+# Required parameters per intent, in the order they are asked for; optional ones are taken when offered
+SLOTS = {
+    'RegisterUser': ('sampatti_id', 'role'),
+    'LogSalary': ('sampatti_id', 'amount'),
+}
+OPTIONAL_SLOTS = {
+    'LogSalary': ('date',),
+}
+PROMPTS = {
+    ('RegisterUser', 'sampatti_id'): "What is your Sampatti card ID?",
+    ('RegisterUser', 'role'): "Are you registering as a worker or an employer?",
+    ('LogSalary', 'sampatti_id'): "Which worker was paid? Send their Sampatti card ID.",
+    ('LogSalary', 'amount'): "How much was paid? Send the amount, e.g. 5000.",
+}
+CANCELLED_REPLY = "Okay, I've cancelled that."
+
+CONVERSATION_TURNS_TOTAL = Counter(
+    'lighthouse_conversation_turns_total', 'Slot-filling turns by outcome.', ['intent', 'outcome']
+)
+
+
+def is_filled(value):
+    """Dialogflow leaves unfilled parameters as '' (or an empty list)."""
+    if value is None or value == '':
+        return False
+    if hasattr(value, '__len__') and not isinstance(value, (str, bytes, Mapping)):
+        return len(value) > 0
+    return True
+
+
+def missing_slots(intent, parameters):
+    return [slot for slot in SLOTS.get(intent, ()) if not is_filled(parameters.get(slot))]
+
+
+def _plain(value):
+    """A JSON-serializable copy of a (possibly Dialogflow Struct) parameter value."""
+    value = get_dialogflow_param(value)
+    if isinstance(value, Mapping):
+        return {key: _plain(item) for key, item in value.items()}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+class ConversationStore:
+    """Partially filled commands, keyed on the sender's WhatsApp number."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def ask(self, sender, intent, parameters, prompt=None):
+        """Saves what is filled so far and returns the question for the next missing parameter
+        (prompt, e.g. Dialogflow's own, if given)."""
+        filled = {key: _plain(value) for key, value in parameters.items() if is_filled(value)}
+        self.store.set(sender, {'intent': intent, 'parameters': filled})
+        CONVERSATION_TURNS_TOTAL.inc(intent=intent, outcome='asked')
+        return prompt or PROMPTS[(intent, missing_slots(intent, filled)[0])]
+
+    def fill(self, sender, intent, parameters):
+        """Adds parameters kept from earlier turns of the same command to a new (partial) result."""
+        state = self.store.get(sender)
+        if state is None or state['intent'] != intent:
+            return parameters
+        merged = dict(state['parameters'])
+        merged.update({key: value for key, value in parameters.items() if is_filled(value)})
+        return merged
+
+    def resume(self, sender, text, language_code='en'):
+        """
+        Continues the sender's pending command with a text message.
+        Returns (intent, parameters, None) when the command is complete, (None, None, reply) when the
+        message was an answer (or 'cancel') and was handled here, or (None, None, None) otherwise.
+        """
+        state = self.store.get(sender)
+        if state is None:
+            return None, None, None
+        intent = state['intent']
+        if is_cancel(text, language_code):
+            self.store.delete(sender)
+            CONVERSATION_TURNS_TOTAL.inc(intent=intent, outcome='cancelled')
+            reset_session_context(sender)
+            return None, None, CANCELLED_REPLY
+        slots = missing_slots(intent, state['parameters']) + list(OPTIONAL_SLOTS.get(intent, ()))
+        answer = match_slot_answer(text, slots, language_code)
+        if answer is None:
+            CONVERSATION_TURNS_TOTAL.inc(intent=intent, outcome='not_an_answer')
+            return None, None, None
+        # Dialogflow may still be waiting for this answer; make its next call start fresh
+        reset_session_context(sender)
+        parameters = {**state['parameters'], **answer}
+        if missing_slots(intent, parameters):
+            return None, None, self.ask(sender, intent, parameters)
+        self.store.delete(sender)
+        CONVERSATION_TURNS_TOTAL.inc(intent=intent, outcome='completed')
+        INTENTS_TOTAL.inc(intent=intent, source='conversation')
+        log.debug("Slot filling completed %s locally: %s", intent, parameters)
+        return intent, parameters, None
+
+    def clear(self, sender):
+        self.store.delete(sender)
+
+    def stats(self):
+        return self.store.stats()
+
+
+def init_conversations(app):
+    """Sets up the slot-filling store unless CONVERSATION_STATE_ENABLED is off."""
+    if not app.config.get('CONVERSATION_STATE_ENABLED', True):
+        return None
+    store = make_cache(
+        app.config.get('CONVERSATION_BACKEND', 'memory'), name='conversations',
+        maxsize=app.config.get('CONVERSATION_MAX_SENDERS', 50000), ttl=app.config.get('CONVERSATION_TTL', 300),
+        path=app.config.get('CONVERSATION_PATH'),
+    )
+    if store is None:
+        return None
+    conversations = ConversationStore(store)
+    app.extensions['conversations'] = conversations
+    return conversations
@@ -0,0 +1,227 @@
+# src/hours.py
+# Turns raw AttendanceLog checkin/checkout events into hours worked, entirely in SQL.
+# Events are paired with window functions over (user_id, timestamp), which is served by the
+# ix_attendance_logs_user_timestamp index, so a roster of hundreds of workers is one query
+# rather than a Python loop over every row. Rules:
+# - A run of checkins counts from the first one (a repeated 'checkin' is ignored), and a run of
+#   checkouts ends at the last one. A checkin more than max_shift after the previous checkin
+#   starts a new run, as does a checkout more than max_shift before the next one.
+# - A checkin pairs with the next remaining event if that is a checkout no more than max_shift later.
+#   Otherwise it has a missing checkout and counts no hours (or is 'in progress' if it is recent).
+# - Shifts count towards the UTC day (and month) in which they started.
+# Months archived by `flask attendance archive` (attendance_partitions.py) no longer have raw events;
+# hours_by_worker reads their daily rollups instead when given archived_until.
+# Works on PostgreSQL and SQLite (3.25+, for window functions).
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import select, func, and_, or_, case, literal
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.types import Date, Float
+
+from .models import AttendanceLog, AttendanceDailySummary
+
+DEFAULT_MAX_SHIFT_HOURS = 16
+
+DailyHours = namedtuple('DailyHours', ['user_id', 'day', 'hours', 'shifts', 'missing_checkouts'])
+HoursSummary = namedtuple('HoursSummary', ['user_id', 'hours', 'days_worked', 'shifts', 'missing_checkouts', 'in_progress_since'])
+
+
+# --- Portable date arithmetic ---
+
+class seconds_between(FunctionElement):
+    """seconds_between(start, end): end - start in seconds."""
+    type = Float()
+    name = 'seconds_between'
+    inherit_cache = True
+
+
+@compiles(seconds_between)
+def _seconds_between_default(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return f"EXTRACT(EPOCH FROM ({compiler.process(end, **kw)} - {compiler.process(start, **kw)}))"
+
+
+@compiles(seconds_between, 'sqlite')
+def _seconds_between_sqlite(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return f"((julianday({compiler.process(end, **kw)}) - julianday({compiler.process(start, **kw)})) * 86400.0)"
+
+
+class day_of(FunctionElement):
+    """day_of(timestamp): the calendar date of a timestamp."""
+    type = Date()
+    name = 'day_of'
+    inherit_cache = True
+
+
+@compiles(day_of)
+def _day_of_default(element, compiler, **kw):
+    return f"CAST({compiler.process(element.clauses, **kw)} AS DATE)"
+
+
+@compiles(day_of, 'sqlite')
+def _day_of_sqlite(element, compiler, **kw):
+    return f"date({compiler.process(element.clauses, **kw)})"
+
+
+# --- Date ranges ---
+
+def month_range(day):
+    """(start, end) datetimes of the month containing day; end is exclusive."""
+    start = datetime(day.year, day.month, 1)
+    end = datetime(day.year + (day.month == 12), day.month % 12 + 1, 1)
+    return start, end
+
+
+def previous_month_range(day):
+    start, _ = month_range(day)
+    return month_range((start - timedelta(days=1)).date())
+
+
+def day_range(day):
+    start = datetime(day.year, day.month, day.day)
+    return start, start + timedelta(days=1)
+
+
+# --- Queries ---
+
+def shifts_query(user_ids, start, end, max_shift_hours=DEFAULT_MAX_SHIFT_HOURS, now=None):
+    """Shifts started in [start, end) for user_ids (a list or a SELECT of user ids).
+    Columns: user_id, started_at, ended_at (NULL when unpaired), seconds, missing, in_progress."""
+    max_shift = max_shift_hours * 3600.0
+    margin = timedelta(hours=max_shift_hours)
+    now = now or datetime.utcnow()
+
+    # 1. Each event with its neighbours. The scan is widened by one shift on both sides so
+    #    shifts crossing the range boundaries still find their partner.
+    log = AttendanceLog
+    by_user = {'partition_by': log.user_id, 'order_by': (log.timestamp, log.id)}
+    events = select(
+        log.id, log.user_id, log.log_type, log.timestamp,
+        func.lag(log.log_type).over(**by_user).label('prev_type'),
+        func.lag(log.timestamp).over(**by_user).label('prev_at'),
+        func.lead(log.log_type).over(**by_user).label('next_type'),
+        func.lead(log.timestamp).over(**by_user).label('next_at'),
+    ).where(
+        log.user_id.in_(user_ids), log.timestamp >= start - margin, log.timestamp < end + margin,
+    ).subquery('events')
+
+    # 2. Collapse repeated checkins (keep the first) and repeated checkouts (keep the last)
+    e = events.c
+    kept = select(e.id, e.user_id, e.log_type, e.timestamp).where(or_(
+        and_(e.log_type == 'checkin', or_(
+            e.prev_type.is_(None), e.prev_type != 'checkin', seconds_between(e.prev_at, e.timestamp) > max_shift,
+        )),
+        and_(e.log_type == 'checkout', or_(
+            e.next_type.is_(None), e.next_type != 'checkout', seconds_between(e.timestamp, e.next_at) > max_shift,
+        )),
+    )).subquery('kept')
+
+    # 3. Events now alternate, so each checkin's partner is simply the next remaining event
+    k = kept.c
+    by_user = {'partition_by': k.user_id, 'order_by': (k.timestamp, k.id)}
+    paired = select(
+        k.user_id, k.log_type, k.timestamp.label('started_at'),
+        func.lead(k.log_type).over(**by_user).label('end_type'),
+        func.lead(k.timestamp).over(**by_user).label('end_at'),
+    ).subquery('paired')
+
+    p = paired.c
+    complete = and_(p.end_type == 'checkout', seconds_between(p.started_at, p.end_at) <= max_shift)
+    recent = seconds_between(p.started_at, literal(now)) <= max_shift
+    return select(
+        p.user_id, p.started_at,
+        case((complete, p.end_at)).label('ended_at'),
+        case((complete, seconds_between(p.started_at, p.end_at)), else_=0.0).label('seconds'),
+        case((complete, 0), (recent, 0), else_=1).label('missing'),
+        case((complete, 0), (recent, 1), else_=0).label('in_progress'),
+    ).where(p.log_type == 'checkin', p.started_at >= start, p.started_at < end)
+
+
+def daily_hours_query(user_ids, start, end, max_shift_hours=DEFAULT_MAX_SHIFT_HOURS, now=None):
+    """Per worker and day of shifts started in [start, end). Columns: user_id, day, seconds, shifts, missing."""
+    shifts = shifts_query(user_ids, start, end, max_shift_hours, now).subquery('shifts')
+    s = shifts.c
+    day = day_of(s.started_at)
+    return select(
+        s.user_id, day.label('day'), func.sum(s.seconds).label('seconds'),
+        func.sum(1 - s.missing - s.in_progress).label('shifts'), func.sum(s.missing).label('missing'),
+    ).group_by(s.user_id, day)
+
+
+def daily_hours(session, user_ids, start, end, max_shift_hours=DEFAULT_MAX_SHIFT_HOURS, now=None):
+    """Hours per worker per day for shifts started in [start, end)."""
+    query = daily_hours_query(user_ids, start, end, max_shift_hours, now).subquery('daily')
+    rows = session.execute(select(query).order_by(query.c.user_id, query.c.day))
+    return [
+        DailyHours(row.user_id, _as_date(row.day), round((row.seconds or 0) / 3600.0, 2), int(row.shifts or 0), int(row.missing or 0))
+        for row in rows
+    ]
+
+
+def hours_by_worker(session, user_ids, start, end, max_shift_hours=DEFAULT_MAX_SHIFT_HOURS, now=None, archived_until=None):
+    """
+    {user_id: HoursSummary} for shifts started in [start, end). Workers with no checkins are absent.
+    Days before archived_until (the end of the last archived month) come from attendance_daily_summaries.
+    """
+    totals = {}
+    if archived_until is not None and start < archived_until:
+        _add_totals(totals, _rolled_up_totals(session, user_ids, start, min(end, archived_until)))
+        start = archived_until
+    if start < end:
+        shifts = shifts_query(user_ids, start, end, max_shift_hours, now).subquery('shifts')
+        s = shifts.c
+        worked_day = case((s.seconds > 0, day_of(s.started_at)))
+        _add_totals(totals, session.execute(
+            select(
+                s.user_id, func.sum(s.seconds).label('seconds'),
+                func.count(func.distinct(worked_day)).label('days'),
+                func.sum(1 - s.missing - s.in_progress).label('shifts'), func.sum(s.missing).label('missing'),
+                func.max(case((s.in_progress == 1, s.started_at))).label('in_progress_since'),
+            ).group_by(s.user_id)
+        ))
+    return {
+        user_id: HoursSummary(
+            user_id, round(total['seconds'] / 3600.0, 2), total['days'], total['shifts'], total['missing'],
+            _as_datetime(total['in_progress_since']),
+        )
+        for user_id, total in totals.items()
+    }
+
+
+def _rolled_up_totals(session, user_ids, start, end):
+    """Same columns as the raw totals in hours_by_worker, summed from the daily rollups of archived months."""
+    d = AttendanceDailySummary
+    return session.execute(
+        select(
+            d.user_id, func.sum(d.worked_seconds).label('seconds'),
+            func.count(case((d.worked_seconds > 0, d.day))).label('days'),
+            func.sum(d.shifts).label('shifts'), func.sum(d.missing_checkouts).label('missing'),
+            literal(None).label('in_progress_since'),
+        ).where(d.user_id.in_(user_ids), d.day >= start.date(), d.day < end.date()).group_by(d.user_id)
+    )
+
+
+def _add_totals(totals, rows):
+    for row in rows:
+        total = totals.setdefault(row.user_id, {'seconds': 0.0, 'days': 0, 'shifts': 0, 'missing': 0, 'in_progress_since': None})
+        total['seconds'] += row.seconds or 0
+        total['days'] += int(row.days or 0) # Rolled-up and raw days never overlap
+        total['shifts'] += int(row.shifts or 0)
+        total['missing'] += int(row.missing or 0)
+        total['in_progress_since'] = row.in_progress_since or total['in_progress_since']
+
+
+def _as_date(value):
+    # SQLite returns date() results as text
+    if value is None or isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _as_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
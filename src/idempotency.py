@@ -0,0 +1,124 @@
+# src/idempotency.py
+# Deduplicates Twilio webhook deliveries on MessageSid.
+# Twilio retries a webhook it considers slow, and each retry used to rerun Dialogflow and could
+# insert a second AttendanceLog/SalaryLog row. The first delivery claims the SID; once it has
+# replied, its TwiML is stored and every retry gets that same TwiML back without doing any work.
+# A retry that arrives while the first delivery is still running waits briefly (about a second,
+# never past its own request budget) for that reply, then gets an empty TwiML so it doesn't hold a
+# worker for the rest of the original's run.
+# The store is a bounded TTL cache: in-process ('memory') or shared by all workers on the
+# host ('sqlite').
+import asyncio
+import time
+
+from twilio.twiml.messaging_response import MessagingResponse
+
+from .breaker import remaining_time
+from .cache import make_cache
+from .log import get_logger
+from .metrics import Counter
+
+log = get_logger(__name__)
+
+DUPLICATES_TOTAL = Counter(
+    'lighthouse_webhook_duplicates_total', 'Repeated MessageSid deliveries by outcome.', ['outcome']
+)
+
+_POLL_INTERVAL = 0.05 # Seconds between checks while another delivery is still processing
+_WAIT = object() # _resolve() result meaning 'keep polling'
+DEFAULT_PENDING_TTL = 60.0 # Used when there is no WEBHOOK_DEADLINE_SECONDS to derive it from
+
+
+class MessageDeduplicator:
+    """Claim/complete protocol around one webhook delivery, keyed on MessageSid."""
+
+    def __init__(self, store, wait_seconds=1.0, pending_ttl=DEFAULT_PENDING_TTL):
+        self.store = store
+        self.wait_seconds = wait_seconds
+        self.pending_ttl = pending_ttl # A claim whose worker died is released after this long
+
+    def try_claim(self, message_sid):
+        """Returns (True, None) if this delivery should process the message, (False, twiml) for a
+        completed duplicate, or (False, None) while another delivery is still processing it."""
+        if self.store.add(message_sid, {'status': 'pending'}, ttl=self.pending_ttl):
+            return True, None
+        entry = self.store.get(message_sid)
+        if entry is None: # Expired between the two calls; try again
+            return self.try_claim(message_sid)
+        if entry.get('status') == 'done':
+            return False, entry['twiml']
+        return False, None
+
+    def claim(self, message_sid):
+        """Blocking claim. Returns None if the caller owns the message, else the TwiML to return."""
+        deadline = self._wait_deadline()
+        while True:
+            owned, twiml = self.try_claim(message_sid)
+            result = self._resolve(message_sid, owned, twiml, deadline)
+            if result is not _WAIT:
+                return result
+            time.sleep(_POLL_INTERVAL)
+
+    async def claim_async(self, message_sid, run):
+        """claim() for the asyncio webhook; waits without blocking the event loop. Store calls are made
+        through `run` (an async callable(func, *args), e.g. the DB pool for the 'sqlite' store)."""
+        deadline = self._wait_deadline()
+        while True:
+            owned, twiml = await run(self.try_claim, message_sid)
+            result = self._resolve(message_sid, owned, twiml, deadline)
+            if result is not _WAIT:
+                return result
+            await asyncio.sleep(_POLL_INTERVAL)
+
+    def _wait_deadline(self):
+        # A retry waits at most wait_seconds and never past its own request budget
+        wait = self.wait_seconds
+        remaining = remaining_time()
+        if remaining is not None:
+            wait = min(wait, max(0.0, remaining))
+        return time.monotonic() + wait
+
+    def _resolve(self, message_sid, owned, twiml, deadline):
+        if owned:
+            return None
+        if twiml is not None:
+            DUPLICATES_TOTAL.inc(outcome='replayed')
+            log.info("Duplicate delivery of %s, returning the stored reply.", message_sid)
+            return twiml
+        if time.monotonic() >= deadline:
+            # Still processing elsewhere; acknowledge without a message so Twilio stops retrying
+            DUPLICATES_TOTAL.inc(outcome='in_flight')
+            log.warning("Duplicate delivery of %s while it is still being processed.", message_sid)
+            return str(MessagingResponse())
+        return _WAIT
+
+    def complete(self, message_sid, twiml):
+        self.store.set(message_sid, {'status': 'done', 'twiml': twiml})
+
+    def release(self, message_sid):
+        """Drops a claim after a failure so a retry processes the message again."""
+        self.store.delete(message_sid)
+
+    def stats(self):
+        return self.store.stats()
+
+
+def init_idempotency(app):
+    """Sets up MessageSid deduplication unless IDEMPOTENCY_ENABLED is off."""
+    if not app.config.get('IDEMPOTENCY_ENABLED', True):
+        return None
+    store = make_cache(
+        app.config.get('IDEMPOTENCY_BACKEND', 'memory'), name='message_sids',
+        maxsize=app.config.get('IDEMPOTENCY_MAX_ENTRIES', 50000), ttl=app.config.get('IDEMPOTENCY_TTL', 3600),
+        path=app.config.get('IDEMPOTENCY_PATH'),
+    )
+    if store is None:
+        return None
+    # A claim must outlive a delivery that keeps to its budget; one left by a dead worker is freed after two
+    webhook_deadline = app.config.get('WEBHOOK_DEADLINE_SECONDS')
+    deduplicator = MessageDeduplicator(
+        store, wait_seconds=app.config.get('IDEMPOTENCY_WAIT_SECONDS', 1.0),
+        pending_ttl=2 * webhook_deadline if webhook_deadline else DEFAULT_PENDING_TTL,
+    )
+    app.extensions['message_dedup'] = deduplicator
+    return deduplicator
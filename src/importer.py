@@ -0,0 +1,464 @@
+# src/importer.py
+# Bulk loading for onboarding an employer: `flask import users|attendance|salary FILE`.
+#   flask import users workers.csv
+#   flask import attendance punches.jsonl.gz --chunk-size 20000
+#   flask import salary payments.csv --rejects rejected.csv
+# Input (CSV with a header row, or JSON Lines; optionally gzipped, '-' for stdin) is streamed in
+# chunks of IMPORT_CHUNK_SIZE records, so memory stays flat however large the file is. Each chunk is
+# validated, resolved against the users table with IN queries, written in one statement and
+# committed. Attendance and salary rows use COPY on PostgreSQL (psycopg2) and executemany elsewhere.
+# Users are upserted: a row matching an existing user on whatsapp_number or sampatti_card_id
+# (ignoring case) updates it, anything else is inserted, so re-running a users import is safe.
+# Attendance and salary rows are appended, so don't re-run those on the same file (try --dry-run
+# first). Invalid rows are skipped and counted (and written to --rejects). If a chunk still fails in the
+# database, it is retried one row at a time so only the offending rows are rejected.
+# Web processes pick up imported users once their USER_CACHE_TTL expires.
+import csv
+import gzip
+import io
+import json
+import sys
+import time
+from datetime import datetime, timezone
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import bindparam, func, or_
+from sqlalchemy.exc import SQLAlchemyError
+
+from .models import db, clean_sampatti_id, User, AttendanceLog, SalaryLog
+from .bulk_salary import parse_amount, _parse_date
+from .commands import rebuild_salary_summaries
+from .log import get_logger
+
+log = get_logger(__name__)
+
+ROLES = ('worker', 'employer')
+LOG_TYPES = {'checkin': 'checkin', 'check-in': 'checkin', 'in': 'checkin',
+             'checkout': 'checkout', 'check-out': 'checkout', 'out': 'checkout'}
+# Alternative column names, after lower-casing and replacing spaces with underscores
+FIELD_ALIASES = {
+    'sampatti_id': 'sampatti_card_id', 'card_id': 'sampatti_card_id',
+    'phone': 'whatsapp_number', 'whatsapp': 'whatsapp_number', 'language': 'language_preference',
+    'type': 'log_type', 'date': 'payment_date', 'employer_id': 'employer_sampatti_id',
+    'worker_id': 'worker_sampatti_id', 'note': 'notes',
+}
+MAX_REPORTED_ERRORS = 20 # Rejected rows echoed to the terminal; --rejects gets all of them
+
+
+class ImportStats:
+    """Running totals for one import, reported after every chunk."""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.read = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.recased = 0 # Existing sampatti_card_ids whose letter case the import changed
+        self.rejected = 0
+        self.chunks = 0
+        self.summaries = 0 # Salary summaries rebuilt after a salary import
+        self.started = time.perf_counter()
+
+    def rate(self):
+        return self.read / max(time.perf_counter() - self.started, 1e-9)
+
+    def describe(self):
+        parts = [f"{self.inserted:,} inserted"]
+        if self.kind == 'users':
+            parts += [f"{self.updated:,} updated", f"{self.unchanged:,} unchanged"]
+            if self.recased:
+                parts.append(f"{self.recased:,} card IDs re-cased")
+        parts.append(f"{self.rejected:,} rejected")
+        return f"{self.kind}: {self.read:,} rows read ({', '.join(parts)}) at {self.rate():,.0f} rows/s"
+
+
+# --- Reading ---
+
+def _clean(value):
+    if value is None:
+        return ''
+    return str(value).strip()
+
+
+def _field_name(name):
+    name = _clean(name).lower().replace(' ', '_')
+    return FIELD_ALIASES.get(name, name)
+
+
+def _open_text(path):
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig', newline='')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8-sig', newline='')
+    return open(path, encoding='utf-8-sig', newline='')
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'jsonl' if name.endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def read_records(path, input_format=None):
+    """Yields (line number, record dict, error) for each input row; record is None when error is set."""
+    input_format = input_format or detect_format(path)
+    with _open_text(path) as f:
+        if input_format == 'jsonl':
+            for number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    yield number, None, f"invalid JSON ({e})"
+                    continue
+                if not isinstance(record, dict):
+                    yield number, None, "expected a JSON object"
+                    continue
+                yield number, {_field_name(k): v for k, v in record.items()}, None
+        else:
+            reader = csv.reader(f)
+            header = [_field_name(name) for name in next(reader, [])]
+            for cells in reader:
+                if not any(_clean(cell) for cell in cells):
+                    continue
+                yield reader.line_num, dict(zip(header, cells)), None
+
+
+def chunked(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# --- Field parsing ---
+
+def normalize_whatsapp_number(value):
+    """'+91 98765 43210' -> 'whatsapp:+919876543210' (the form Twilio sends as From)."""
+    number = _clean(value)
+    if number.lower().startswith('whatsapp:'):
+        number = number[len('whatsapp:'):]
+    number = ''.join(ch for ch in number if ch.isdigit() or ch == '+')
+    if len(number.lstrip('+')) < 6:
+        return None
+    return f"whatsapp:{number if number.startswith('+') else '+' + number}"
+
+
+def parse_timestamp(value):
+    """ISO 8601 timestamp as naive UTC (how AttendanceLog stores them), or None."""
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        try:
+            parsed = datetime.fromisoformat(_clean(value))
+        except ValueError:
+            return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _users_by(column, values):
+    """{value: (id, role)} for users whose column is in values; one IN query."""
+    if not values:
+        return {}
+    rows = db.session.execute(db.select(column, User.id, User.role).where(column.in_(values)))
+    return {row[0]: (row[1], row[2]) for row in rows}
+
+
+def _resolve_people(chunk, card_field, number_field):
+    """Returns record -> (user id, role) or None, looking users up by card_field, else number_field.
+    The whole chunk is resolved up front with at most two IN queries."""
+    cards = {clean_sampatti_id(record.get(card_field)) for _, record in chunk} - {''}
+    numbers = {normalize_whatsapp_number(record.get(number_field)) for _, record in chunk} - {None}
+    by_card = _users_by(User.sampatti_card_id, cards)
+    by_number = _users_by(User.whatsapp_number, numbers)
+
+    def resolve(record):
+        card = clean_sampatti_id(record.get(card_field))
+        if card:
+            return by_card.get(card)
+        number = normalize_whatsapp_number(record.get(number_field))
+        return by_number.get(number) if number else None
+    return resolve
+
+
+# --- Writing ---
+
+def _copy_rows(table, columns, rows):
+    """COPY rows (tuples in column order) into table. Returns False if the connection can't COPY."""
+    connection = db.session.connection()
+    if connection.dialect.name != 'postgresql' or not current_app.config.get('IMPORT_USE_COPY', True):
+        return False
+    cursor = connection.connection.cursor() # Raw DBAPI cursor, inside the session's transaction
+    if not hasattr(cursor, 'copy_expert'): # psycopg2 only
+        cursor.close()
+        return False
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['' if value is None else value for value in row]) # Unquoted empty field is NULL
+    buffer.seek(0)
+    try:
+        cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    finally:
+        cursor.close()
+    return True
+
+
+def _append_rows(table, rows):
+    """Inserts a list of dicts with the same keys: COPY where available, otherwise one executemany."""
+    if not rows:
+        return
+    columns = list(rows[0])
+    if not _copy_rows(table, columns, [tuple(row[c] for c in columns) for row in rows]):
+        db.session.execute(table.insert(), rows)
+
+
+# --- Loaders: one chunk of (line, record) in, rows written, (line, error) for each rejected row out ---
+
+def load_users(chunk, stats, context):
+    """Upserts users, matching existing rows on whatsapp_number or sampatti_card_id."""
+    errors = []
+    pending = {} # whatsapp_number -> row; the last row for a number wins
+    for line, record in chunk:
+        number = normalize_whatsapp_number(record.get('whatsapp_number'))
+        card = clean_sampatti_id(record.get('sampatti_card_id')) or None
+        role = _clean(record.get('role')).lower() or None
+        language = _clean(record.get('language_preference')).lower() or None
+        if not number:
+            errors.append((line, f"invalid whatsapp_number '{_clean(record.get('whatsapp_number'))}'"))
+        elif role and role not in ROLES:
+            errors.append((line, f"invalid role '{role}' (use worker or employer)"))
+        elif card and len(card) > User.sampatti_card_id.type.length:
+            errors.append((line, f"sampatti_card_id '{card}' is too long"))
+        elif language and len(language) > User.language_preference.type.length:
+            errors.append((line, f"invalid language_preference '{language}'"))
+        else:
+            pending[number] = (line, number, card, role, language)
+
+    # Cards are matched ignoring case, so 'abc123' in the file can't link a second user to an
+    # existing 'ABC123'; the case the file gives is stored, and counted in stats.recased if it differs
+    cards = {row[2].lower() for row in pending.values() if row[2]}
+    existing = db.session.execute(
+        db.select(User.id, User.whatsapp_number, User.sampatti_card_id, User.role, User.language_preference)
+          .where(or_(User.whatsapp_number.in_(list(pending)), func.lower(User.sampatti_card_id).in_(cards)))
+    ).all() if pending else []
+    by_number = {user.whatsapp_number: user for user in existing}
+    by_card = {user.sampatti_card_id.lower(): user for user in existing if user.sampatti_card_id}
+
+    inserts, updates, claimed = [], [], {}
+    for line, number, card, role, language in pending.values():
+        if card and claimed.setdefault(card.lower(), number) != number:
+            errors.append((line, f"sampatti_card_id {card} is also given for {claimed[card.lower()]} in this file"))
+            continue
+        user = by_number.get(number)
+        card_owner = by_card.get(card.lower()) if card else None
+        if user is not None and card_owner is not None and card_owner.id != user.id:
+            errors.append((line, f"sampatti_card_id {card} belongs to another user ({card_owner.whatsapp_number})"))
+            continue
+        user = user or card_owner
+        if user is None:
+            inserts.append({'whatsapp_number': number, 'sampatti_card_id': card, 'role': role, 'language_preference': language or 'en'})
+            continue
+        values = {
+            'user_id': user.id, 'whatsapp_number': number, 'sampatti_card_id': card or user.sampatti_card_id,
+            'role': role or user.role, 'language_preference': language or user.language_preference,
+        }
+        if (values['whatsapp_number'], values['sampatti_card_id'], values['role'], values['language_preference']) == tuple(user[1:]):
+            stats.unchanged += 1
+            continue
+        if card and user.sampatti_card_id and card != user.sampatti_card_id and card.lower() == user.sampatti_card_id.lower():
+            stats.recased += 1
+        updates.append(values)
+
+    users = User.__table__
+    if updates:
+        db.session.execute(
+            users.update().where(users.c.id == bindparam('user_id')).values(
+                whatsapp_number=bindparam('whatsapp_number'), sampatti_card_id=bindparam('sampatti_card_id'),
+                role=bindparam('role'), language_preference=bindparam('language_preference'),
+            ),
+            updates,
+        )
+    if inserts:
+        db.session.execute(users.insert(), inserts) # Unique constraints make COPY unsuitable for upserts
+    stats.inserted += len(inserts)
+    stats.updated += len(updates)
+    return errors
+
+
+def load_attendance(chunk, stats, context):
+    """Appends checkin/checkout events; the user is given by sampatti_card_id or whatsapp_number."""
+    errors, rows = [], []
+    resolve = _resolve_people(chunk, 'sampatti_card_id', 'whatsapp_number')
+    for line, record in chunk:
+        user = resolve(record)
+        log_type = LOG_TYPES.get(_clean(record.get('log_type')).lower())
+        timestamp = parse_timestamp(record.get('timestamp'))
+        if user is None:
+            errors.append((line, "no user found for this sampatti_card_id/whatsapp_number"))
+        elif log_type is None:
+            errors.append((line, f"invalid log_type '{_clean(record.get('log_type'))}' (use checkin or checkout)"))
+        elif timestamp is None:
+            errors.append((line, f"invalid timestamp '{_clean(record.get('timestamp'))}' (use ISO 8601, e.g. 2025-05-01T09:00:00+05:30)"))
+        else:
+            rows.append({'user_id': user[0], 'log_type': log_type, 'timestamp': timestamp})
+    _append_rows(AttendanceLog.__table__, rows)
+    stats.inserted += len(rows)
+    return errors
+
+
+def load_salary(chunk, stats, context):
+    """Appends past payments (employer_sampatti_id, worker_sampatti_id, amount, payment_date, notes)."""
+    errors, rows = [], []
+    employers = _resolve_people(chunk, 'employer_sampatti_id', 'employer_whatsapp_number')
+    workers = _resolve_people(chunk, 'worker_sampatti_id', 'worker_whatsapp_number')
+    for line, record in chunk:
+        employer, worker = employers(record), workers(record)
+        amount = parse_amount(record.get('amount'))
+        payment_date = _parse_date(record.get('payment_date')) if _clean(record.get('payment_date')) else None
+        if employer is None or employer[1] != 'employer':
+            errors.append((line, "no employer found for this employer_sampatti_id/employer_whatsapp_number"))
+        elif worker is None or worker[1] != 'worker':
+            errors.append((line, "no worker found for this worker_sampatti_id/worker_whatsapp_number"))
+        elif amount is None:
+            errors.append((line, f"invalid amount '{_clean(record.get('amount'))}'"))
+        elif payment_date is None:
+            errors.append((line, f"invalid payment_date '{_clean(record.get('payment_date'))}' (use YYYY-MM-DD)"))
+        else:
+            rows.append({
+                'employer_user_id': employer[0], 'worker_user_id': worker[0], 'amount': amount,
+                'payment_date': payment_date, 'notes': _clean(record.get('notes')) or None,
+                'logged_at': context['logged_at'], # Identifies this import's rows for the summary rebuild
+            })
+    _append_rows(SalaryLog.__table__, rows)
+    stats.inserted += len(rows)
+    return errors
+
+
+def rebuild_imported_summaries(logged_at, batch_size):
+    """Rebuilds the salary summary of every worker paid in an import, committing every batch_size workers."""
+    rebuilt, last_id = 0, 0
+    while True:
+        worker_ids = db.session.scalars(
+            db.select(SalaryLog.worker_user_id).distinct()
+              .where(SalaryLog.logged_at == logged_at, SalaryLog.worker_user_id > last_id)
+              .order_by(SalaryLog.worker_user_id).limit(batch_size)
+        ).all()
+        if not worker_ids:
+            return rebuilt
+        rebuild_salary_summaries(worker_ids)
+        db.session.commit()
+        rebuilt += len(worker_ids)
+        last_id = worker_ids[-1]
+
+
+# --- Driver ---
+
+def _load_chunk(loader, chunk, stats, context, dry_run):
+    """Writes one chunk in its own transaction. If the database rejects it, retries row by row."""
+    counts = (stats.inserted, stats.updated, stats.unchanged)
+    try:
+        errors = loader(chunk, stats, context)
+        if dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+        return errors
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        stats.inserted, stats.updated, stats.unchanged = counts
+        if len(chunk) == 1:
+            return [(chunk[0][0], f"database error: {getattr(e, 'orig', e)}".splitlines()[0])]
+        log.warning("Import chunk of %d rows failed (%s); retrying row by row.", len(chunk), type(e).__name__)
+    errors = []
+    for record in chunk:
+        errors.extend(_load_chunk(loader, [record], stats, context, dry_run))
+    return errors
+
+
+def run_import(kind, records, chunk_size, dry_run=False, on_chunk=None, on_error=None):
+    """Imports (line, record, error) tuples in chunks. Returns the ImportStats."""
+    loader = LOADERS[kind]
+    stats = ImportStats(kind)
+    context = {'logged_at': datetime.utcnow().replace(microsecond=0)}
+    for chunk in chunked(records, chunk_size):
+        stats.read += len(chunk)
+        errors = [(line, error) for line, _, error in chunk if error]
+        valid = [(line, record) for line, record, error in chunk if not error]
+        if valid:
+            errors += _load_chunk(loader, valid, stats, context, dry_run)
+        stats.rejected += len(errors)
+        stats.chunks += 1
+        if on_error:
+            for line, error in sorted(errors):
+                on_error(line, error)
+        if on_chunk:
+            on_chunk(stats)
+    if kind == 'salary' and stats.inserted and not dry_run:
+        stats.summaries = rebuild_imported_summaries(context['logged_at'], chunk_size)
+    return stats
+
+
+LOADERS = {'users': load_users, 'attendance': load_attendance, 'salary': load_salary}
+
+
+# --- CLI ---
+
+import_cli = AppGroup('import', help="Bulk-load users, attendance and salary history from CSV or JSON Lines files.")
+
+
+def _import_command(kind, columns):
+    @import_cli.command(kind, help=f"Import {kind} from FILE (CSV with a header row, or .jsonl; .gz and '-' for stdin work too).\n\nColumns: {columns}")
+    @click.argument('path', metavar='FILE')
+    @click.option('--format', 'input_format', type=click.Choice(['csv', 'jsonl']), help='Input format (default: from the file extension).')
+    @click.option('--chunk-size', type=click.IntRange(min=1), help='Records per transaction (default: IMPORT_CHUNK_SIZE).')
+    @click.option('--rejects', type=click.Path(dir_okay=False, writable=True), help='Write rejected rows (line, error) to this CSV file.')
+    @click.option('--dry-run', is_flag=True, help='Validate and write every chunk, then roll it back.')
+    def command(path, input_format, chunk_size, rejects, dry_run):
+        chunk_size = chunk_size or current_app.config.get('IMPORT_CHUNK_SIZE', 5000)
+        reported = 0
+        rejects_file = open(rejects, 'w', newline='') if rejects else None
+        rejects_writer = csv.writer(rejects_file) if rejects_file else None
+        if rejects_writer:
+            rejects_writer.writerow(['line', 'error'])
+
+        def on_error(line, error):
+            nonlocal reported
+            if rejects_writer:
+                rejects_writer.writerow([line, error])
+            if reported < MAX_REPORTED_ERRORS:
+                click.echo(f"  line {line}: {error}", err=True)
+            reported += 1
+
+        def on_chunk(stats):
+            click.echo(stats.describe(), err=True)
+
+        click.echo(f"Importing {kind} from {path} in chunks of {chunk_size}{' (dry run)' if dry_run else ''}...", err=True)
+        try:
+            stats = run_import(kind, read_records(path, input_format), chunk_size, dry_run, on_chunk, on_error)
+        except (OSError, UnicodeDecodeError, csv.Error) as e:
+            raise click.ClickException(f"Could not read {path}: {e}")
+        finally:
+            if rejects_file:
+                rejects_file.close()
+        if reported > MAX_REPORTED_ERRORS:
+            click.echo(f"  ...and {reported - MAX_REPORTED_ERRORS:,} more rejected rows{f' (see {rejects})' if rejects else ''}.", err=True)
+        click.echo(f"Done in {time.perf_counter() - stats.started:.1f}s. {stats.describe()}"
+                   + (f"; rebuilt {stats.summaries:,} salary summaries" if stats.summaries else '')
+                   + (". Nothing was saved (dry run)." if dry_run else '.'))
+    return command
+
+
+_import_command('users', "whatsapp_number (required), sampatti_card_id, role (worker/employer), language_preference.")
+_import_command('attendance', "sampatti_card_id or whatsapp_number, log_type (checkin/checkout), timestamp (ISO 8601; UTC unless it has an offset).")
+_import_command('salary', "employer_sampatti_id, worker_sampatti_id, amount, payment_date (YYYY-MM-DD), notes. "
+                          "employer_whatsapp_number / worker_whatsapp_number may be used instead of the Sampatti IDs.")
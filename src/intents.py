@@ -0,0 +1,265 @@
+# src/intents.py
+# Local rule-based matcher for the fixed command set advertised by get_fallback_message.
+# Literal commands ('checkin', 'salary', 'register ABC12345 worker', ...) are resolved here
+# without a Dialogflow round trip; anything that doesn't match falls through to Dialogflow.
+# Partial commands ('register', 'log salary W0000012') are matched too, and match_slot_answer reads
+# the follow-up answers ('worker', 'Rs 5000') for the slot filling in conversation.py.
+import re
+import unicodedata
+from datetime import date, timedelta
+
+from .models import clean_sampatti_id
+
+# Map Devanagari (and other Unicode) digits to ASCII so amounts/dates parse downstream
+_DIGIT_TRANSLATION = {ord(ch): str(unicodedata.digit(ch)) for ch in '०१२३४५६७८९'}
+
+# Characters stripped from the ends of a message before matching ("salary?", "checkin!")
+_TRIM_CHARS = ' \t\r\n.?!,;:।'
+
+# --- Aliases per language ---
+# English aliases are always active (users mix languages); other languages are added
+# on top based on User.language_preference.
+INTENT_ALIASES = {
+    'en': {
+        'CheckIn': [r'check[\s-]?in', r'checking in', r'clock[\s-]?in', r'start work'],
+        'CheckOut': [r'check[\s-]?out', r'checking out', r'clock[\s-]?out', r'end work'],
+        'SalaryInquiry': [r'salary', r'my salary', r'check salary', r'show salary', r'salary status',
+                          r'salary this month', r'total this month', r'salary this year', r'total this year'],
+        'register': [r'register'],
+        'log_salary': [r'log\s+salary', r'add\s+salary', r'record\s+salary'],
+        'HoursInquiry': [r'hours', r'my hours', r'hours worked', r'working hours', r'work hours', r'my attendance'],
+        'RosterSummary': [r'roster', r'my roster', r'team', r'my team', r'team hours', r'my workers', r'workers'],
+    },
+    'hi': {
+        'CheckIn': [r'चेक\s?इन', r'हाज़िरी', r'हाजिरी', r'हाजरी', r'काम शुरू', r'hajri', r'haziri'],
+        'CheckOut': [r'चेक\s?आउट', r'छुट्टी', r'काम खत्म', r'काम ख़त्म', r'chutti'],
+        'SalaryInquiry': [r'वेतन', r'मेरा वेतन', r'तनख्वाह', r'तनख़्वाह', r'सैलरी', r'पगार', r'tankhwah', r'pagar',
+                          r'इस महीने का वेतन', r'इस महीने की सैलरी'],
+        'register': [r'रजिस्टर', r'पंजीकरण'],
+        'log_salary': [r'वेतन\s+दर्ज', r'सैलरी\s+दर्ज', r'सैलरी\s+लॉग'],
+        'HoursInquiry': [r'घंटे', r'मेरे घंटे', r'कितने घंटे', r'काम के घंटे', r'ghante'],
+        'RosterSummary': [r'टीम', r'मेरी टीम', r'मेरे कामगार', r'रोस्टर'],
+    },
+}
+
+# Optional period for hours/roster, before ("इस महीने के घंटे") or after ("hours last month") the command
+PERIOD_ALIASES = {
+    'en': {'this_month': ['this month'], 'last_month': ['last month', 'previous month'], 'today': ['today']},
+    'hi': {'this_month': ['इस महीने'], 'last_month': ['पिछले महीने'], 'today': ['आज']},
+}
+
+# Words ignored in a follow-up answer ("my id is ABC12345", "Rs 5000", "मेरा आईडी ABC12345 है")
+FILLER_WORDS = {
+    'en': {'my', 'id', 'is', 'its', "it's", 'the', 'a', 'an', 'as', 'i', 'am', "i'm", 'im', 'sampatti', 'card',
+           'number', 'no', 'amount', 'of', 'rs', 'inr', 'rupees', 'rupee', 'role', 'paid', 'for', 'on', 'date', 'ok', 'okay'},
+    'hi': {'मेरा', 'मेरी', 'मेरे', 'है', 'हूँ', 'हूं', 'मैं', 'आईडी', 'नंबर', 'रुपये', 'रुपए', 'रु', 'राशि', 'का', 'की', 'के', 'को', 'तारीख'},
+}
+CANCEL_ALIASES = {
+    'en': ['cancel', 'stop', 'never mind', 'nevermind', 'forget it'],
+    'hi': ['रद्द', 'रद्द करो', 'रहने दो', 'छोड़ो'],
+}
+DATE_ALIASES = {
+    'en': {'today': 0, 'yesterday': 1},
+    'hi': {'आज': 0},
+}
+
+ROLE_ALIASES = {
+    'en': {'worker': ['worker'], 'employer': ['employer']},
+    'hi': {
+        'worker': ['कामगार', 'मजदूर', 'मज़दूर', 'कर्मचारी', 'वर्कर'],
+        'employer': ['मालिक', 'नियोक्ता', 'एम्प्लॉयर'],
+    },
+}
+
+_ID = r'(?P<sampatti_id>[A-Za-z0-9-]+)'
+_AMOUNT = r'(?P<amount>\d[\d,]*(?:\.\d{1,2})?)'
+_DATE = r'(?P<date>\d{4}-\d{2}-\d{2})'
+_NUMBER = r'\d[\d,]*(?:\.\d{1,2})?'
+
+# Word boundaries for keyword search; \\b misses Devanagari vowel signs, so use whitespace/punctuation
+_BOUNDARY_BEFORE = r'(?:^|(?<=[\s.?!,;:।"\'(]))'
+_BOUNDARY_AFTER = r'(?=$|[\s.?!,;:।"\')])'
+
+_compiled_cache = {}
+
+
+def _alternation(patterns):
+    # Longest first, so an unanchored search takes 'team hours' over 'team'
+    return '(?:' + '|'.join(sorted(patterns, key=len, reverse=True)) + ')'
+
+
+def _languages(language_code):
+    """English aliases plus those of the user's language."""
+    lang = (language_code or 'en').split('-')[0].lower()
+    return ['en'] if lang == 'en' else ['en', lang]
+
+
+def _compile_for_language(language_code):
+    """Builds (and memoizes) the compiled pattern table for a language."""
+    lang = (language_code or 'en').split('-')[0].lower()
+    if lang in _compiled_cache:
+        return _compiled_cache[lang]
+
+    languages = _languages(lang)
+    aliases = {}
+    role_lookup = {}
+    period_lookup = {}
+    for code in languages:
+        for key, patterns in INTENT_ALIASES.get(code, {}).items():
+            aliases.setdefault(key, []).extend(patterns)
+        for role, words in ROLE_ALIASES.get(code, {}).items():
+            for word in words:
+                role_lookup[word.lower()] = role
+        for period, words in PERIOD_ALIASES.get(code, {}).items():
+            for word in words:
+                period_lookup[word.lower()] = period
+
+    role_pattern = '(?P<role>' + '|'.join(re.escape(w) for w in sorted(role_lookup, key=len, reverse=True)) + ')'
+    periods = '|'.join(re.escape(w) for w in sorted(period_lookup, key=len, reverse=True))
+    flags = re.IGNORECASE | re.UNICODE
+    table = [
+        ('RegisterUser', re.compile(rf'^{_alternation(aliases["register"])}\s+(?!as\s){_ID}\s+{role_pattern}$', flags)),
+        ('LogSalary', re.compile(rf'^{_alternation(aliases["log_salary"])}\s+{_ID}\s+{_AMOUNT}(?:\s+{_DATE})?$', flags)),
+        # Incomplete forms; the rest is asked for by slot filling (conversation.py)
+        ('RegisterUser', re.compile(rf'^{_alternation(aliases["register"])}(?:\s+(?:as\s+)?{role_pattern})?$', flags)),
+        ('RegisterUser', re.compile(rf'^{_alternation(aliases["register"])}\s+{_ID}$', flags)),
+        ('LogSalary', re.compile(rf'^{_alternation(aliases["log_salary"])}(?:\s+(?!{_NUMBER}$){_ID})?$', flags)),
+        ('CheckIn', re.compile(rf'^{_alternation(aliases["CheckIn"])}$', flags)),
+        ('CheckOut', re.compile(rf'^{_alternation(aliases["CheckOut"])}$', flags)),
+        ('SalaryInquiry', re.compile(rf'^{_alternation(aliases["SalaryInquiry"])}$', flags)),
+    ]
+    for intent in ('HoursInquiry', 'RosterSummary'):
+        table.append((intent, re.compile(
+            rf'^(?:(?P<period_before>{periods})\s+(?:(?:के|की|का)\s+)?)?{_alternation(aliases[intent])}(?:\s+(?P<period>{periods}))?$', flags
+        )))
+    # Bulk salary: 'log salary' followed by one payment per line (or entries separated by ';')
+    bulk_salary = re.compile(rf'^\s*{_alternation(aliases["log_salary"])}(?=\s|;|$)', flags)
+    # Degraded mode: the same commands found anywhere in a sentence ("please check in for me")
+    keywords = [(intent, re.compile(_BOUNDARY_BEFORE + pattern.pattern.strip('^$') + _BOUNDARY_AFTER, flags))
+                for intent, pattern in table]
+    _compiled_cache[lang] = (table, role_lookup, period_lookup, bulk_salary, keywords)
+    return _compiled_cache[lang]
+
+
+def normalize_text(text):
+    """Collapses whitespace and trims surrounding punctuation; keeps case for IDs."""
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFC', text)
+    return ' '.join(text.split()).strip(_TRIM_CHARS)
+
+
+def match_local_intent(text, language_code='en'):
+    """
+    Matches a message against the local command patterns.
+    Returns (intent, parameters, fulfillment) in the same shape as detect_intent_text,
+    or (None, None, None) when nothing matches and Dialogflow should be asked.
+    """
+    message = normalize_text(text)
+    if not message:
+        return None, None, None
+
+    table, role_lookup, period_lookup, bulk_salary, _ = _compile_for_language(language_code)
+    bulk = bulk_salary.match(text)
+    if bulk and ('\n' in text[bulk.end():].strip() or ';' in text[bulk.end():]):
+        return 'BulkLogSalary', {'entries': text[bulk.end():].translate(_DIGIT_TRANSLATION)}, None
+    for intent, pattern in table:
+        match = pattern.match(message)
+        if match:
+            return intent, _parameters(match, role_lookup, period_lookup), None
+
+    return None, None, None
+
+
+def _parameters(match, role_lookup, period_lookup):
+    groups = {k: v for k, v in match.groupdict().items() if v is not None}
+    parameters = {}
+    if 'sampatti_id' in groups:
+        parameters['sampatti_id'] = clean_sampatti_id(groups['sampatti_id'])
+    if 'role' in groups:
+        parameters['role'] = role_lookup.get(groups['role'].lower(), groups['role'].lower())
+    if 'amount' in groups:
+        parameters['amount'] = groups['amount'].translate(_DIGIT_TRANSLATION).replace(',', '')
+    if 'date' in groups:
+        parameters['date'] = groups['date'].translate(_DIGIT_TRANSLATION)
+    period = groups.get('period') or groups.get('period_before')
+    if period:
+        parameters['period'] = period_lookup.get(period.lower())
+    return parameters
+
+
+def match_degraded_intent(text, language_code='en'):
+    """
+    Looser matcher used while Dialogflow is unavailable (circuit open or out of time budget):
+    finds a command anywhere in the message ("I want to check in now", "मुझे सैलरी बताओ").
+    A command inside a longer one ('hours' in 'team hours') is ignored; two different commands
+    ("check in and check out") are ambiguous and return (None, None, None).
+    """
+    intent, parameters, reply = match_local_intent(text, language_code)
+    if intent:
+        return intent, parameters, reply
+    message = normalize_text(text)
+    if not message:
+        return None, None, None
+
+    _, role_lookup, period_lookup, _, keywords = _compile_for_language(language_code)
+    found = []
+    for intent, pattern in keywords:
+        match = pattern.search(message)
+        if match:
+            found.append((intent, match))
+    found = [
+        (intent, match) for intent, match in found
+        if not any(other is not match and other.start() <= match.start() and match.end() <= other.end()
+                   and other.end() - other.start() > match.end() - match.start() for _, other in found)
+    ]
+    if len({intent for intent, _ in found}) != 1:
+        return None, None, None
+    intent, match = found[0]
+    return intent, _parameters(match, role_lookup, period_lookup), None
+
+
+def is_cancel(text, language_code='en'):
+    """True if the message asks to drop the command being filled in ('cancel', 'रहने दो')."""
+    message = normalize_text(text).casefold()
+    return message in {word for code in _languages(language_code) for word in CANCEL_ALIASES.get(code, ())}
+
+
+def match_slot_answer(text, slots, language_code='en'):
+    """
+    Reads a follow-up answer for the parameters in `slots` ('sampatti_id', 'role', 'amount', 'date').
+    Every word must be a value for one of them or a filler word, and each slot takes one value,
+    so only messages that really are an answer match. Returns {slot: value}, or None.
+    """
+    message = normalize_text(text).translate(_DIGIT_TRANSLATION)
+    if not message:
+        return None
+    _, role_lookup, _, _, _ = _compile_for_language(language_code)
+    languages = _languages(language_code)
+    fillers = {word for code in languages for word in FILLER_WORDS.get(code, ())}
+    date_words = {word: days for code in languages for word, days in DATE_ALIASES.get(code, {}).items()}
+    values = {}
+    for word in message.split():
+        word = word.strip(_TRIM_CHARS + '₹')
+        if word.lower().startswith('rs.'):
+            word = word[3:]
+        lowered = word.lower()
+        if not word or lowered in fillers:
+            continue
+        if lowered in role_lookup:
+            if 'role' not in slots:
+                continue # 'worker W12' while logging salary
+            slot, value = 'role', role_lookup[lowered]
+        elif re.fullmatch(r'\d{4}-\d{2}-\d{2}', word) or lowered in date_words:
+            slot = 'date'
+            value = word if lowered not in date_words else (date.today() - timedelta(days=date_words[lowered])).isoformat()
+        elif re.fullmatch(_NUMBER, word) and 'amount' in slots:
+            slot, value = 'amount', word.replace(',', '')
+        elif re.fullmatch(r'[A-Za-z0-9-]*\d[A-Za-z0-9-]*', word):
+            slot, value = 'sampatti_id', clean_sampatti_id(word) # IDs always contain a digit, so command words never match
+        else:
+            return None
+        if slot not in slots or slot in values:
+            return None
+        values[slot] = value
+    return values or None
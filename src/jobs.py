@@ -0,0 +1,279 @@
+# src/jobs.py
+# Background processing for slow media messages (voice notes, KYC files).
+# In async mode the webhook enqueues a job and returns empty TwiML straight away; a bounded
+# pool of worker threads runs the job inside an app context and replies via the Twilio REST API.
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+from flask import current_app
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+
+# --- Queue Backends ---
+
+class InMemoryJobQueue:
+    """Bounded in-process FIFO. Jobs are lost on restart; fine for local testing."""
+
+    blocking = False
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._queue = queue.Queue(maxsize=maxsize)
+
+    def put(self, job):
+        try:
+            self._queue.put_nowait(job)
+            return True
+        except queue.Full:
+            return False
+
+    def get(self, timeout=1.0):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def retry(self, job, delay):
+        # Re-queue after the backoff delay without holding a worker thread
+        def requeue():
+            if not self.put(job):
+                log.error("Dropped job %s on retry, queue full.", job['id'])
+        timer = threading.Timer(delay, requeue)
+        timer.daemon = True
+        timer.start()
+
+    def done(self, job):
+        pass
+
+    def failed(self, job):
+        pass
+
+    def depth(self):
+        return self._queue.qsize()
+
+
+class SQLiteJobQueue:
+    """Bounded queue persisted in a local SQLite file; survives restarts and is shared by worker processes."""
+
+    blocking = True # put() is an INSERT and commit
+
+    def __init__(self, path, maxsize=100, stale_after=300):
+        self.path = path
+        self.maxsize = maxsize
+        self.stale_after = stale_after # Re-queue 'running' jobs whose worker died
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and getattr(self._local, 'pid', None) == os.getpid():
+            return conn
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' id TEXT PRIMARY KEY, payload TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,'
+            " status TEXT NOT NULL DEFAULT 'queued', available_at REAL NOT NULL, locked_at REAL)"
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_jobs_status_available ON jobs (status, available_at)')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def put(self, job):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            depth = conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+            if depth >= self.maxsize:
+                conn.execute('ROLLBACK')
+                return False
+            conn.execute(
+                'INSERT INTO jobs (id, payload, attempts, available_at) VALUES (?, ?, ?, ?)',
+                (job['id'], json.dumps(job['payload']), job['attempts'], time.time())
+            )
+            conn.execute('COMMIT')
+            return True
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+
+    def get(self, timeout=1.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self._claim()
+            if job is not None or time.monotonic() >= deadline:
+                return job
+            time.sleep(min(0.2, timeout))
+
+    def _claim(self):
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued' WHERE status = 'running' AND locked_at < ?",
+                (now - self.stale_after,)
+            )
+            row = conn.execute(
+                "SELECT id, payload, attempts FROM jobs WHERE status = 'queued' AND available_at <= ?"
+                ' ORDER BY available_at LIMIT 1', (now,)
+            ).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', locked_at = ? WHERE id = ?", (now, row[0]))
+            conn.execute('COMMIT')
+            return {'id': row[0], 'payload': json.loads(row[1]), 'attempts': row[2]}
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+
+    def retry(self, job, delay):
+        self._conn().execute(
+            "UPDATE jobs SET status = 'queued', payload = ?, attempts = ?, available_at = ?, locked_at = NULL WHERE id = ?",
+            (json.dumps(job['payload']), job['attempts'], time.time() + delay, job['id'])
+        )
+
+    def done(self, job):
+        self._conn().execute('DELETE FROM jobs WHERE id = ?', (job['id'],))
+
+    def failed(self, job):
+        self._conn().execute(
+            "UPDATE jobs SET status = 'failed', payload = ?, attempts = ? WHERE id = ?",
+            (json.dumps(job['payload']), job['attempts'], job['id'])
+        )
+
+    def depth(self):
+        return self._conn().execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+
+# --- Worker Pool ---
+
+class JobWorkerPool:
+    """Runs queued jobs on a fixed number of daemon threads, with retries and exponential backoff."""
+
+    def __init__(self, app, backend, handler, workers=4, max_attempts=3, retry_backoff=2.0):
+        self.app = app
+        self.backend = backend
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.max_attempts = max(1, max_attempts)
+        self.retry_backoff = retry_backoff
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def enqueue(self, payload):
+        """Queues a job; returns False if the queue is full (caller should shed the message)."""
+        self._ensure_started()
+        job = {'id': uuid.uuid4().hex, 'payload': payload, 'attempts': 0}
+        return self.backend.put(job)
+
+    def _ensure_started(self):
+        # Threads don't survive fork(), so start them lazily in the process that serves requests
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stop.clear()
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"media-job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+            log.info("Started %s media job workers in process %s", self.workers, self._pid)
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            job = self.backend.get(timeout=1.0)
+            if job is None:
+                continue
+            job['attempts'] += 1
+            try:
+                with self.app.app_context():
+                    self.handler(job['payload'])
+                self.backend.done(job)
+            except Exception as e:
+                if job['attempts'] < self.max_attempts:
+                    delay = self.retry_backoff * (2 ** (job['attempts'] - 1))
+                    log.warning("Job %s failed (attempt %s), retrying in %.1fs: %s", job['id'], job['attempts'], delay, e)
+                    self.backend.retry(job, delay)
+                else:
+                    log.error("Job %s failed after %s attempts, giving up: %s", job['id'], job['attempts'], e)
+                    self.backend.failed(job)
+
+    def stats(self):
+        return {'depth': self.backend.depth(), 'maxsize': self.backend.maxsize, 'workers': self.workers}
+
+
+def init_job_queue(app, handler):
+    """Sets up the media job queue when ASYNC_MEDIA_PROCESSING is enabled."""
+    if not app.config.get('ASYNC_MEDIA_PROCESSING'):
+        return None
+    maxsize = app.config.get('JOB_QUEUE_MAXSIZE', 100)
+    if app.config.get('JOB_QUEUE_BACKEND', 'memory') == 'sqlite':
+        backend = SQLiteJobQueue(app.config.get('JOB_QUEUE_PATH', '/tmp/lighthouse_jobs.sqlite3'), maxsize=maxsize)
+    else:
+        backend = InMemoryJobQueue(maxsize=maxsize)
+    pool = JobWorkerPool(
+        app, backend, handler,
+        workers=app.config.get('JOB_WORKERS', 4),
+        max_attempts=app.config.get('JOB_MAX_ATTEMPTS', 3),
+        retry_backoff=app.config.get('JOB_RETRY_BACKOFF', 2.0),
+    )
+    app.extensions['job_queue'] = pool
+    log.info("Async media processing enabled (%s, max %s queued jobs)", type(backend).__name__, maxsize)
+    return pool
+
+
+def get_job_queue():
+    """Returns the app's media job pool, or None when async mode is off."""
+    return current_app.extensions.get('job_queue')
+
+
+# --- Outbound Replies ---
+
+_twilio_client = None
+_twilio_client_pid = None
+_twilio_client_lock = threading.Lock()
+
+
+def _get_twilio_client():
+    global _twilio_client, _twilio_client_pid
+    if _twilio_client is not None and _twilio_client_pid == os.getpid():
+        return _twilio_client
+    with _twilio_client_lock:
+        if _twilio_client is None or _twilio_client_pid != os.getpid():
+            from twilio.rest import Client
+            _twilio_client = Client(current_app.config['TWILIO_ACCOUNT_SID'], current_app.config['TWILIO_AUTH_TOKEN'])
+            _twilio_client_pid = os.getpid()
+        return _twilio_client
+
+
+def send_whatsapp_message(to_number, body):
+    """Sends a WhatsApp message through the Twilio REST API (raises on failure so the job is retried)."""
+    from_number = current_app.config.get('TWILIO_WHATSAPP_NUMBER')
+    if not from_number:
+        raise RuntimeError("TWILIO_WHATSAPP_NUMBER is not configured; cannot send async reply.")
+    if not from_number.startswith('whatsapp:'):
+        from_number = f"whatsapp:{from_number}"
+    message = _get_twilio_client().messages.create(from_=from_number, to=to_number, body=body)
+    log.debug("Sent async reply to %s (SID: %s)", to_number, message.sid)
+    return message.sid
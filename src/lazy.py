@@ -0,0 +1,98 @@
+# src/lazy.py
+# Deferred imports for the heavy SDKs, so a cold container can serve its first request sooner.
+# google.cloud.dialogflow pulls in protobuf, grpc and google-auth (about 0.6s, most of the app's
+# import time) and requests adds another 60ms that text messages never need; modules using them
+# hold a LazyModule and the import happens on first attribute access. init_preload(app) then
+# warms the SDKs up according to SDK_PRELOAD:
+# - 'background' (default): a daemon thread imports them (and creates the Dialogflow client if
+#   DIALOGFLOW_WARM_UP is on) right after create_app returns, while the server starts listening;
+# - 'eager': the same work before create_app returns (the old start-up behaviour);
+# - 'off': whichever message needs an SDK first pays for its import.
+import importlib
+import os
+import threading
+import time
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+# Imported by the preload, in this order
+PRELOAD_MODULES = ('requests', 'google.api_core.exceptions', 'google.cloud.dialogflow')
+
+
+class LazyModule:
+    """Stands in for a module and imports it on first attribute access."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<LazyModule {self._name!r} ({state})>"
+
+
+# A fork (gunicorn --preload forks workers right after create_app) while the preload thread holds an
+# import lock would leave that lock held forever in the child, so forks wait for the preload to finish
+_preload_lock = threading.Lock()
+_preload_stats = {'mode': 'off', 'state': 'idle', 'seconds': None}
+
+
+def preload(warm_up_client=False):
+    """Imports PRELOAD_MODULES (and creates the Dialogflow client if asked). Returns the seconds taken."""
+    started = time.perf_counter()
+    with _preload_lock:
+        _preload_stats['state'] = 'running'
+        try:
+            for name in PRELOAD_MODULES:
+                importlib.import_module(name)
+            if warm_up_client:
+                from .nlp import warm_up_client as warm_up
+                warm_up()
+            _preload_stats['state'] = 'done'
+        except Exception as e: # Missing or broken SDK: the first message will report it
+            _preload_stats['state'] = 'failed'
+            log.warning("SDK preload failed (modules load on first use instead): %s", e)
+        finally:
+            _preload_stats['seconds'] = round(time.perf_counter() - started, 3)
+    log.info("SDK preload %s in %.2fs.", _preload_stats['state'], _preload_stats['seconds'])
+    return _preload_stats['seconds']
+
+
+def get_preload_stats():
+    return dict(_preload_stats)
+
+
+def _reinit_lock_after_fork():
+    global _preload_lock
+    _preload_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(
+        before=lambda: _preload_lock.acquire(), after_in_parent=lambda: _preload_lock.release(),
+        after_in_child=_reinit_lock_after_fork,
+    )
+
+
+def init_preload(app):
+    """Starts the SDK preload as configured by SDK_PRELOAD ('background', 'eager' or 'off')."""
+    mode = app.config.get('SDK_PRELOAD', 'background')
+    warm_up_client = bool(app.config.get('DIALOGFLOW_WARM_UP'))
+    _preload_stats['mode'] = mode
+    if mode == 'eager':
+        preload(warm_up_client)
+    elif mode == 'background':
+        threading.Thread(target=preload, args=(warm_up_client,), name='lighthouse-preload', daemon=True).start()
+    elif mode != 'off':
+        log.warning("Unknown SDK_PRELOAD '%s'; SDKs will load on first use.", mode)
@@ -0,0 +1,130 @@
+# src/log.py
+# Logging for the request path.
+# - Level gated (LOG_LEVEL); use %-style args so messages are only formatted when emitted.
+# - Every record carries the current message SID and sender (set per request by bind_request).
+# - Records are handed to a QueueHandler and written by a background QueueListener thread,
+#   so request threads never block on stdout.
+# - Debug output can be switched on for one request (X-Debug-Log header matching LOG_DEBUG_TOKEN)
+#   or for specific senders (LOG_DEBUG_SENDERS) without lowering the global level.
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+
+_message_sid = contextvars.ContextVar('message_sid', default='-')
+_sender = contextvars.ContextVar('sender', default='-')
+_debug_override = contextvars.ContextVar('debug_override', default=False)
+
+_listener = None
+_queue_handler = None
+
+
+class RequestLogger(logging.LoggerAdapter):
+    """Logger that also emits records below its level while per-request debugging is on."""
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level) or (_debug_override.get() and level >= logging.DEBUG)
+
+    def log(self, level, msg, *args, **kwargs):
+        if self.isEnabledFor(level):
+            msg, kwargs = self.process(msg, kwargs)
+            kwargs.setdefault('stacklevel', 2)
+            # Bypass the wrapped logger's own level check (already decided above)
+            self.logger._log(level, msg, args, **kwargs)
+
+
+def get_logger(name):
+    return RequestLogger(logging.getLogger(name), {})
+
+
+def bind_request(message_sid=None, sender=None, debug=False):
+    """Sets the correlation fields (and optional debug override) for the current request."""
+    _message_sid.set(message_sid or '-')
+    _sender.set(sender or '-')
+    _debug_override.set(bool(debug))
+
+
+class _ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.message_sid = _message_sid.get()
+        record.sender = _sender.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log aggregation."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'message_sid': getattr(record, 'message_sid', '-'),
+            'sender': getattr(record, 'sender', '-'),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the caller: drops records (and counts them) if the queue is full."""
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
+
+
+def configure_logging(app):
+    """Attaches the queued, structured handler to the 'src' package logger (once per process)."""
+    global _listener, _queue_handler
+    package_logger = logging.getLogger(__package__)
+    package_logger.setLevel(app.config.get('LOG_LEVEL', 'INFO').upper())
+    package_logger.propagate = False
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if app.config.get('LOG_FORMAT', 'text') == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s [%(name)s] [sid=%(message_sid)s from=%(sender)s] %(message)s'
+        ))
+
+    log_queue = queue.Queue(maxsize=app.config.get('LOG_QUEUE_SIZE', 10000))
+    _queue_handler = _DroppingQueueHandler(log_queue)
+    _queue_handler.addFilter(_ContextFilter())
+    package_logger.addHandler(_queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    _listener.start()
+    atexit.register(_listener.stop) # Drain queued records on shutdown
+
+
+def _restart_listener_after_fork():
+    # The writer thread doesn't survive fork() (e.g. gunicorn --preload), and the queue's
+    # condition may still list the parent's waiter, so give the child a fresh queue and thread
+    if _listener is not None:
+        fresh_queue = queue.Queue(maxsize=_listener.queue.maxsize)
+        _queue_handler.queue = fresh_queue
+        _listener.queue = fresh_queue
+        _listener._thread = None
+        _listener.start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_listener_after_fork)
+
+
+def get_log_stats():
+    return {'dropped_records': _DroppingQueueHandler.dropped}
@@ -0,0 +1,251 @@
+# src/metrics.py
+# In-process metrics for the request path, exposed in Prometheus text format on /metrics.
+# - Histograms time each processing stage (user lookup, NLP, command handlers, DB commit,
+#   media download, TwiML rendering) so we can see what is eating the latency budget.
+# - Counters track intents and NLP error classes.
+# - Existing stats() dicts (caches, job queue, write buffer, logging) are exported on each scrape.
+# Values are per worker process; Prometheus sums them across the scraped workers.
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Seconds; covers fast cache hits up to Twilio's 15s webhook timeout
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    labels = list(labels)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        return self._values.get(key, 0)
+
+    def total(self):
+        """Sum over all label values."""
+        with self._lock:
+            return sum(self._values.values())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(zip(self.labelnames, key))} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram (seconds) with optional labels."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {} # label key -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            entry[-2] += value
+            entry[-1] += 1
+
+    def count(self, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        entry = self._values.get(key)
+        return entry[-1] if entry else 0
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, list(entry)) for key, entry in self._values.items())
+        for key, entry in items:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(entry[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {entry[-1]}")
+        return lines
+
+
+# --- Request path metrics ---
+STAGE_SECONDS = Histogram(
+    'lighthouse_stage_seconds', 'Time spent in each webhook processing stage.', ['stage']
+)
+REQUEST_SECONDS = Histogram(
+    'lighthouse_webhook_request_seconds', 'Total time to answer a WhatsApp webhook request.', ['kind']
+)
+INTENTS_TOTAL = Counter(
+    'lighthouse_intents_total', 'Messages routed per intent and where the intent came from.', ['intent', 'source']
+)
+NLP_ERRORS_TOTAL = Counter(
+    'lighthouse_nlp_errors_total', 'Dialogflow text/audio failures by error class.', ['kind', 'error']
+)
+
+
+def stage_timer(stage):
+    """Context manager timing a block as a processing stage."""
+    return STAGE_SECONDS.time(stage=stage)
+
+
+def timed(stage):
+    """Decorator timing every call of a function as a processing stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.time(stage=stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_nlp_error(kind, error):
+    NLP_ERRORS_TOTAL.inc(kind=kind, error=error)
+
+
+# --- DB commit timing (every Session, including the write-behind flusher) ---
+_commit_local = threading.local()
+
+
+@event.listens_for(Session, 'before_commit')
+def _before_commit(session):
+    _commit_local.started = time.perf_counter()
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    started = getattr(_commit_local, 'started', None)
+    if started is not None:
+        _commit_local.started = None
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage='db_commit')
+
+
+# --- Samples from the existing stats() dicts ---
+
+def _component_families(app):
+    """Yields (name, type, help, [(labels, value), ...]) for caches, job queue, write buffer, NLP breaker, SDK preload and logging."""
+    # Imported here: nlp and commands import this module
+    from .nlp import get_text_cache_stats, get_voice_cache_stats, get_nlp_breaker_stats
+    from .breaker import STATE_VALUES
+    from .commands import get_user_cache_stats
+    from .lazy import get_preload_stats
+    from .log import get_log_stats
+
+    caches = [s for s in [get_text_cache_stats(), get_voice_cache_stats()] + get_user_cache_stats() if s]
+    for extension in ('message_dedup', 'conversations'):
+        store = app.extensions.get(extension)
+        if store is not None:
+            caches.append(store.stats())
+    for field, metric_type, documentation in (
+        ('hits', 'counter', 'Cache hits.'), ('misses', 'counter', 'Cache misses.'),
+        ('evictions', 'counter', 'Entries evicted to stay under maxsize.'), ('size', 'gauge', 'Entries currently cached.'),
+    ):
+        name = f"lighthouse_cache_{field}" + ('_total' if metric_type == 'counter' else '')
+        yield name, metric_type, documentation, [({'cache': c['name']}, c[field]) for c in caches]
+
+    job_queue = app.extensions.get('job_queue')
+    if job_queue is not None:
+        stats = job_queue.stats()
+        yield 'lighthouse_job_queue_depth', 'gauge', 'Media jobs waiting for a worker.', [({}, stats['depth'])]
+        yield 'lighthouse_job_queue_maxsize', 'gauge', 'Media job queue capacity.', [({}, stats['maxsize'])]
+
+    buffer = app.extensions.get('attendance_buffer')
+    if buffer is not None:
+        stats = buffer.stats()
+        yield 'lighthouse_attendance_buffer_depth', 'gauge', 'Attendance rows waiting to be flushed.', [({}, stats['depth'])]
+        yield 'lighthouse_attendance_flushes_total', 'counter', 'Attendance batches committed.', [({}, stats['flushes'])]
+        yield 'lighthouse_attendance_rows_written_total', 'counter', 'Attendance rows committed.', [({}, stats['rows_written'])]
+        yield 'lighthouse_attendance_failed_flushes_total', 'counter', 'Attendance batches that failed.', [({}, stats['failed_flushes'])]
+
+    previews = app.extensions.get('kyc_previews')
+    if previews is not None:
+        yield 'lighthouse_kyc_preview_pending', 'gauge', 'KYC files waiting for or being rendered by the preview pool.', [({}, previews.stats()['pending'])]
+
+    shedder = app.extensions.get('load_shedder')
+    if shedder is not None:
+        stats = shedder.stats()
+        yield 'lighthouse_in_flight_requests', 'gauge', 'Webhook requests currently being processed.', [({}, stats['in_flight'])]
+        yield 'lighthouse_in_flight_cap', 'gauge', 'Current concurrency cap (lowered while NLP errors are high).', [({}, stats['current_cap'])]
+        yield 'lighthouse_nlp_error_rate', 'gauge', 'Dialogflow error rate over the shedding window.', [({}, stats['nlp_error_rate'])]
+
+    breaker = get_nlp_breaker_stats()
+    if breaker is not None:
+        yield 'lighthouse_circuit_state', 'gauge', 'Circuit breaker state (0 closed, 1 half-open, 2 open).', [({'circuit': breaker['name']}, STATE_VALUES[breaker['state']])]
+
+    preload = get_preload_stats()
+    if preload['seconds'] is not None:
+        yield 'lighthouse_sdk_preload_seconds', 'gauge', 'Seconds the SDK preload took (see SDK_PRELOAD).', [({'state': preload['state']}, preload['seconds'])]
+
+    limiter = app.extensions.get('rate_limiter')
+    if limiter is not None:
+        yield 'lighthouse_rate_limit_buckets', 'gauge', 'Sender token buckets currently tracked.', [({}, limiter.stats()['tracked_buckets'])]
+
+    yield 'lighthouse_log_dropped_records_total', 'counter', 'Log records dropped because the log queue was full.', [({}, get_log_stats()['dropped_records'])]
+
+
+def render_metrics(app):
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for name, metric_type, documentation, samples in _component_families(app):
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            lines.append(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
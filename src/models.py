@@ -1,11 +1,32 @@
 # src/models.py
+import unicodedata
+from contextlib import contextmanager
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import Session
 from datetime import datetime, date
 from decimal import Decimal
 
 # Initialize SQLAlchemy extension object globally but without app context yet
 db = SQLAlchemy()
 
+# Bind key of the optional read replica (SQLALCHEMY_BINDS['replica'], see ProductionConfig)
+REPLICA_BIND = 'replica'
+
+
+@contextmanager
+def read_session():
+    """
+    Session for read-only queries: a short-lived session on the read replica when one is
+    configured, otherwise the normal db.session. Never write through it. The replica may lag
+    the primary, so callers that must see their own writes should re-check db.session on a miss.
+    """
+    engine = db.engines.get(REPLICA_BIND)
+    if engine is None:
+        yield db.session
+        return
+    with Session(engine, expire_on_commit=False) as session:
+        yield session
+
 # --- Database Models ---
 
 class User(db.Model):
@@ -18,21 +39,62 @@ class User(db.Model):
     def __repr__(self):
         return f'<User {self.whatsapp_number} ({self.role}) - ID: {self.sampatti_card_id or "Not Linked"}>'
 
+
+def clean_sampatti_id(value):
+    """
+    A Sampatti card ID as it is stored and looked up: trimmed, non-ASCII digits (e.g. Devanagari)
+    as ASCII, letters kept as typed. Every write and lookup of User.sampatti_card_id goes through
+    here, so the chat, Dialogflow, bulk salary and import paths always agree on an ID.
+    """
+    text = str(value).strip() if value is not None else ''
+    return ''.join(str(unicodedata.decimal(ch)) if ch.isdecimal() and not ch.isascii() else ch for ch in text)
+
 class AttendanceLog(db.Model):
     __tablename__ = 'attendance_logs'
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False) # Indexed via ix_attendance_logs_user_timestamp
     log_type = db.Column(db.String(10), nullable=False) # 'checkin' or 'checkout'
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     user = db.relationship('User', backref=db.backref('attendance_logs', lazy=True))
     def __repr__(self):
         return f'<AttendanceLog {self.id} User: {self.user_id} Type: {self.log_type} at {self.timestamp}>'
 
+# Serves the hours engine's per-worker window scans (WHERE user_id IN (...) AND timestamp range,
+# PARTITION BY user_id ORDER BY timestamp) without a sort
+db.Index('ix_attendance_logs_user_timestamp', AttendanceLog.user_id, AttendanceLog.timestamp)
+
+# On PostgreSQL attendance_logs is partitioned by month (primary key (id, timestamp)); see
+# attendance_partitions.py. Months older than ATTENDANCE_KEEP_MONTHS are rolled up into the daily
+# rows below, written to a compressed file and dropped.
+
+class AttendanceDailySummary(db.Model):
+    """Hours per worker per day of an archived month, as computed by the hours engine before archiving."""
+    __tablename__ = 'attendance_daily_summaries'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True) # UTC day the shifts started
+    worked_seconds = db.Column(db.Integer, nullable=False, default=0)
+    shifts = db.Column(db.Integer, nullable=False, default=0)
+    missing_checkouts = db.Column(db.Integer, nullable=False, default=0)
+    def __repr__(self):
+        return f'<AttendanceDailySummary User: {self.user_id} Day: {self.day} Seconds: {self.worked_seconds}>'
+
+class AttendanceArchive(db.Model):
+    """One archived month of attendance_logs and where its raw rows went."""
+    __tablename__ = 'attendance_archives'
+    month = db.Column(db.Date, primary_key=True) # First day of the month
+    row_count = db.Column(db.Integer, nullable=False)
+    summary_rows = db.Column(db.Integer, nullable=False)
+    file_path = db.Column(db.String(255), nullable=True) # .csv.gz export, re-importable with `flask import attendance`
+    detached_table = db.Column(db.String(63), nullable=True) # Partition kept detached instead of dropped (PostgreSQL)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    def __repr__(self):
+        return f'<AttendanceArchive {self.month:%Y-%m} Rows: {self.row_count}>'
+
 class SalaryLog(db.Model):
     __tablename__ = 'salary_logs'
     id = db.Column(db.Integer, primary_key=True)
     employer_user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
-    worker_user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    worker_user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False) # Indexed via ix_salary_logs_worker_payment_date
     amount = db.Column(db.Numeric(10, 2), nullable=False)
     payment_date = db.Column(db.Date, nullable=False, index=True)
     notes = db.Column(db.Text, nullable=True)
@@ -43,6 +105,26 @@ class SalaryLog(db.Model):
         amount_str = str(self.amount) if self.amount is not None else 'N/A'
         return f'<SalaryLog {self.id} Worker: {self.worker_user_id} Amount: {amount_str} Date: {self.payment_date}>'
 
+# Serves "latest payments for a worker" (WHERE worker_user_id = ? ORDER BY payment_date DESC LIMIT n)
+# straight from the index, without sorting the worker's rows on every inquiry.
+db.Index('ix_salary_logs_worker_payment_date', SalaryLog.worker_user_id, SalaryLog.payment_date.desc())
+
+class WorkerSalarySummary(db.Model):
+    """Incrementally maintained per-worker salary totals, so inquiries are a single-row read."""
+    __tablename__ = 'worker_salary_summaries'
+    worker_user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    # Latest payments, newest first: [{"date": "YYYY-MM-DD", "amount": "500.00"}, ...]
+    recent_payments = db.Column(db.JSON, nullable=False, default=list)
+    month_key = db.Column(db.String(7), nullable=True) # 'YYYY-MM' that month_to_date refers to
+    month_to_date = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    year_key = db.Column(db.Integer, nullable=True) # Year that year_to_date refers to
+    year_to_date = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    payment_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+    worker = db.relationship('User', backref=db.backref('salary_summary', uselist=False))
+    def __repr__(self):
+        return f'<WorkerSalarySummary Worker: {self.worker_user_id} MTD({self.month_key}): {self.month_to_date} YTD({self.year_key}): {self.year_to_date}>'
+
 # You can add KycDocument model here later
 
 # src/models.py (Add this class)
@@ -60,6 +142,13 @@ class KycDocument(db.Model):
     # Status of the document verification
     status = db.Column(db.String(20), nullable=False, default='pending', index=True) # 'pending', 'approved', 'rejected'
     uploaded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Reviewer renditions written by the preview pool (src/previews.py); storage keys and byte sizes
+    preview_path = db.Column(db.String(255), nullable=True)
+    preview_size = db.Column(db.Integer, nullable=True)
+    thumbnail_path = db.Column(db.String(255), nullable=True)
+    thumbnail_size = db.Column(db.Integer, nullable=True)
+    page_count = db.Column(db.Integer, nullable=True)
+    previews_generated_at = db.Column(db.DateTime, nullable=True)
     # Optional: Add fields for reviewer notes, review timestamp etc.
 
     # Relationship back to the User
@@ -1,48 +1,568 @@
 # src/nlp.py (Corrected Version - Reads Env Var INSIDE functions)
+import hashlib
 import os
-from google.cloud import dialogflow
-from google.api_core.exceptions import GoogleAPICallError
-import requests
+import threading
+from collections import namedtuple
+from collections.abc import Mapping
+from .breaker import CircuitBreaker, BudgetExceeded, budget_timeout, download_budget, iter_response
+from .cache import TTLCache, make_cache
+from .intents import normalize_text, match_degraded_intent
+from .lazy import LazyModule
+from .log import get_logger
+from .metrics import Counter, INTENTS_TOTAL, timed, stage_timer, record_nlp_error
+from .voice import VoiceNoteRejected, preflight_voice_note
 # Ensure GOOGLE_APPLICATION_CREDENTIALS environment variable is set correctly
 
 # REMOVED module-level variable definition and check
 
+log = get_logger(__name__)
+
+# The Dialogflow SDK (protobuf, grpc) is most of the app's import time; it is loaded on first use
+# or by the start-up preload (see lazy.py). Its exceptions module is only needed once a call was made,
+# and requests only for voice-note downloads.
+dialogflow = LazyModule('google.cloud.dialogflow')
+api_exceptions = LazyModule('google.api_core.exceptions')
+requests = LazyModule('requests')
+
+# Default per-call deadlines (seconds), overridable via env vars.
+# Kept well below Twilio's 15s webhook timeout so a slow Dialogflow call can't hold a worker for all of it.
+DEFAULT_TEXT_TIMEOUT = 5.0
+DEFAULT_AUDIO_TIMEOUT = 10.0
+DEFAULT_AUDIO_DOWNLOAD_TIMEOUT = 15.0 # Twilio media download (also capped by the request budget)
+# Size of each audio chunk piped from the Twilio download into the streaming request
+AUDIO_CHUNK_SIZE = 16 * 1024
+
+# --- Managed Dialogflow client (one per worker process) ---
+# Creating a SessionsClient means a new gRPC channel, credential load and TLS handshake,
+# so we build it once per process and reuse it. gRPC channels don't survive fork(),
+# so the PID is recorded and the client is rebuilt in the child (e.g. gunicorn --preload).
+_client_lock = threading.Lock()
+_session_client = None
+_client_pid = None
+
+
+def get_session_client():
+    """Returns the process-wide SessionsClient, creating it lazily (thread-safe)."""
+    global _session_client, _client_pid
+    client = _session_client
+    if client is not None and _client_pid == os.getpid():
+        return client
+    with _client_lock:
+        if _session_client is None or _client_pid != os.getpid():
+            _session_client = dialogflow.SessionsClient()
+            _client_pid = os.getpid()
+            log.info("Created Dialogflow SessionsClient for process %s", _client_pid)
+        return _session_client
+
+
+def set_session_client(client):
+    """Installs a pre-built client for this process (e.g. a local stand-in for benchmarks)."""
+    global _session_client, _client_pid
+    with _client_lock:
+        _session_client = client
+        _client_pid = os.getpid()
+
+
+def _reset_client_after_fork():
+    """Drops the parent's client in a forked child; it is rebuilt on first use."""
+    global _session_client, _client_pid, _client_lock
+    _session_client = None
+    _client_pid = None
+    _client_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_client_after_fork)
+
+
+def warm_up_client():
+    """Creates the client ahead of the first message. Returns True if a client is ready."""
+    if not os.getenv('DIALOGFLOW_PROJECT_ID'):
+        log.warning("Skipping Dialogflow client warm-up - DIALOGFLOW_PROJECT_ID env var not set.")
+        return False
+    try:
+        get_session_client()
+        return True
+    except Exception as e:
+        log.warning("Dialogflow client warm-up failed (will retry on first message): %s", e)
+        return False
+
+
+def _get_timeout(env_var, default):
+    """Reads a per-call deadline in seconds from the environment."""
+    try:
+        return float(os.getenv(env_var, default))
+    except (TypeError, ValueError):
+        return default
+
+# --- Circuit breaker and deadline budget (see breaker.py) ---
+# Text and audio share one breaker: both go to the same Dialogflow endpoint. While it is open, or
+# when the webhook's remaining budget is too short for a useful call, text is resolved by the
+# degraded local parser (intents.match_degraded_intent) and voice notes get a "please type" reply.
+# Settings: NLP_BREAKER_ENABLED, NLP_BREAKER_FAILURES (consecutive outage errors that open it),
+# NLP_BREAKER_RESET_SECONDS (open time before a probe), NLP_DEADLINE_RESERVE (seconds of the budget
+# kept for the command handler and reply) and NLP_MIN_CALL_SECONDS (shortest call worth making).
+NLP_DEGRADED_TOTAL = Counter(
+    'lighthouse_nlp_degraded_total', 'Messages resolved without Dialogflow because it was unavailable.', ['kind', 'reason']
+)
+DEGRADED_VOICE_REPLY = (
+    "Sorry, I can't understand voice messages right now. Please type your command instead, "
+    "e.g. 'checkin', 'checkout' or 'salary'."
+)
+NlpCall = namedtuple('NlpCall', ['timeout', 'capped']) # capped: the request budget set the timeout
+_breaker = None
+_breaker_ready = False
+_breaker_lock = threading.Lock()
+
+
+def is_api_error(error):
+    """True for errors returned by the Dialogflow API (as opposed to failures on our side)."""
+    return isinstance(error, api_exceptions.GoogleAPICallError)
+
+
+def is_outage_error(error):
+    """True for errors meaning Dialogflow is unavailable (UNAVAILABLE, DEADLINE_EXCEEDED)."""
+    return isinstance(error, (api_exceptions.ServiceUnavailable, api_exceptions.DeadlineExceeded))
+
+
+def get_nlp_breaker():
+    """Returns the process-wide Dialogflow circuit breaker, or None if it is disabled."""
+    global _breaker, _breaker_ready
+    if _breaker_ready:
+        return _breaker
+    with _breaker_lock:
+        if not _breaker_ready:
+            if os.getenv('NLP_BREAKER_ENABLED', '1') == '1':
+                _breaker = CircuitBreaker(
+                    'dialogflow', failure_threshold=int(os.getenv('NLP_BREAKER_FAILURES', 5)),
+                    reset_timeout=float(os.getenv('NLP_BREAKER_RESET_SECONDS', 30)),
+                )
+            _breaker_ready = True
+    return _breaker
+
+
+def get_nlp_breaker_stats():
+    breaker = get_nlp_breaker()
+    return breaker.stats() if breaker is not None else None
+
+
+def _admit_nlp_call(kind, env_var, default):
+    """Returns the NlpCall to make, or None when Dialogflow must be skipped (circuit open or out of budget)."""
+    timeout, capped = budget_timeout(_get_timeout(env_var, default), _get_timeout('NLP_DEADLINE_RESERVE', 1.0))
+    if timeout < _get_timeout('NLP_MIN_CALL_SECONDS', 0.5):
+        log.warning("Skipping Dialogflow (%s): only %.2fs left in the request budget.", kind, timeout)
+        NLP_DEGRADED_TOTAL.inc(kind=kind, reason='deadline')
+        return None
+    breaker = get_nlp_breaker()
+    if breaker is not None and not breaker.allow():
+        NLP_DEGRADED_TOTAL.inc(kind=kind, reason='circuit_open')
+        return None
+    return NlpCall(timeout, capped)
+
+
+def voice_download_budget():
+    """(timeout, deadline) for downloading a voice note (see breaker.download_budget), leaving enough of
+    the request budget for the shortest useful Dialogflow call after it. None when there isn't time."""
+    min_call = _get_timeout('NLP_MIN_CALL_SECONDS', 0.5)
+    budget = download_budget(
+        _get_timeout('VOICE_DOWNLOAD_TIMEOUT', DEFAULT_AUDIO_DOWNLOAD_TIMEOUT),
+        reserve=_get_timeout('NLP_DEADLINE_RESERVE', 1.0) + min_call, min_seconds=min_call,
+    )
+    if budget is None:
+        log.warning("Skipping voice note download: the request budget is spent.")
+        NLP_DEGRADED_TOTAL.inc(kind='audio', reason='deadline')
+    return budget
+
+
+def voice_download_timed_out(session_id, error):
+    """Reply for a voice note whose download ran out of the request budget."""
+    log.warning("Voice note download for session %s ran out of the request budget: %s", session_id, error)
+    NLP_DEGRADED_TOTAL.inc(kind='audio', reason='deadline')
+    return None, None, DEGRADED_VOICE_REPLY
+
+
+def _end_nlp_call(call, error=None):
+    """Reports an admitted call's outcome to the breaker. Only outage errors count as failures."""
+    breaker = get_nlp_breaker()
+    if call is None or breaker is None:
+        return
+    if error is None or (is_api_error(error) and not is_outage_error(error)):
+        breaker.record_success() # Dialogflow answered, even if with an error about the request
+    elif isinstance(error, api_exceptions.ServiceUnavailable) or (
+            isinstance(error, api_exceptions.DeadlineExceeded) and not call.capped):
+        breaker.record_failure()
+    else:
+        breaker.release() # Ran out of the request's budget, or failed on our side
+
+
+def _degraded_text_result(text, language_code):
+    """Resolves a text message locally while Dialogflow is unavailable; unmatched text gets the command list."""
+    intent, parameters, _ = match_degraded_intent(text, language_code)
+    intent = intent or 'Default Fallback Intent'
+    log.info("Dialogflow unavailable; degraded local parser matched '%s'.", intent)
+    INTENTS_TOTAL.inc(intent=intent, source='degraded')
+    return intent, parameters or {}, None
+
+# --- Text result cache ---
+# Identical texts ("check in", "salary?") resolve to the same intent for every user, so
+# context-free results are cached by (language, normalized text). Configured via env vars:
+# NLP_CACHE_BACKEND ('memory', 'sqlite' or 'off'), NLP_CACHE_SIZE, NLP_CACHE_TTL, NLP_CACHE_PATH.
+_text_cache = None
+_text_cache_ready = False
+_text_cache_lock = threading.Lock()
+# Sessions that Dialogflow left with active output contexts; their next message may
+# resolve differently, so they bypass the cache until the contexts (typically 20 min) lapse.
+_sessions_with_context = TTLCache(maxsize=10000, ttl=1200, name='dialogflow_contexts')
+
+
+def get_text_cache():
+    """Returns the configured text result cache, or None if caching is disabled."""
+    global _text_cache, _text_cache_ready
+    if _text_cache_ready:
+        return _text_cache
+    with _text_cache_lock:
+        if not _text_cache_ready:
+            _text_cache = make_cache(
+                os.getenv('NLP_CACHE_BACKEND', 'memory'), name='dialogflow_text',
+                maxsize=int(os.getenv('NLP_CACHE_SIZE', 2048)), ttl=float(os.getenv('NLP_CACHE_TTL', 600)),
+                path=os.getenv('NLP_CACHE_PATH', '/tmp/lighthouse_nlp_cache.sqlite3'),
+            )
+            _text_cache_ready = True
+    return _text_cache
+
+
+def get_text_cache_stats():
+    """Hit/miss counters for the text cache (None if disabled)."""
+    cache = get_text_cache()
+    return cache.stats() if cache is not None else None
+
+
+def _text_cache_key(text, language_code):
+    return f"{(language_code or 'en').lower()}:{normalize_text(text).casefold()}"
+
+
+def _to_plain(value):
+    """Converts Dialogflow Struct/ListValue parameters into plain dicts/lists."""
+    if isinstance(value, Mapping):
+        return {k: _to_plain(v) for k, v in value.items()}
+    if hasattr(value, '__iter__') and not isinstance(value, (str, bytes)):
+        return [_to_plain(v) for v in value]
+    return value
+
+
+def reset_session_context(session_id):
+    """Asks Dialogflow to drop the session's contexts on its next call, e.g. after a follow-up it was
+    waiting for was answered locally (conversation.py). Only known sessions of this process are reset."""
+    if _sessions_with_context.get(session_id) is not None:
+        _sessions_with_context.set(session_id, 'reset')
+
+
+def _session_fields(session_path, session_id):
+    """The 'session' request field, plus query_params resetting contexts if reset_session_context asked for it."""
+    fields = {'session': session_path}
+    if _sessions_with_context.get(session_id) == 'reset':
+        fields['query_params'] = dialogflow.QueryParameters(reset_contexts=True)
+    return fields
+
+
+def _is_context_free(query_result):
+    """True if the result doesn't depend on (or start) a multi-turn conversation."""
+    return (
+        bool(query_result.intent.display_name)
+        and query_result.all_required_params_present
+        and len(query_result.output_contexts) == 0
+    )
+
+
+# --- Voice note pre-flight and transcript cache ---
+# With VOICE_PREFLIGHT=1, a voice note is downloaded whole (up to VOICE_MAX_BYTES) instead of
+# being streamed into the recognizer, so that:
+# - a clip already recognised (typically a forwarded voice note) is answered from a cache keyed by
+#   the SHA-256 of its bytes, without calling Dialogflow;
+# - src/voice.py can check it locally: silent, unreadable or non-mono clips get a reply straight
+#   away, long clips are trimmed to VOICE_MAX_SECONDS, and the header's sample rate is sent.
+# It is off by default: streaming overlaps the download with recognition (DIALOGFLOW_STREAMING_AUDIO),
+# and pre-flight gives that up for every clip to save a Dialogflow call on the few it rejects or finds cached.
+# Cache settings: VOICE_CACHE_BACKEND ('memory', 'sqlite' or 'off'), VOICE_CACHE_SIZE, VOICE_CACHE_TTL, VOICE_CACHE_PATH.
+VOICE_PREFLIGHT_TOTAL = Counter(
+    'lighthouse_voice_preflight_total', 'Voice notes by pre-flight outcome.', ['outcome']
+)
+VOICE_REJECTION_REPLIES = {
+    'too_large': "Your voice message is too long. Please send a shorter message with just your command.",
+    'unsupported_format': "Sorry, the audio format of your voice message is not supported.",
+    'corrupt': "Sorry, I couldn't read your voice message. Please record it again.",
+    'channels': "Sorry, I can only understand normal WhatsApp voice messages. Please record your command again.",
+    'silent': "I couldn't hear anything in your voice message. Please try again and speak clearly.",
+}
+_voice_cache = None
+_voice_cache_ready = False
+_voice_cache_lock = threading.Lock()
+
+
+def get_voice_cache():
+    """Returns the configured voice result cache, or None if caching is disabled."""
+    global _voice_cache, _voice_cache_ready
+    if _voice_cache_ready:
+        return _voice_cache
+    with _voice_cache_lock:
+        if not _voice_cache_ready:
+            _voice_cache = make_cache(
+                os.getenv('VOICE_CACHE_BACKEND', 'memory'), name='dialogflow_voice',
+                maxsize=int(os.getenv('VOICE_CACHE_SIZE', 1024)), ttl=float(os.getenv('VOICE_CACHE_TTL', 86400)),
+                path=os.getenv('VOICE_CACHE_PATH', '/tmp/lighthouse_voice_cache.sqlite3'),
+            )
+            _voice_cache_ready = True
+    return _voice_cache
+
+
+def get_voice_cache_stats():
+    """Hit/miss counters for the voice cache (None if disabled)."""
+    cache = get_voice_cache()
+    return cache.stats() if cache is not None else None
+
+
+def voice_preflight_enabled():
+    return os.getenv('VOICE_PREFLIGHT', '0') == '1'
+
+
+def max_voice_bytes():
+    return int(os.getenv('VOICE_MAX_BYTES', 2 * 1024 * 1024))
+
+
+def _prepare_voice_note(session_id, audio, language_code):
+    """
+    Cache lookup and pre-flight for a downloaded voice note.
+    Returns (result, clip, cache, cache_key): result is the (intent, parameters, fulfillment) reply when
+    no Dialogflow call is needed; otherwise send clip and pass cache/cache_key on to _audio_result.
+    """
+    cache = get_voice_cache()
+    cache_key = None
+    if cache is not None and _sessions_with_context.get(session_id) is None:
+        cache_key = f"{(language_code or 'en').lower()}:{hashlib.sha256(audio).hexdigest()}"
+        cached = cache.get(cache_key)
+        if cached is not None:
+            VOICE_PREFLIGHT_TOTAL.inc(outcome='cached')
+            log.debug("Voice cache hit: Transcript='%s', Intent='%s'", cached['transcript'], cached['intent'])
+            return (cached['intent'], cached['parameters'], cached['fulfillment_text']), None, cache, cache_key
+    try:
+        with stage_timer('voice_preflight'):
+            clip = preflight_voice_note(
+                audio, max_seconds=float(os.getenv('VOICE_MAX_SECONDS', 55)),
+                min_speech_seconds=float(os.getenv('VOICE_MIN_SPEECH_SECONDS', 0.3)),
+            )
+    except VoiceNoteRejected as rejected:
+        return _voice_rejected(session_id, rejected), None, cache, None
+    VOICE_PREFLIGHT_TOTAL.inc(outcome='trimmed' if clip.trimmed else 'passed')
+    if clip.trimmed:
+        log.info("Voice note for session %s trimmed to %.1fs.", session_id, clip.duration)
+    return None, clip, cache, cache_key
+
+
+def _voice_rejected(session_id, rejected):
+    VOICE_PREFLIGHT_TOTAL.inc(outcome=rejected.reason)
+    log.info("Voice note for session %s rejected before recognition: %s", session_id, rejected)
+    return None, None, VOICE_REJECTION_REPLIES[rejected.reason]
+
+
+# --- Shared by detect_intent_text and the async path (nlp_async.py) ---
+
+def _text_cache_lookup(session_id, text, language_code):
+    """Returns (cache, cache_key, cached result or None); cache_key is None when the session must bypass the cache."""
+    cache = get_text_cache()
+    if cache is None or _sessions_with_context.get(session_id) is not None:
+        return cache, None, None
+    cache_key = _text_cache_key(text, language_code)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        log.debug("Dialogflow text cache hit: Lang=%s, Intent='%s'", language_code, cached['intent'])
+        if cached['intent']:
+            INTENTS_TOTAL.inc(intent=cached['intent'], source='dialogflow')
+        return cache, cache_key, (cached['intent'], cached['parameters'], cached['fulfillment_text'])
+    return cache, cache_key, None
+
+
+def _text_query_input(text, language_code):
+    text_input = dialogflow.TextInput(text=text, language_code=language_code)
+    return dialogflow.QueryInput(text=text_input)
+
+
+def _text_result(session_id, query_result, cache, cache_key):
+    """Turns a text QueryResult into (intent, parameters, fulfillment), tracking contexts and caching it (counted in INTENTS_TOTAL)."""
+    intent = query_result.intent.display_name
+    parameters = query_result.parameters
+    fulfillment_text = query_result.fulfillment_text
+    log.debug("Dialogflow Text Response: Intent='%s', Params='%s', Fulfillment='%s'", intent, parameters, fulfillment_text)
+    if intent:
+        INTENTS_TOTAL.inc(intent=intent, source='dialogflow')
+    if len(query_result.output_contexts) > 0:
+        _sessions_with_context.set(session_id, True)
+    else:
+        _sessions_with_context.delete(session_id)
+    if cache_key is not None and _is_context_free(query_result):
+        parameters = _to_plain(parameters)
+        cache.set(cache_key, {'intent': intent, 'parameters': parameters, 'fulfillment_text': fulfillment_text})
+    return intent, parameters, fulfillment_text
+
+
+@timed('nlp_text')
 def detect_intent_text(session_id, text, language_code='en'):
     """Sends user text query to Dialogflow..."""
     if not text:
         return None, None, None
 
+    cache, cache_key, cached = _text_cache_lookup(session_id, text, language_code)
+    if cached is not None:
+        return cached
+
     # >>> Get Project ID inside the function <<<
     project_id = os.getenv('DIALOGFLOW_PROJECT_ID')
     if not project_id:
-        print("ERROR: detect_intent_text - DIALOGFLOW_PROJECT_ID env var not set.")
+        log.error("detect_intent_text - DIALOGFLOW_PROJECT_ID env var not set.")
+        record_nlp_error('text', 'missing_config')
         return None, None, None # Return error indication
 
+    call = _admit_nlp_call('text', 'DIALOGFLOW_TEXT_TIMEOUT', DEFAULT_TEXT_TIMEOUT)
+    if call is None:
+        return _degraded_text_result(text, language_code)
+
     try:
-        session_client = dialogflow.SessionsClient()
+        session_client = get_session_client()
         # >>> Use the locally fetched project_id <<<
         session_path = session_client.session_path(project_id, session_id)
 
-        text_input = dialogflow.TextInput(text=text, language_code=language_code)
-        query_input = dialogflow.QueryInput(text=text_input)
-        print(f"Sending TEXT to Dialogflow: Project={project_id}, Session={session_id}, Lang={language_code}, Text='{text}'")
+        query_input = _text_query_input(text, language_code)
+        log.debug("Sending TEXT to Dialogflow: Project=%s, Session=%s, Lang=%s, Text='%s'", project_id, session_id, language_code, text)
         response = session_client.detect_intent(
-            request={"session": session_path, "query_input": query_input}
+            request={**_session_fields(session_path, session_id), "query_input": query_input},
+            timeout=call.timeout,
         )
-        # ... (rest of text function remains the same) ...
-        query_result = response.query_result
-        intent = query_result.intent.display_name
-        parameters = query_result.parameters
-        fulfillment_text = query_result.fulfillment_text
-        print(f"Dialogflow Text Response: Intent='{intent}', Params='{parameters}', Fulfillment='{fulfillment_text}'")
-        return intent, parameters, fulfillment_text
+        _end_nlp_call(call)
+        return _text_result(session_id, response.query_result, cache, cache_key)
     except Exception as e:
-        print(f"ERROR interacting with Dialogflow (Text): {e}")
+        log.error("Error interacting with Dialogflow (Text): %s", e)
+        record_nlp_error('text', 'api_error' if is_api_error(e) else 'unexpected')
+        _end_nlp_call(call, e)
+        if is_outage_error(e):
+            NLP_DEGRADED_TOTAL.inc(kind='text', reason='outage_error')
+            return _degraded_text_result(text, language_code)
         return None, None, None
 
 
 
-# ... (detect_intent_text remains the same) ...
+def _streaming_detect_intent(session_client, session_fields, query_input, first_chunk, audio_chunks, download_state, timeout):
+    """
+    Runs streaming_detect_intent fed directly from the download iterator.
+    Download errors are recorded in download_state instead of being raised inside gRPC's
+    request thread (where they'd surface as an opaque UNKNOWN error).
+    Returns the final QueryResult, or None if Dialogflow sent none.
+    """
+    def request_stream():
+        yield dialogflow.StreamingDetectIntentRequest(**session_fields, query_input=query_input)
+        download_state['bytes'] += len(first_chunk)
+        yield dialogflow.StreamingDetectIntentRequest(input_audio=first_chunk)
+        try:
+            for chunk in audio_chunks:
+                if chunk:
+                    download_state['bytes'] += len(chunk)
+                    yield dialogflow.StreamingDetectIntentRequest(input_audio=chunk)
+        except (requests.exceptions.RequestException, BudgetExceeded) as e:
+            download_state['error'] = e
+
+    query_result = None
+    for response in session_client.streaming_detect_intent(requests=request_stream(), timeout=timeout):
+        if 'query_result' in response:
+            query_result = response.query_result
+    return query_result
+
+
+# --- Shared by detect_intent_audio and the async path (nlp_async.py) ---
+
+def _audio_query_input(language_code, sample_rate_hertz=16000):
+    audio_config = dialogflow.InputAudioConfig(
+        audio_encoding=dialogflow.AudioEncoding.AUDIO_ENCODING_OGG_OPUS,
+        language_code=language_code,
+        sample_rate_hertz=sample_rate_hertz,
+    )
+    return dialogflow.QueryInput(audio_config=audio_config)
+
+
+def _audio_result(query_result, session_id=None, cache=None, cache_key=None):
+    """Turns the final audio QueryResult (or None) into (intent, parameters, fulfillment), caching it if cache_key is set."""
+    if query_result is None:
+        log.warning("Dialogflow streaming call ended without a query result.")
+        record_nlp_error('audio', 'no_result')
+        return None, None, "Sorry, I couldn't understand your voice message. Please try again."
+
+    # Raw QueryResult is large; only formatted when debug logging is on
+    log.debug("RAW DIALOGFLOW QueryResult OBJECT (Audio):\n%s", query_result)
+
+    intent_display_name = getattr(query_result.intent, 'display_name', None)
+    parameters = query_result.parameters # Should generally exist
+    fulfillment_text = getattr(query_result, 'fulfillment_text', None)
+    transcript = getattr(query_result, 'query_text', None)
+    log.debug("Dialogflow Audio Response: Transcript='%s', Intent='%s', Params='%s', Fulfillment='%s'", transcript, intent_display_name, parameters, fulfillment_text)
+
+    if not intent_display_name and transcript:
+        log.info("Dialogflow recognized speech but couldn't match an intent.")
+    elif not transcript:
+         log.info("Dialogflow did not detect any speech in the audio.")
+
+    if session_id is not None:
+        if len(query_result.output_contexts) > 0:
+            _sessions_with_context.set(session_id, True)
+        else:
+            _sessions_with_context.delete(session_id)
+    if cache_key is not None and _is_context_free(query_result):
+        parameters = _to_plain(parameters)
+        cache.set(cache_key, {
+            'intent': intent_display_name, 'parameters': parameters,
+            'fulfillment_text': fulfillment_text, 'transcript': transcript,
+        })
+    return intent_display_name, parameters, fulfillment_text
+
+
+def _audio_download_error(session_id, error, status_code=None):
+    log.error("Error downloading audio for session %s: %s", session_id, error)
+    if status_code in (401, 403):
+        log.error("Authentication failed downloading Twilio media. Check SID/Token.")
+        record_nlp_error('audio', 'download_auth')
+        return None, None, "Error: Could not authenticate to download voice message. Please check credentials."
+    record_nlp_error('audio', 'download')
+    return None, None, "Error: Could not download voice message from URL."
+
+
+def _audio_api_error(api_error):
+    log.error("Dialogflow API Call Error (Audio): %s", api_error)
+    if "Audio encoding not supported" in str(api_error):
+        record_nlp_error('audio', 'unsupported_encoding')
+        return None, None, "Sorry, the audio format of your voice message is not supported."
+    elif "PermissionDenied" in str(api_error) or "403" in str(api_error):
+         log.error("Permission Denied Error from Dialogflow API. Check service account key/roles.")
+         record_nlp_error('audio', 'permission_denied')
+         return None, None, "Error: Permission issue accessing Dialogflow API."
+    elif is_outage_error(api_error) or "Deadline Exceeded" in str(api_error) or "RESOURCE_EXHAUSTED" in str(api_error) or "UNAVAILABLE" in str(api_error):
+        log.warning("Dialogflow API timeout or resource error: %s", api_error)
+        record_nlp_error('audio', 'busy_or_timeout')
+        return None, None, "Sorry, the voice recognition service is busy or timed out. Please try again."
+    record_nlp_error('audio', 'api_error')
+    return None, None, "Sorry, there was an API error processing your voice message."
+
+
+def _read_voice_note(audio_response, first_chunk, audio_chunks):
+    """Reads the rest of a voice note download, up to VOICE_MAX_BYTES."""
+    max_bytes = max_voice_bytes()
+    declared = audio_response.headers.get('Content-Length')
+    if declared and declared.isdigit() and int(declared) > max_bytes:
+        raise VoiceNoteRejected('too_large', f"{declared} bytes")
+    audio = bytearray(first_chunk)
+    for chunk in audio_chunks:
+        audio.extend(chunk)
+        if len(audio) > max_bytes:
+            raise VoiceNoteRejected('too_large', f"over {max_bytes} bytes")
+    return bytes(audio)
+
+
+@timed('nlp_audio')
 def detect_intent_audio(session_id, audio_uri, language_code='en'):
     """
     Downloads audio from URI (with auth), sends audio content to Dialogflow...
@@ -55,90 +575,112 @@ def detect_intent_audio(session_id, audio_uri, language_code='en'):
 
     if not project_id or not twilio_account_sid or not twilio_auth_token:
         missing = [var for var, val in [('Project ID', project_id), ('Twilio SID', twilio_account_sid), ('Twilio Token', twilio_auth_token)] if not val]
-        print(f"ERROR: detect_intent_audio - Missing environment variables: {', '.join(missing)}")
+        log.error("detect_intent_audio - Missing environment variables: %s", ', '.join(missing))
+        record_nlp_error('audio', 'missing_config')
         return None, None, None
 
-    audio_content = None
+    audio_response = None
+    call = None
+    budget = voice_download_budget()
+    if budget is None:
+        return None, None, DEGRADED_VOICE_REPLY
+    download_timeout, download_deadline = budget
 
     try:
-        # --- Step 1: Download Audio ---
-        print(f"Downloading audio for session {session_id} from {audio_uri} using Twilio Auth")
-        audio_response = requests.get(
-            audio_uri,
-            auth=(twilio_account_sid, twilio_auth_token),
-            timeout=15
-        )
-        audio_response.raise_for_status()
-        audio_content = audio_response.content
-        print(f"Audio downloaded successfully ({len(audio_content)} bytes).")
-
-        # --- Step 2: Send Audio Content ---
-        if audio_content:
-            session_client = dialogflow.SessionsClient()
-            session_path = session_client.session_path(project_id, session_id)
-
-            audio_encoding = dialogflow.AudioEncoding.AUDIO_ENCODING_OGG_OPUS
-            sample_rate_hertz = 16000
-
-            audio_config = dialogflow.InputAudioConfig(
-                audio_encoding=audio_encoding,
-                language_code=language_code,
-                sample_rate_hertz=sample_rate_hertz,
+        # --- Step 1: Start Audio Download (streamed; body is read chunk by chunk below) ---
+        log.debug("Downloading audio for session %s from %s using Twilio Auth", session_id, audio_uri)
+        # Time to first chunk; the rest of the download overlaps recognition when streaming
+        with stage_timer('media_download'):
+            audio_response = requests.get(
+                audio_uri,
+                auth=(twilio_account_sid, twilio_auth_token),
+                timeout=download_timeout,
+                stream=True
             )
-            print(f"Sending AUDIO CONTENT to Dialogflow: Project={project_id}, Session={session_id}, Lang={language_code}, Encoding={audio_encoding}, SampleRate={sample_rate_hertz}")
-            query_input = dialogflow.QueryInput(audio_config=audio_config)
-            request_config = {
-                "session": session_path,
-                "query_input": query_input,
-                "input_audio": audio_content,
-            }
-            response = session_client.detect_intent(request=request_config)
-
-            query_result = response.query_result
-
-            # --- >>> ADDED DIAGNOSTIC PRINT <<< ---
-            print(f"**** RAW DIALOGFLOW QueryResult OBJECT (Audio):\n{query_result}\n****")
-            # --- >>>------------------------------<<< ---
-
-            # --- >>> CORRECTED ACCESS USING getattr <<< ---
-            intent_display_name = getattr(query_result.intent, 'display_name', None)
-            parameters = query_result.parameters # Should generally exist
-            fulfillment_text = getattr(query_result, 'fulfillment_text', None)
-            # Get transcript using query_text field name safely
-            transcript = getattr(query_result, 'query_text', None) # <<< FIXED HERE
-            # --- >>>------------------------------<<< ---
+            audio_response.raise_for_status()
+            audio_chunks = iter_response(audio_response, AUDIO_CHUNK_SIZE, download_deadline)
+            first_chunk = next(audio_chunks, b'')
 
+        # --- Step 2: Send Audio Content ---
+        if first_chunk:
+            if voice_preflight_enabled():
+                # Buffered: the whole clip is needed for its hash and duration
+                with stage_timer('media_download'):
+                    audio_content = _read_voice_note(audio_response, first_chunk, audio_chunks)
+                # Cached and rejected clips are answered even while Dialogflow is unavailable
+                cached, clip, cache, cache_key = _prepare_voice_note(session_id, audio_content, language_code)
+                if cached is not None:
+                    return cached
+                call = _admit_nlp_call('audio', 'DIALOGFLOW_AUDIO_TIMEOUT', DEFAULT_AUDIO_TIMEOUT)
+                if call is None:
+                    return None, None, DEGRADED_VOICE_REPLY
+                session_client = get_session_client()
+                log.debug("Sending AUDIO CONTENT to Dialogflow: Project=%s, Session=%s, Lang=%s, %.1fs at %d Hz", project_id, session_id, language_code, clip.duration, clip.sample_rate)
+                response = session_client.detect_intent(request={
+                    **_session_fields(session_client.session_path(project_id, session_id), session_id),
+                    "query_input": _audio_query_input(language_code, clip.sample_rate),
+                    "input_audio": clip.audio,
+                }, timeout=call.timeout)
+                _end_nlp_call(call)
+                return _audio_result(response.query_result, session_id, cache, cache_key)
 
-            print(f"Dialogflow Audio Response: Transcript='{transcript}', Intent='{intent_display_name}', Params='{parameters}', Fulfillment='{fulfillment_text}'")
+            call = _admit_nlp_call('audio', 'DIALOGFLOW_AUDIO_TIMEOUT', DEFAULT_AUDIO_TIMEOUT)
+            if call is None:
+                return None, None, DEGRADED_VOICE_REPLY
+            timeout = call.timeout
+            session_client = get_session_client()
+            session_path = session_client.session_path(project_id, session_id)
+            query_input = _audio_query_input(language_code)
 
-            # Update checks to use the transcript variable
-            if not intent_display_name and transcript:
-                print("Dialogflow recognized speech but couldn't match an intent.")
-            elif not transcript:
-                 print("Dialogflow did not detect any speech in the audio.")
+            if os.getenv('DIALOGFLOW_STREAMING_AUDIO', '1') == '1':
+                # Pipe downloaded chunks straight into a streaming recognition request, so
+                # recognition overlaps the download and the clip is never held in memory whole.
+                log.debug("Streaming AUDIO to Dialogflow: Project=%s, Session=%s, Lang=%s", project_id, session_id, language_code)
+                download_state = {'bytes': 0, 'error': None}
+                query_result = _streaming_detect_intent(
+                    session_client, _session_fields(session_path, session_id), query_input, first_chunk, audio_chunks, download_state, timeout
+                )
+                if download_state['error'] is not None:
+                    # Download broke mid-stream; report it like any other download failure
+                    raise download_state['error']
+                log.debug("Audio streamed successfully (%d bytes).", download_state['bytes'])
+            else:
+                audio_content = first_chunk + b''.join(audio_chunks)
+                log.debug("Audio downloaded successfully (%d bytes).", len(audio_content))
+                log.debug("Sending AUDIO CONTENT to Dialogflow: Project=%s, Session=%s, Lang=%s", project_id, session_id, language_code)
+                request_config = {
+                    **_session_fields(session_path, session_id),
+                    "query_input": query_input,
+                    "input_audio": audio_content,
+                }
+                response = session_client.detect_intent(request=request_config, timeout=timeout)
+                query_result = response.query_result
 
-            return intent_display_name, parameters, fulfillment_text
+            _end_nlp_call(call)
+            return _audio_result(query_result, session_id)
         else:
-             print("Audio content is empty after successful download attempt?")
+             log.warning("Audio content is empty after successful download attempt?")
+             record_nlp_error('audio', 'empty_audio')
              return None, None, "Error processing downloaded audio."
 
+    except VoiceNoteRejected as rejected:
+        return _voice_rejected(session_id, rejected)
+    except (BudgetExceeded, requests.exceptions.Timeout) as timed_out:
+        _end_nlp_call(call, timed_out)
+        return voice_download_timed_out(session_id, timed_out)
     except requests.exceptions.RequestException as req_err:
-         print(f"ERROR Downloading audio for session {session_id}: {req_err}")
-         if isinstance(req_err, requests.exceptions.HTTPError) and req_err.response.status_code in [401, 403]:
-             print("Authentication failed downloading Twilio media. Check SID/Token.")
-             return None, None, "Error: Could not authenticate to download voice message. Please check credentials."
-         return None, None, "Error: Could not download voice message from URL."
-    except GoogleAPICallError as api_error:
-        print(f"ERROR Dialogflow API Call Error (Audio): {api_error}")
-        if "Audio encoding not supported" in str(api_error): return None, None, "Sorry, the audio format of your voice message is not supported."
-        elif "PermissionDenied" in str(api_error) or "403" in str(api_error):
-             print("Permission Denied Error from Dialogflow API. Check service account key/roles.")
-             return None, None, "Error: Permission issue accessing Dialogflow API."
-        elif "Deadline Exceeded" in str(api_error) or "RESOURCE_EXHAUSTED" in str(api_error) or "UNAVAILABLE" in str(api_error):
-            print(f"Dialogflow API timeout or resource error: {api_error}")
-            return None, None, "Sorry, the voice recognition service is busy or timed out. Please try again."
-        else: return None, None, "Sorry, there was an API error processing your voice message."
+        _end_nlp_call(call, req_err) # A broken download mid-stream says nothing about Dialogflow
+        status_code = req_err.response.status_code if isinstance(req_err, requests.exceptions.HTTPError) else None
+        return _audio_download_error(session_id, req_err, status_code)
+    except api_exceptions.GoogleAPICallError as api_error:
+        _end_nlp_call(call, api_error)
+        return _audio_api_error(api_error)
     except Exception as e:
-        print(f"ERROR processing audio for session {session_id}: {e}")
-        if "Unknown field" in str(e): print("Potential QueryResult structure issue persists.") # Keep this check
-        return None, None, "An unexpected error occurred while processing your voice message."
\ No newline at end of file
+        _end_nlp_call(call, e)
+        log.exception("Error processing audio for session %s: %s", session_id, e)
+        record_nlp_error('audio', 'unexpected')
+        if "Unknown field" in str(e): log.error("Potential QueryResult structure issue persists.") # Keep this check
+        return None, None, "An unexpected error occurred while processing your voice message."
+    finally:
+        if audio_response is not None:
+            audio_response.close()
\ No newline at end of file
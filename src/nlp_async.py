@@ -0,0 +1,269 @@
+# src/nlp_async.py
+# asyncio versions of detect_intent_text / detect_intent_audio for the ASGI entry point (asgi.py).
+# Dialogflow is called through SessionsAsyncClient and Twilio media is downloaded with aiohttp,
+# so a waiting request holds no thread. The text cache, context tracking, error replies, circuit
+# breaker and degraded fallback are shared with nlp.py. Calls on a blocking ('sqlite') text or voice
+# cache go through the caller's `run` (the async webhook's DB pool) instead of running on the loop.
+import asyncio
+import os
+import time
+import weakref
+
+import aiohttp
+
+from .nlp import (
+    dialogflow, api_exceptions, is_api_error, is_outage_error,
+    AUDIO_CHUNK_SIZE, DEFAULT_TEXT_TIMEOUT, DEFAULT_AUDIO_TIMEOUT, NLP_DEGRADED_TOTAL, DEGRADED_VOICE_REPLY,
+    get_text_cache, get_voice_cache, _admit_nlp_call, _end_nlp_call, _degraded_text_result, _session_fields,
+    _text_cache_lookup, _text_query_input, _text_result,
+    _audio_query_input, _audio_result, _audio_download_error, _audio_api_error,
+    voice_preflight_enabled, max_voice_bytes, _prepare_voice_note, _voice_rejected,
+    voice_download_budget, voice_download_timed_out,
+)
+from .breaker import BudgetExceeded, check_deadline
+from .voice import VoiceNoteRejected
+from .log import get_logger
+from .metrics import stage_timer, record_nlp_error
+
+log = get_logger(__name__)
+
+# gRPC aio channels and aiohttp sessions belong to one event loop, so keep one of each per loop
+_session_clients = weakref.WeakKeyDictionary()
+_http_sessions = weakref.WeakKeyDictionary()
+_client_override = None
+
+
+def get_async_session_client():
+    """Returns the SessionsAsyncClient for the running event loop (created on first use)."""
+    if _client_override is not None:
+        return _client_override
+    loop = asyncio.get_running_loop()
+    client = _session_clients.get(loop)
+    if client is None:
+        client = _session_clients[loop] = dialogflow.SessionsAsyncClient()
+    return client
+
+
+def set_async_session_client(client):
+    """Replaces the async Dialogflow client for every loop (benchmarks and local fakes)."""
+    global _client_override
+    _client_override = client
+
+
+def get_http_session():
+    """Returns the shared aiohttp session for the running event loop."""
+    loop = asyncio.get_running_loop()
+    session = _http_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=int(os.getenv('ASYNC_HTTP_CONNECTIONS', 100)))
+        session = _http_sessions[loop] = aiohttp.ClientSession(connector=connector)
+    return session
+
+
+async def close_async_clients():
+    """Closes this loop's HTTP session and Dialogflow channel (call on ASGI shutdown)."""
+    loop = asyncio.get_running_loop()
+    session = _http_sessions.pop(loop, None)
+    if session is not None:
+        await session.close()
+    client = _session_clients.pop(loop, None)
+    if client is not None:
+        await client.transport.close()
+
+
+async def call_inline(func, *args):
+    """Runner (async callable(func, *args)) that calls func on the event loop."""
+    return func(*args)
+
+
+def cache_runner(cache, run):
+    """run for a cache doing blocking I/O (see cache.blocking), call_inline for in-process ones."""
+    return run if run is not None and getattr(cache, 'blocking', False) else call_inline
+
+
+async def detect_intent_text_async(session_id, text, language_code='en', run=None):
+    """Async detect_intent_text: same cache and return shape. run: async callable(func, *args) for
+    calls on a blocking cache backend, e.g. the async webhook's DB pool."""
+    if not text:
+        return None, None, None
+
+    with stage_timer('nlp_text'):
+        run_cache = cache_runner(get_text_cache(), run)
+        cache, cache_key, cached = await run_cache(_text_cache_lookup, session_id, text, language_code)
+        if cached is not None:
+            return cached
+
+        project_id = os.getenv('DIALOGFLOW_PROJECT_ID')
+        if not project_id:
+            log.error("detect_intent_text_async - DIALOGFLOW_PROJECT_ID env var not set.")
+            record_nlp_error('text', 'missing_config')
+            return None, None, None
+
+        call = _admit_nlp_call('text', 'DIALOGFLOW_TEXT_TIMEOUT', DEFAULT_TEXT_TIMEOUT)
+        if call is None:
+            return _degraded_text_result(text, language_code)
+
+        try:
+            session_client = get_async_session_client()
+            session_path = session_client.session_path(project_id, session_id)
+            log.debug("Sending TEXT to Dialogflow (async): Session=%s, Lang=%s, Text='%s'", session_id, language_code, text)
+            response = await session_client.detect_intent(
+                request={**_session_fields(session_path, session_id), "query_input": _text_query_input(text, language_code)},
+                timeout=call.timeout,
+            )
+            _end_nlp_call(call)
+            return await run_cache(_text_result, session_id, response.query_result, cache, cache_key)
+        except Exception as e:
+            log.error("Error interacting with Dialogflow (Text, async): %s", e)
+            record_nlp_error('text', 'api_error' if is_api_error(e) else 'unexpected')
+            _end_nlp_call(call, e)
+            if is_outage_error(e):
+                NLP_DEGRADED_TOTAL.inc(kind='text', reason='outage_error')
+                return _degraded_text_result(text, language_code)
+            return None, None, None
+
+
+async def _streaming_detect_intent_async(session_client, session_fields, query_input, first_chunk, audio_response, download_state, timeout, deadline):
+    """Feeds the aiohttp download straight into streaming_detect_intent (see nlp._streaming_detect_intent)."""
+    async def request_stream():
+        yield dialogflow.StreamingDetectIntentRequest(**session_fields, query_input=query_input)
+        download_state['bytes'] += len(first_chunk)
+        yield dialogflow.StreamingDetectIntentRequest(input_audio=first_chunk)
+        try:
+            async for chunk in audio_response.content.iter_chunked(AUDIO_CHUNK_SIZE):
+                check_deadline(deadline)
+                download_state['bytes'] += len(chunk)
+                yield dialogflow.StreamingDetectIntentRequest(input_audio=chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError, BudgetExceeded) as e:
+            download_state['error'] = e
+
+    query_result = None
+    stream = await session_client.streaming_detect_intent(requests=request_stream(), timeout=timeout)
+    async for response in stream:
+        if 'query_result' in response:
+            query_result = response.query_result
+    return query_result
+
+
+async def _read_voice_note_async(audio_response, first_chunk, deadline):
+    """Reads the rest of a voice note download, up to VOICE_MAX_BYTES (see nlp._read_voice_note)."""
+    max_bytes = max_voice_bytes()
+    if audio_response.content_length and audio_response.content_length > max_bytes:
+        raise VoiceNoteRejected('too_large', f"{audio_response.content_length} bytes")
+    audio = bytearray(first_chunk)
+    async for chunk in audio_response.content.iter_chunked(AUDIO_CHUNK_SIZE):
+        check_deadline(deadline)
+        audio.extend(chunk)
+        if len(audio) > max_bytes:
+            raise VoiceNoteRejected('too_large', f"over {max_bytes} bytes")
+    return bytes(audio)
+
+
+async def detect_intent_audio_async(session_id, audio_uri, language_code='en', run=None):
+    """Async detect_intent_audio: downloads the voice note with aiohttp and streams it to Dialogflow.
+    run: as for detect_intent_text_async, used for the voice cache."""
+    if not audio_uri: return None, None, None
+
+    project_id = os.getenv('DIALOGFLOW_PROJECT_ID')
+    twilio_account_sid = os.getenv('TWILIO_ACCOUNT_SID')
+    twilio_auth_token = os.getenv('TWILIO_AUTH_TOKEN')
+    if not project_id or not twilio_account_sid or not twilio_auth_token:
+        log.error("detect_intent_audio_async - Missing Dialogflow project or Twilio credentials.")
+        record_nlp_error('audio', 'missing_config')
+        return None, None, None
+
+    audio_response = None
+    call = None
+    budget = voice_download_budget()
+    if budget is None:
+        return None, None, DEGRADED_VOICE_REPLY
+    download_timeout, download_deadline = budget
+    with stage_timer('nlp_audio'):
+        try:
+            log.debug("Downloading audio (async) for session %s from %s", session_id, audio_uri)
+            with stage_timer('media_download'):
+                audio_response = await get_http_session().get(
+                    audio_uri,
+                    auth=aiohttp.BasicAuth(twilio_account_sid, twilio_auth_token),
+                    timeout=aiohttp.ClientTimeout(total=None, sock_connect=download_timeout, sock_read=download_timeout),
+                )
+                audio_response.raise_for_status()
+                first_chunk = await audio_response.content.read(AUDIO_CHUNK_SIZE)
+
+            if not first_chunk:
+                log.warning("Audio content is empty after successful download attempt?")
+                record_nlp_error('audio', 'empty_audio')
+                return None, None, "Error processing downloaded audio."
+
+            if voice_preflight_enabled():
+                with stage_timer('media_download'):
+                    audio_content = await _read_voice_note_async(audio_response, first_chunk, download_deadline)
+                run_cache = cache_runner(get_voice_cache(), run)
+                cached, clip, cache, cache_key = await run_cache(_prepare_voice_note, session_id, audio_content, language_code)
+                if cached is not None:
+                    return cached
+                call = _admit_nlp_call('audio', 'DIALOGFLOW_AUDIO_TIMEOUT', DEFAULT_AUDIO_TIMEOUT)
+                if call is None:
+                    return None, None, DEGRADED_VOICE_REPLY
+                session_client = get_async_session_client()
+                response = await session_client.detect_intent(request={
+                    **_session_fields(session_client.session_path(project_id, session_id), session_id),
+                    "query_input": _audio_query_input(language_code, clip.sample_rate),
+                    "input_audio": clip.audio,
+                }, timeout=call.timeout)
+                _end_nlp_call(call)
+                return await run_cache(_audio_result, response.query_result, session_id, cache, cache_key)
+
+            call = _admit_nlp_call('audio', 'DIALOGFLOW_AUDIO_TIMEOUT', DEFAULT_AUDIO_TIMEOUT)
+            if call is None:
+                return None, None, DEGRADED_VOICE_REPLY
+            timeout = call.timeout
+            session_client = get_async_session_client()
+            session_path = session_client.session_path(project_id, session_id)
+            query_input = _audio_query_input(language_code)
+
+            if os.getenv('DIALOGFLOW_STREAMING_AUDIO', '1') == '1':
+                download_state = {'bytes': 0, 'error': None}
+                query_result = await _streaming_detect_intent_async(
+                    session_client, _session_fields(session_path, session_id), query_input, first_chunk, audio_response,
+                    download_state, timeout, download_deadline,
+                )
+                if download_state['error'] is not None:
+                    raise download_state['error']
+                log.debug("Audio streamed successfully (%d bytes).", download_state['bytes'])
+            else:
+                audio_content = first_chunk + await asyncio.wait_for(
+                    audio_response.content.read(), max(0.0, download_deadline - time.monotonic())
+                )
+                log.debug("Audio downloaded successfully (%d bytes).", len(audio_content))
+                response = await session_client.detect_intent(
+                    request={**_session_fields(session_path, session_id), "query_input": query_input, "input_audio": audio_content},
+                    timeout=timeout,
+                )
+                query_result = response.query_result
+
+            _end_nlp_call(call)
+            return _audio_result(query_result, session_id)
+
+        except VoiceNoteRejected as rejected:
+            return _voice_rejected(session_id, rejected)
+        except (BudgetExceeded, asyncio.TimeoutError) as timed_out: # Includes aiohttp's read timeouts
+            _end_nlp_call(call, timed_out)
+            return voice_download_timed_out(session_id, timed_out)
+        except aiohttp.ClientResponseError as http_err:
+            _end_nlp_call(call, http_err)
+            return _audio_download_error(session_id, http_err, http_err.status)
+        except aiohttp.ClientError as req_err:
+            _end_nlp_call(call, req_err)
+            return _audio_download_error(session_id, req_err)
+        except api_exceptions.GoogleAPICallError as api_error:
+            _end_nlp_call(call, api_error)
+            return _audio_api_error(api_error)
+        except Exception as e:
+            _end_nlp_call(call, e)
+            log.exception("Error processing audio (async) for session %s: %s", session_id, e)
+            record_nlp_error('audio', 'unexpected')
+            return None, None, "An unexpected error occurred while processing your voice message."
+        finally:
+            if audio_response is not None:
+                audio_response.release()
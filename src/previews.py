@@ -0,0 +1,248 @@
+# src/previews.py
+# Reviewer-friendly renditions of KYC uploads, made off the request path.
+# Once record_kyc_upload has committed a KycDocument, the original is handed to a small process
+# pool. The pool writes a recompressed preview and a thumbnail next to the original in the KYC
+# store; for a PDF it renders the first page. Their paths and sizes are then recorded on every
+# KycDocument that points at the same file.
+# - Decoding and resizing run in separate processes at a lower CPU priority, with a default
+#   worker count well below the CPU count, so they can't starve the request workers.
+# - At most KYC_PREVIEW_QUEUE_MAXSIZE files wait for a worker. Past that, files are skipped
+#   (the upload itself is unaffected); `flask kyc-previews` backfills anything missing.
+# Pillow (and pypdfium2 for PDFs) are optional. Without them, uploads are stored without previews.
+import functools
+import importlib.util
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+
+from .log import get_logger
+from .metrics import Counter, STAGE_SECONDS
+
+log = get_logger(__name__)
+
+PREVIEWS_TOTAL = Counter(
+    'lighthouse_kyc_previews_total', 'KYC preview requests by outcome.', ['outcome']
+)
+
+IMAGE_EXTENSIONS = ('png', 'jpg', 'jpeg')
+
+
+# --- Worker side (runs in the pool processes) ---
+
+def _lower_priority(niceness):
+    try:
+        os.nice(niceness)
+    except (AttributeError, OSError):
+        pass
+
+
+def _save_jpeg(image, path, size, quality):
+    """Writes a JPEG no larger than size x size pixels (atomically) and returns its byte size."""
+    copy = image.copy()
+    copy.thumbnail((size, size))
+    temp_path = f"{path}.{os.getpid()}.part"
+    copy.save(temp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+    os.replace(temp_path, path)
+    return os.path.getsize(path)
+
+
+def _open_pdf_page(source_path, size):
+    import pypdfium2
+
+    pdf = pypdfium2.PdfDocument(source_path)
+    try:
+        page = pdf[0]
+        width, height = page.get_size() # Points (1/72 inch)
+        bitmap = page.render(scale=size / max(width, height, 1))
+        return bitmap.to_pil(), len(pdf)
+    finally:
+        pdf.close()
+
+
+def render_previews(source_path, preview_path, thumbnail_path, preview_size, thumbnail_size):
+    """Renders the preview and thumbnail for one file. Returns their sizes, the page count and the render time."""
+    from PIL import Image, ImageOps
+
+    started = time.perf_counter()
+    if source_path.lower().endswith('.pdf'):
+        image, pages = _open_pdf_page(source_path, preview_size)
+        image = image.convert('RGB')
+    else:
+        with Image.open(source_path) as opened:
+            opened.draft('RGB', (preview_size, preview_size)) # Lets JPEG decode at reduced scale
+            image = ImageOps.exif_transpose(opened).convert('RGB')
+        pages = 1
+    return {
+        'preview_size': _save_jpeg(image, preview_path, preview_size, quality=80),
+        'thumbnail_size': _save_jpeg(image, thumbnail_path, thumbnail_size, quality=70),
+        'page_count': pages,
+        'seconds': time.perf_counter() - started,
+    }
+
+
+# --- Web process side ---
+
+def _extension(key):
+    return os.path.splitext(key)[1].lstrip('.').lower()
+
+
+class PreviewPool:
+    """Bounded process pool that renders KYC previews and records them on the KycDocument rows."""
+
+    def __init__(self, app, storage, workers, max_pending=32, preview_size=1600, thumbnail_size=320, niceness=10):
+        self.app = app
+        self.storage = storage
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.preview_size = preview_size
+        self.thumbnail_size = thumbnail_size
+        self.niceness = niceness
+        self.pdf_supported = importlib.util.find_spec('pypdfium2') is not None
+        self.pending = 0
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def supports(self, key):
+        extension = _extension(key)
+        return extension in IMAGE_EXTENSIONS or (extension == 'pdf' and self.pdf_supported)
+
+    def derived_keys(self, key):
+        base = os.path.splitext(key)[0]
+        return f"{base}.preview.jpg", f"{base}.thumb.jpg"
+
+    def _get_executor(self):
+        # Pool processes don't survive fork(), so create the pool in the process that serves requests.
+        # 'spawn' keeps the children clear of the parent's threads and gRPC state.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._executor = None
+            self.pending = 0
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_lower_priority, initargs=(self.niceness,),
+            )
+            log.info("Started %s KYC preview workers in process %s", self.workers, self._pid)
+        return self._executor
+
+    def submit(self, key, wait=False):
+        """Queues previews for a stored file. Returns False if the file was skipped (queue full or unsupported)."""
+        if not self.supports(key):
+            PREVIEWS_TOTAL.inc(outcome='unsupported')
+            return False
+        preview_key, thumbnail_key = self.derived_keys(key)
+        if self.storage.exists(preview_key) and self.storage.exists(thumbnail_key):
+            # Same bytes were uploaded before (possibly by another user); reuse the renditions
+            PREVIEWS_TOTAL.inc(outcome='reused')
+            self._record(key, preview_key, thumbnail_key, {
+                'preview_size': os.path.getsize(self.storage.path(preview_key)),
+                'thumbnail_size': os.path.getsize(self.storage.path(thumbnail_key)),
+            })
+            return True
+        with self._changed:
+            if wait:
+                self._changed.wait_for(lambda: self.pending < self.max_pending)
+            elif self.pending >= self.max_pending:
+                PREVIEWS_TOTAL.inc(outcome='dropped')
+                log.warning("KYC preview queue is full, skipping previews for %s.", key)
+                return False
+            args = (
+                render_previews, self.storage.path(key), self.storage.path(preview_key),
+                self.storage.path(thumbnail_key), self.preview_size, self.thumbnail_size,
+            )
+            try:
+                future = self._get_executor().submit(*args)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory); start a fresh pool
+                log.warning("KYC preview pool was broken, restarting it.")
+                self._executor = None
+                future = self._get_executor().submit(*args)
+            self.pending += 1
+        future.add_done_callback(functools.partial(self._finished, key, preview_key, thumbnail_key))
+        return True
+
+    def _finished(self, key, preview_key, thumbnail_key, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            PREVIEWS_TOTAL.inc(outcome='failed')
+            log.warning("Could not render previews for %s: %s", key, e)
+        else:
+            PREVIEWS_TOTAL.inc(outcome='rendered')
+            STAGE_SECONDS.observe(result.pop('seconds'), stage='kyc_preview')
+            with self.app.app_context():
+                self._record(key, preview_key, thumbnail_key, result)
+        finally:
+            with self._changed:
+                self.pending -= 1
+                self._changed.notify_all()
+
+    def _record(self, key, preview_key, thumbnail_key, result):
+        from .models import db, KycDocument
+
+        values = {
+            'preview_path': preview_key, 'preview_size': result['preview_size'],
+            'thumbnail_path': thumbnail_key, 'thumbnail_size': result['thumbnail_size'],
+            'previews_generated_at': datetime.utcnow(),
+        }
+        if 'page_count' in result:
+            values['page_count'] = result['page_count']
+        try:
+            KycDocument.query.filter_by(storage_path=key).update(values, synchronize_session=False)
+            db.session.commit()
+        except SQLAlchemyError as db_err:
+            db.session.rollback()
+            log.error("Error recording KYC previews for %s: %s", key, db_err)
+
+    def drain(self, timeout=None):
+        """Waits until every queued preview has finished (used by the backfill command)."""
+        with self._changed:
+            return self._changed.wait_for(lambda: self.pending == 0, timeout=timeout)
+
+    def stats(self):
+        return {'pending': self.pending, 'max_pending': self.max_pending, 'workers': self.workers}
+
+
+def default_preview_workers():
+    # Leave most cores to the request workers
+    return max(1, (os.cpu_count() or 2) // 4)
+
+
+def init_kyc_previews(app, storage):
+    """Sets up the preview pool unless KYC_PREVIEWS_ENABLED is off or Pillow is not installed."""
+    if not app.config.get('KYC_PREVIEWS_ENABLED', True):
+        return None
+    if importlib.util.find_spec('PIL') is None:
+        log.info("Pillow is not installed; KYC previews are disabled.")
+        return None
+    pool = PreviewPool(
+        app, storage,
+        workers=app.config.get('KYC_PREVIEW_WORKERS') or default_preview_workers(),
+        max_pending=app.config.get('KYC_PREVIEW_QUEUE_MAXSIZE', 32),
+        preview_size=app.config.get('KYC_PREVIEW_SIZE', 1600),
+        thumbnail_size=app.config.get('KYC_THUMBNAIL_SIZE', 320),
+    )
+    app.extensions['kyc_previews'] = pool
+    return pool
+
+
+def schedule_previews(key):
+    """Queues previews for a newly recorded upload; a no-op when previews are disabled."""
+    pool = current_app.extensions.get('kyc_previews')
+    if pool is None:
+        return False
+    try:
+        return pool.submit(key)
+    except Exception as e:
+        # Previews are a convenience; never fail the upload reply over them
+        log.error("Could not queue KYC previews for %s: %s", key, e)
+        return False
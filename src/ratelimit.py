@@ -0,0 +1,151 @@
+# src/ratelimit.py
+# Cheap admission control, checked before get_user and before any NLP call.
+# - SenderRateLimiter: token buckets keyed on the sender's number, with separate buckets for
+#   text, audio (voice notes) and other media, so one phone or a forwarded voice-note loop
+#   can't burn Dialogflow quota and worker time.
+# - LoadShedder: caps concurrent webhook requests per process, and lowers the cap while the
+#   recent Dialogflow error rate is high (piling on more calls would only make it worse).
+# Both are per worker process; limits effectively multiply by the number of workers.
+import threading
+import time
+from collections import OrderedDict, deque
+
+from .log import get_logger
+from .metrics import Counter, STAGE_SECONDS, NLP_ERRORS_TOTAL
+
+log = get_logger(__name__)
+
+RATE_LIMITED_TOTAL = Counter(
+    'lighthouse_rate_limited_total', 'Messages rejected by the per-sender rate limiter.', ['kind']
+)
+SHED_TOTAL = Counter(
+    'lighthouse_load_shed_total', 'Messages rejected because the process was at its concurrency cap.', ['reason']
+)
+
+RATE_LIMITED_REPLY = "You're sending messages too quickly. Please wait a minute and try again."
+SHED_REPLY = "We're receiving a lot of messages right now. Please try again in a few minutes."
+
+
+def message_kind(num_media, media_type):
+    """Bucket a message is charged to: 'text', 'audio' or 'media'."""
+    if num_media > 0 and media_type:
+        return 'audio' if media_type.startswith('audio/') else 'media'
+    return 'text'
+
+
+class SenderRateLimiter:
+    """Per-sender token buckets. limits maps kind -> (tokens per minute, burst size)."""
+
+    def __init__(self, limits, max_senders=100000):
+        self.limits = limits
+        self.max_senders = max_senders
+        self._buckets = OrderedDict() # (sender, kind) -> [tokens, last refill time]
+        self._lock = threading.Lock()
+
+    def allow(self, sender, kind):
+        limit = self.limits.get(kind)
+        if not limit or not sender:
+            return True
+        per_minute, burst = limit
+        now = time.monotonic()
+        key = (sender, kind)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(burst), now]
+                while len(self._buckets) > self.max_senders:
+                    self._buckets.popitem(last=False)
+            else:
+                bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * per_minute / 60.0)
+                bucket[1] = now
+            self._buckets.move_to_end(key)
+            if bucket[0] >= 1.0:
+                bucket[0] -= 1.0
+                return True
+        RATE_LIMITED_TOTAL.inc(kind=kind)
+        log.info("Rate limited %s message.", kind)
+        return False
+
+    def stats(self):
+        return {
+            'tracked_buckets': len(self._buckets),
+            'limited': {kind: RATE_LIMITED_TOTAL.value(kind=kind) for kind in self.limits},
+        }
+
+
+class LoadShedder:
+    """Concurrency cap that drops to degraded_cap while the Dialogflow error rate is above threshold."""
+
+    def __init__(self, max_in_flight, degraded_cap=None, error_threshold=0.5, window_seconds=30, min_calls=20):
+        self.max_in_flight = max_in_flight
+        self.degraded_cap = degraded_cap if degraded_cap is not None else max(1, max_in_flight // 4)
+        self.error_threshold = error_threshold
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._samples = deque() # (time, NLP calls, NLP errors) snapshots of the metrics counters
+        self._error_rate = 0.0
+
+    def _nlp_totals(self):
+        calls = STAGE_SECONDS.count(stage='nlp_text') + STAGE_SECONDS.count(stage='nlp_audio')
+        return calls, NLP_ERRORS_TOTAL.total()
+
+    def _update_error_rate(self, now):
+        # Caller holds self._lock; snapshots at most once a second
+        if self._samples and now - self._samples[-1][0] < 1.0:
+            return
+        calls, errors = self._nlp_totals()
+        self._samples.append((now, calls, errors))
+        while len(self._samples) > 1 and now - self._samples[0][0] > self.window_seconds:
+            self._samples.popleft()
+        _, first_calls, first_errors = self._samples[0]
+        window_calls = calls - first_calls
+        self._error_rate = (errors - first_errors) / window_calls if window_calls >= self.min_calls else 0.0
+
+    def current_cap(self):
+        return self.degraded_cap if self._error_rate >= self.error_threshold else self.max_in_flight
+
+    def try_acquire(self):
+        with self._lock:
+            self._update_error_rate(time.monotonic())
+            cap = self.current_cap()
+            if self.in_flight >= cap:
+                reason = 'nlp_errors' if cap < self.max_in_flight else 'capacity'
+            else:
+                self.in_flight += 1
+                return True
+        SHED_TOTAL.inc(reason=reason)
+        log.warning("Shedding load (in flight=%s, cap=%s, reason=%s).", self.in_flight, cap, reason)
+        return False
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight, 'max_in_flight': self.max_in_flight, 'current_cap': self.current_cap(),
+            'nlp_error_rate': round(self._error_rate, 3),
+            'shed': {reason: SHED_TOTAL.value(reason=reason) for reason in ('capacity', 'nlp_errors')},
+        }
+
+
+def init_rate_limiting(app):
+    """Sets up the per-sender limiter and the load shedder (each can be disabled separately)."""
+    if app.config.get('RATE_LIMIT_ENABLED', True):
+        app.extensions['rate_limiter'] = SenderRateLimiter(
+            {
+                'text': (app.config.get('RATE_LIMIT_TEXT_PER_MIN', 20), app.config.get('RATE_LIMIT_TEXT_BURST', 10)),
+                'audio': (app.config.get('RATE_LIMIT_AUDIO_PER_MIN', 6), app.config.get('RATE_LIMIT_AUDIO_BURST', 3)),
+                'media': (app.config.get('RATE_LIMIT_MEDIA_PER_MIN', 6), app.config.get('RATE_LIMIT_MEDIA_BURST', 3)),
+            },
+            max_senders=app.config.get('RATE_LIMIT_MAX_SENDERS', 100000),
+        )
+    max_in_flight = app.config.get('MAX_IN_FLIGHT_REQUESTS', 0)
+    if max_in_flight > 0:
+        app.extensions['load_shedder'] = LoadShedder(
+            max_in_flight,
+            degraded_cap=app.config.get('DEGRADED_IN_FLIGHT_REQUESTS') or None,
+            error_threshold=app.config.get('SHED_NLP_ERROR_RATE', 0.5),
+        )
@@ -0,0 +1,150 @@
+# src/storage.py
+# Content-addressed store for KYC uploads.
+# Files are hashed (SHA-256) while they stream to disk and filed under their hash in a sharded
+# layout (ab/cd/abcd...ef.jpeg), so no directory grows past a few hundred entries and the same
+# bytes are only ever stored once. KycDocument.storage_path holds the returned key.
+# Downloads are written to a temporary file first and abandoned as soon as they pass the size
+# limit; only complete files are moved into place (an atomic rename on the same filesystem).
+import hashlib
+import os
+import tempfile
+from collections import namedtuple
+
+from flask import current_app
+
+from .log import get_logger
+
+log = get_logger(__name__)
+
+StoredObject = namedtuple('StoredObject', ['key', 'sha256', 'size', 'created'])
+
+
+class StorageError(Exception):
+    """A file could not be stored."""
+
+
+class UploadTooLarge(StorageError):
+    """The upload passed the configured size limit."""
+
+    def __init__(self, max_bytes):
+        super().__init__(f"Upload exceeds {max_bytes} bytes")
+        self.max_bytes = max_bytes
+
+
+class PendingUpload:
+    """A file being written: write() chunks as they arrive, then commit() or abort()."""
+
+    def __init__(self, storage, max_bytes=None):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._file = storage._open_temp()
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        self.size += len(chunk)
+        if self.max_bytes and self.size > self.max_bytes:
+            self.abort()
+            raise UploadTooLarge(self.max_bytes)
+        self._hash.update(chunk)
+        self._file.write(chunk)
+
+    def commit(self, extension):
+        """Moves the finished file to its content address and returns a StoredObject."""
+        digest = self._hash.hexdigest()
+        self._file.close()
+        try:
+            return self.storage._publish(self._file.name, digest, extension, self.size)
+        except OSError as e:
+            self.abort()
+            raise StorageError(str(e)) from e
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.unlink(self._file.name)
+        except FileNotFoundError:
+            pass
+
+
+class LocalFileStorage:
+    """Content-addressed files under a local directory, sharded by hash prefix."""
+
+    def __init__(self, root, shard_depth=2, shard_width=2):
+        self.root = root
+        self.shard_depth = shard_depth
+        self.shard_width = shard_width
+        self._incoming = os.path.join(root, '.incoming') # Same filesystem, so commits are a rename
+
+    def key_for(self, digest, extension):
+        shards = [digest[i * self.shard_width:(i + 1) * self.shard_width] for i in range(self.shard_depth)]
+        return '/'.join(shards + [f"{digest}.{extension}"])
+
+    def path(self, key):
+        # Older uploads were stored flat, so their key is just a filename; both resolve here
+        return os.path.join(self.root, *key.split('/'))
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def begin(self, max_bytes=None):
+        return PendingUpload(self, max_bytes)
+
+    def save_stream(self, chunks, extension, max_bytes=None):
+        """Stores an iterable of byte chunks; raises UploadTooLarge past max_bytes."""
+        upload = self.begin(max_bytes)
+        try:
+            for chunk in chunks:
+                upload.write(chunk)
+        except BaseException:
+            upload.abort()
+            raise
+        return upload.commit(extension)
+
+    def _open_temp(self):
+        try:
+            os.makedirs(self._incoming, exist_ok=True)
+            return tempfile.NamedTemporaryFile(dir=self._incoming, suffix='.part', delete=False)
+        except OSError as e:
+            raise StorageError(str(e)) from e
+
+    def _publish(self, temp_path, digest, extension, size):
+        key = self.key_for(digest, extension)
+        final_path = self.path(key)
+        if os.path.exists(final_path):
+            os.unlink(temp_path) # Same bytes already stored
+            log.debug("Upload %s already stored, keeping the existing copy.", key)
+            return StoredObject(key, digest, size, False)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(temp_path, final_path)
+        return StoredObject(key, digest, size, True)
+
+
+_BACKENDS = {'local': LocalFileStorage}
+
+
+def make_storage(backend, **options):
+    """Builds a storage backend by name ('local')."""
+    try:
+        factory = _BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown KYC storage backend: {backend}") from None
+    return factory(**options)
+
+
+def init_kyc_storage(app):
+    """Sets up the KYC upload store from KYC_STORAGE_* config."""
+    storage = make_storage(
+        app.config.get('KYC_STORAGE_BACKEND', 'local'), root=app.config.get('KYC_STORAGE_ROOT', '/app/uploads'),
+    )
+    app.extensions['kyc_storage'] = storage
+    return storage
+
+
+def get_kyc_storage(app=None):
+    return (app or current_app).extensions['kyc_storage']
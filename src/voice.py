@@ -0,0 +1,187 @@
+# src/voice.py
+# Local pre-flight checks for voice notes, run before anything is sent to Dialogflow.
+# WhatsApp voice notes are Opus in an Ogg container. Reading the container headers and the Opus
+# packet table of contents (no decoding) gives the channel count, the encoder's sample rate, the
+# exact duration and a rough measure of how much of the clip carries sound:
+# - clips that aren't Ogg/Opus, are unreadable, aren't mono or are silent are rejected locally;
+# - clips longer than Dialogflow accepts are cut at an Ogg page boundary (the last kept page is
+#   marked end-of-stream and re-checksummed), so the command at the start still gets through;
+# - the sample rate sent with the request comes from the OpusHead header instead of being assumed.
+import struct
+from collections import namedtuple
+
+OGG_CAPTURE = b'OggS'
+OGG_HEADER = struct.Struct('<4sBBqIIIB') # capture, version, header type, granule, serial, sequence, crc, segments
+OGG_EOS = 0x04
+OPUS_RATE = 48000 # Opus granule positions always count 48 kHz samples
+# Sample rates Dialogflow accepts for OGG_OPUS; other encoder rates are sent as 48 kHz (the decode rate)
+SUPPORTED_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+# A packet below this bitrate is treated as silence (DTX or comfort-noise frames are a few bytes)
+SILENCE_BITRATE = 3000
+
+OpusInfo = namedtuple('OpusInfo', ['channels', 'input_sample_rate', 'pre_skip', 'duration', 'speech_seconds', 'pages'])
+VoiceClip = namedtuple('VoiceClip', ['audio', 'sample_rate', 'duration', 'speech_seconds', 'trimmed'])
+_Page = namedtuple('_Page', ['offset', 'end', 'header_type', 'granule', 'serial', 'lacing'])
+
+
+class VoiceNoteRejected(ValueError):
+    """The clip would fail (or is pointless) to recognise; reason is a short metric label."""
+
+    def __init__(self, reason, detail=''):
+        super().__init__(f"{reason}: {detail}" if detail else reason)
+        self.reason = reason
+
+
+# --- Ogg framing ---
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+
+_CRC_TABLE = _crc_table()
+
+
+def ogg_crc(data):
+    """Ogg page checksum (CRC-32, polynomial 0x04C11DB7, no reflection, zero initial value)."""
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ _CRC_TABLE[((crc >> 24) ^ byte) & 0xFF]
+    return crc
+
+
+def _pages(data):
+    offset = 0
+    while offset < len(data):
+        if data[offset:offset + 4] != OGG_CAPTURE:
+            raise VoiceNoteRejected('corrupt', f"no Ogg page at byte {offset}")
+        if offset + OGG_HEADER.size > len(data):
+            raise VoiceNoteRejected('corrupt', "truncated page header")
+        _, version, header_type, granule, serial, _, _, segments = OGG_HEADER.unpack_from(data, offset)
+        if version != 0:
+            raise VoiceNoteRejected('corrupt', f"Ogg version {version}")
+        lacing = data[offset + OGG_HEADER.size:offset + OGG_HEADER.size + segments]
+        end = offset + OGG_HEADER.size + segments + sum(lacing)
+        if len(lacing) < segments or end > len(data):
+            raise VoiceNoteRejected('corrupt', "truncated page")
+        yield _Page(offset, end, header_type, granule, serial, lacing)
+        offset = end
+
+
+def _packets(data, pages):
+    """Yields complete packets (as memoryviews) from pages of one logical stream."""
+    view = memoryview(data)
+    pending = []
+    for page in pages:
+        position = page.offset + OGG_HEADER.size + len(page.lacing)
+        start = position
+        for value in page.lacing:
+            position += value
+            if value < 255: # A lacing value below 255 ends the packet
+                pending.append(view[start:position])
+                yield pending[0] if len(pending) == 1 else memoryview(b''.join(pending))
+                pending = []
+                start = position
+        if start < position:
+            pending.append(view[start:position]) # Continues on the next page
+
+
+# --- Opus ---
+
+def opus_packet_samples(packet):
+    """Duration of an Opus packet in 48 kHz samples, from its TOC byte (RFC 6716, section 3.1)."""
+    if not packet:
+        return 0
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12: # SILK: 10, 20, 40, 60 ms
+        frame = (480, 960, 1920, 2880)[config % 4]
+    elif config < 16: # Hybrid: 10, 20 ms
+        frame = (480, 960)[config % 2]
+    else: # CELT: 2.5, 5, 10, 20 ms
+        frame = (120, 240, 480, 960)[config % 4]
+    code = toc & 0x03
+    if code == 0:
+        frames = 1
+    elif code in (1, 2):
+        frames = 2
+    else:
+        frames = packet[1] & 0x3F if len(packet) > 1 else 0
+    return frame * frames
+
+
+def inspect_ogg_opus(data):
+    """Reads an Ogg/Opus file's headers and packet table. Raises VoiceNoteRejected if it can't be used."""
+    if data[:4] != OGG_CAPTURE:
+        raise VoiceNoteRejected('unsupported_format', "not an Ogg file")
+    pages = list(_pages(data))
+    serial = pages[0].serial
+    if any(page.serial != serial for page in pages):
+        raise VoiceNoteRejected('unsupported_format', "multiplexed Ogg streams")
+
+    packets = _packets(data, pages)
+    head = next(packets, None)
+    if head is None or bytes(head[:8]) != b'OpusHead' or len(head) < 19:
+        raise VoiceNoteRejected('unsupported_format', "not an Opus stream")
+    channels = head[9]
+    pre_skip, input_sample_rate = struct.unpack_from('<HI', head, 10)
+    tags = next(packets, None)
+    if tags is None or bytes(tags[:8]) != b'OpusTags':
+        raise VoiceNoteRejected('corrupt', "missing OpusTags header")
+
+    samples = speech_samples = 0
+    for packet in packets:
+        packet_samples = opus_packet_samples(packet)
+        samples += packet_samples
+        if packet_samples and len(packet) * 8 * OPUS_RATE >= SILENCE_BITRATE * packet_samples:
+            speech_samples += packet_samples
+    # The last granule position is exact (it accounts for end trimming); the packet sum is the fallback
+    granules = [page.granule for page in pages if page.granule >= 0]
+    total = granules[-1] if granules and granules[-1] > 0 else samples
+    return OpusInfo(
+        channels, input_sample_rate, pre_skip, max(0, total - pre_skip) / OPUS_RATE,
+        speech_samples / OPUS_RATE, pages,
+    )
+
+
+def trim_ogg_opus(data, info, max_seconds):
+    """Cuts the stream after the last page that ends within max_seconds and marks that page end-of-stream.
+    Returns (audio, duration in seconds)."""
+    limit = info.pre_skip + int(max_seconds * OPUS_RATE)
+    keep = None
+    for page in info.pages:
+        if page.granule <= 0: # Header pages have granule 0; -1 means no packet ends on the page
+            continue
+        if page.granule > limit and keep is not None:
+            break
+        keep = page
+    if keep is None or keep.end >= len(data):
+        return data, info.duration
+    page = bytearray(data[keep.offset:keep.end])
+    page[5] |= OGG_EOS
+    page[22:26] = b'\0\0\0\0' # The checksum covers the page with its own field zeroed
+    page[22:26] = struct.pack('<I', ogg_crc(page))
+    return data[:keep.offset] + bytes(page), (keep.granule - info.pre_skip) / OPUS_RATE
+
+
+def preflight_voice_note(data, max_seconds=55.0, min_speech_seconds=0.3, default_sample_rate=16000):
+    """Checks a downloaded voice note and returns the VoiceClip to send (trimmed if needed).
+    Raises VoiceNoteRejected for clips Dialogflow would reject or could only answer with 'no speech'."""
+    info = inspect_ogg_opus(data)
+    if info.channels != 1:
+        raise VoiceNoteRejected('channels', f"{info.channels} channels")
+    if info.speech_seconds < min_speech_seconds:
+        raise VoiceNoteRejected('silent', f"{info.speech_seconds:.2f}s of sound in {info.duration:.1f}s")
+    audio, duration = data, info.duration
+    if max_seconds and duration > max_seconds:
+        audio, duration = trim_ogg_opus(data, info, max_seconds)
+    if info.input_sample_rate in SUPPORTED_SAMPLE_RATES:
+        sample_rate = info.input_sample_rate
+    else:
+        sample_rate = OPUS_RATE if info.input_sample_rate else default_sample_rate
+    return VoiceClip(audio, sample_rate, duration, info.speech_seconds, len(audio) < len(data))
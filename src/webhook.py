@@ -1,6 +1,6 @@
 # src/webhook.py (Complete, Corrected, Calls *_params Handlers)
 
-from flask import Blueprint, request
+from flask import Blueprint, request, current_app, has_request_context
 from twilio.twiml.messaging_response import MessagingResponse
 from datetime import datetime, date
 from decimal import Decimal # Although not used directly here, good practice if dealing with numbers
@@ -9,6 +9,14 @@ import os # Import os to potentially check env vars if needed
 # Relative imports from within the 'src' package
 from .models import User
 from .nlp import detect_intent_text, detect_intent_audio
+from .intents import match_local_intent
+from .conversation import SLOTS, is_filled, missing_slots
+from .jobs import get_job_queue, send_whatsapp_message
+from .log import get_logger, bind_request
+from .breaker import start_deadline, end_deadline
+from .metrics import INTENTS_TOTAL, REQUEST_SECONDS, stage_timer
+from .ratelimit import message_kind, RATE_LIMITED_REPLY, SHED_REPLY
+from .bulk_salary import is_salary_sheet, parse_message_lines, handle_bulk_log_salary, handle_salary_sheet_upload
 # Import the CORRECTED parameter-accepting handlers
 from .commands import (
     get_user,
@@ -17,11 +25,14 @@ from .commands import (
     handle_salary_inquiry,
     handle_log_salary_params, # Use PARAMETER version
     handle_media_upload,
+    handle_hours_inquiry,
+    handle_roster_summary,
     get_fallback_message,
     get_dialogflow_param # Import the helper function
 )
 
 webhook_bp = Blueprint('webhook', __name__)
+log = get_logger(__name__)
 
 # Helper function for date formatting
 # Moved from commands.py to avoid potential circular imports if commands needed it too
@@ -37,12 +48,207 @@ def format_dialogflow_date(date_param):
         dt_obj = datetime.fromisoformat(iso_date_str.split('T')[0].split('+')[0].split('Z')[0])
         return dt_obj.strftime("%Y-%m-%d")
     except Exception as e:
-        print(f"Error parsing Dialogflow date param: {param_val}. Error: {e}")
+        log.warning("Error parsing Dialogflow date param: %s. Error: %s", param_val, e)
         return None
 
+def _debug_requested(sender_whatsapp_number):
+    """Per-request debug logging: listed senders, or an X-Debug-Log header matching LOG_DEBUG_TOKEN."""
+    if sender_whatsapp_number in current_app.config.get('LOG_DEBUG_SENDERS', ()):
+        return True
+    token = current_app.config.get('LOG_DEBUG_TOKEN')
+    return bool(token) and has_request_context() and request.headers.get('X-Debug-Log') == token
+
+
+def route_intent(user, sender_whatsapp_number, intent_name, parameters, dialogflow_reply, incoming_msg_body):
+    """Runs the command handler for a detected intent and returns the reply text."""
+    log.debug("Processing step: Intent Routing (%s)", intent_name)
+
+    # Safely get parameters dictionary (it's a Struct, use .get)
+    # Parameters might be None if detect_intent failed but somehow intent_name was set (unlikely)
+    params_dict = parameters if parameters else {}
+
+    # Commands with required parameters continue an unfinished one (slot filling, see conversation.py)
+    conversations = current_app.extensions.get('conversations') if intent_name in SLOTS else None
+    prompt = dialogflow_reply
+    if conversations is not None:
+        missing = missing_slots(intent_name, params_dict)
+        params_dict = conversations.fill(sender_whatsapp_number, intent_name, params_dict)
+        if missing_slots(intent_name, params_dict) != missing:
+            prompt = None # Dialogflow's prompt may ask for something given in an earlier message
+
+    # --- Route based on intent name ---
+    if intent_name == 'RegisterUser':
+        sampatti_id_param = params_dict.get('sampatti_id')
+        role_param = params_dict.get('role')
+        # Check if required params were actually extracted by Dialogflow
+        if is_filled(sampatti_id_param) and is_filled(role_param):
+             reply_message = handle_register_params(sender_whatsapp_number, sampatti_id_param, role_param)
+        elif conversations is not None:
+             reply_message = conversations.ask(sender_whatsapp_number, intent_name, params_dict, prompt)
+        else:
+             # Parameters missing, use Dialogflow's prompt/fulfillment text
+             reply_message = dialogflow_reply or "Please provide the missing registration details (ID and Role)."
+
+    elif intent_name == 'CheckIn':
+        reply_message = handle_attendance(user, 'checkin')
+    elif intent_name == 'CheckOut':
+        reply_message = handle_attendance(user, 'checkout')
+    elif intent_name == 'SalaryInquiry':
+        reply_message = handle_salary_inquiry(user)
+    elif intent_name == 'HoursInquiry':
+        reply_message = handle_hours_inquiry(user, params_dict.get('period'))
+    elif intent_name == 'RosterSummary':
+        reply_message = handle_roster_summary(user, params_dict.get('period'))
+    elif intent_name == 'LogSalary':
+        sampatti_id_param = params_dict.get('sampatti_id')
+        amount_param = params_dict.get('amount') # Renamed parameter
+        date_param = params_dict.get('date')     # Raw DF date param
+        notes_param = params_dict.get('notes')   # Optional notes
+
+        # Check required params (amount can be 0)
+        if is_filled(sampatti_id_param) and is_filled(amount_param):
+            reply_message = handle_log_salary_params(user, sampatti_id_param, amount_param, date_param, notes_param)
+        elif conversations is not None:
+            reply_message = conversations.ask(sender_whatsapp_number, intent_name, params_dict, prompt)
+        else:
+             # Use Dialogflow's prompt if available
+             reply_message = dialogflow_reply or "Please provide the missing salary details (Worker ID, Amount)."
+
+    elif intent_name == 'BulkLogSalary':
+        reply_message = handle_bulk_log_salary(user, parse_message_lines(params_dict.get('entries') or ''))
+
+    elif intent_name == 'Default Welcome Intent':
+         # Usually just reply with Dialogflow's configured welcome message
+         reply_message = dialogflow_reply or "Hello! How can I help?"
+    elif intent_name == 'Default Fallback Intent':
+         # Use Dialogflow's fallback response, or generate our own
+         reply_message = dialogflow_reply or get_fallback_message(user, incoming_msg_body)
+    else: # Intent detected by Dialogflow but not explicitly handled above
+         log.warning("Intent '%s' detected but not explicitly handled in webhook.", intent_name)
+         reply_message = dialogflow_reply or f"I understood you want to '{intent_name}', but I don't have a specific action for that yet."
+
+    if conversations is not None and not missing_slots(intent_name, params_dict):
+        conversations.clear(sender_whatsapp_number) # Completed by Dialogflow or in one message
+
+    return reply_message
+
+
+def reply_for_audio_intent(user, sender_whatsapp_number, intent_name, parameters, dialogflow_reply, incoming_msg_body=''):
+    """Turns a detect_intent_audio result into the reply text (never None)."""
+    # Set reply message ONLY if audio processing itself indicates an error/no match
+    if intent_name is None and dialogflow_reply is None:
+         return "Sorry, I encountered an error processing your voice message."
+    elif not intent_name and dialogflow_reply: # e.g., No speech, no match but got fallback
+         return dialogflow_reply
+    reply_message = None
+    if intent_name:
+        INTENTS_TOTAL.inc(intent=intent_name, source='audio')
+        reply_message = route_intent(user, sender_whatsapp_number, intent_name, parameters, dialogflow_reply, incoming_msg_body)
+    return reply_message or get_fallback_message(user, incoming_msg_body)
+
+
+def render_twiml(reply_message):
+    """Wraps the reply in TwiML for Twilio."""
+    with stage_timer('twiml_render'):
+        response = MessagingResponse()
+        # Ensure we always have a string message to send
+        response.message(reply_message if reply_message else "Sorry, an unexpected error occurred. Please try again.")
+        return str(response)
+
+
+def process_media_message(user, sender_whatsapp_number, media_url, media_type, language_code, incoming_msg_body=''):
+    """Handles a voice note or KYC file end to end and returns the reply text (never None)."""
+    if media_type.startswith('audio/'):
+        log.debug("Processing step: Audio Processing")
+        # Call Dialogflow audio detection
+        intent_name, parameters, dialogflow_reply = detect_intent_audio(
+            session_id=sender_whatsapp_number, audio_uri=media_url, language_code=language_code
+        )
+        return reply_for_audio_intent(user, sender_whatsapp_number, intent_name, parameters, dialogflow_reply, incoming_msg_body)
+
+    elif media_type.startswith(('image/', 'application/pdf')):
+        log.debug("Processing step: KYC/File Upload Processing")
+        if not user:
+             return "Please register before uploading files. Send: register <ID> <role>"
+        # This bypasses NLP for now, directly calls handler
+        reply_message = handle_media_upload(user, media_url, media_type)
+        if not reply_message: # Ensure handler returned something
+             reply_message = "Error: File upload processing failed unexpectedly."
+        return reply_message
+
+    elif is_salary_sheet(media_type):
+        log.debug("Processing step: Salary Sheet Upload")
+        return handle_salary_sheet_upload(user, media_url, media_type)
+
+    log.info("Processing step: Unsupported Media - Type: %s", media_type)
+    return "Sorry, I can only process voice messages, images, PDF files and salary sheets (CSV/Excel) right now."
+
+
+def run_media_job(payload):
+    """Background job: processes a queued media message and sends the reply via the Twilio REST API."""
+    sender_whatsapp_number = payload['sender']
+    bind_request(payload.get('message_sid'), sender_whatsapp_number, debug=_debug_requested(sender_whatsapp_number))
+    reply_message = payload.get('reply')
+    if reply_message is None:
+        # Look the user up again; registration may have changed since the message was queued
+        user = get_user(sender_whatsapp_number)
+        reply_message = process_media_message(
+            user, sender_whatsapp_number, payload['media_url'], payload['media_type'],
+            payload.get('language_code', 'en'), payload.get('body', '')
+        )
+        # Keep the computed reply so a retry only re-sends it instead of re-processing the media
+        payload['reply'] = reply_message
+    send_whatsapp_message(sender_whatsapp_number, reply_message)
+
+
 @webhook_bp.route('/webhook/whatsapp', methods=['POST'])
 def whatsapp_webhook():
     """Handles incoming WhatsApp messages via Twilio, using Dialogflow for text/audio."""
+    kind = 'media' if int(request.form.get('NumMedia', 0)) > 0 else 'text'
+    # Twilio's clock starts now; NLP calls get what is left of WEBHOOK_DEADLINE_SECONDS as their timeout
+    deadline = start_deadline(current_app.config.get('WEBHOOK_DEADLINE_SECONDS'))
+    try:
+        with REQUEST_SECONDS.time(kind=kind):
+            message_sid = request.form.get('MessageSid')
+            sender_whatsapp_number = request.form.get('From', '')
+            bind_request(message_sid, sender_whatsapp_number, debug=_debug_requested(sender_whatsapp_number))
+            # Twilio retries slow deliveries; answer a repeated MessageSid from the stored reply
+            dedup = current_app.extensions.get('message_dedup')
+            if dedup is None or not message_sid:
+                return _admit_and_handle()
+            stored_twiml = dedup.claim(message_sid)
+            if stored_twiml is not None:
+                return stored_twiml
+            try:
+                twiml = _admit_and_handle()
+            except Exception:
+                dedup.release(message_sid)
+                raise
+            dedup.complete(message_sid, twiml)
+            return twiml
+    finally:
+        end_deadline(deadline)
+
+
+def _admit_and_handle():
+    """Per-sender rate limit and load shedding, checked before the user lookup and any NLP."""
+    limiter = current_app.extensions.get('rate_limiter')
+    if limiter is not None:
+        kind = message_kind(int(request.form.get('NumMedia', 0)), request.form.get('MediaContentType0'))
+        if not limiter.allow(request.form.get('From', ''), kind):
+            return render_twiml(RATE_LIMITED_REPLY)
+    shedder = current_app.extensions.get('load_shedder')
+    if shedder is None:
+        return _handle_whatsapp_message()
+    if not shedder.try_acquire():
+        return render_twiml(SHED_REPLY)
+    try:
+        return _handle_whatsapp_message()
+    finally:
+        shedder.release()
+
+
+def _handle_whatsapp_message():
     incoming_msg_body = request.form.get('Body', '').strip()
     sender_whatsapp_number = request.form.get('From', '')
     session_id = sender_whatsapp_number # Use sender's number as a unique session ID for Dialogflow
@@ -57,141 +263,92 @@ def whatsapp_webhook():
     dialogflow_reply = None # Default text reply from Dialogflow intent
     processing_step = "Start"
 
-    print(f"--- Incoming WhatsApp Message ---")
-    print(f"From: {sender_whatsapp_number}")
-    print(f"Body: '{incoming_msg_body}'")
-    print(f"NumMedia: {num_media}")
-    print(f"MediaUrl0: {media_url}")
-    print(f"MediaContentType0: {media_type}")
-    print(f"-------------------------------")
+    bind_request(request.form.get('MessageSid'), sender_whatsapp_number, debug=_debug_requested(sender_whatsapp_number))
+    log.debug(
+        "Incoming WhatsApp message: Body='%s' NumMedia=%s MediaUrl0=%s MediaContentType0=%s",
+        incoming_msg_body, num_media, media_url, media_type
+    )
 
     # Fetch user early if possible, determine language
     user = get_user(sender_whatsapp_number)
     # Default to English if user not found or preference not set
     language_code = user.language_preference if user and user.language_preference else 'en'
-    print(f"Determined Language Code: {language_code}")
+    log.debug("Determined Language Code: %s", language_code)
 
     # --- Processing Logic ---
 
     # == PRIORITY 1: Handle Incoming Media ==
     if num_media > 0 and media_url and media_type:
         processing_step = "Media Detected"
-        print(f"Processing step: {processing_step}")
-        if media_type.startswith('audio/'):
-            processing_step = "Audio Processing"
-            print(f"Processing step: {processing_step}")
-            # Call Dialogflow audio detection
-            intent_name, parameters, dialogflow_reply = detect_intent_audio(
-                session_id=session_id, audio_uri=media_url, language_code=language_code
-            )
-            # Set reply message ONLY if audio processing itself indicates an error/no match
-            if intent_name is None and dialogflow_reply is None:
-                 reply_message = "Sorry, I encountered an error processing your voice message."
-            elif not intent_name and dialogflow_reply: # e.g., No speech, no match but got fallback
-                 reply_message = dialogflow_reply
-
-        elif media_type.startswith(('image/', 'application/pdf')):
-            processing_step = "KYC/File Upload Processing"
-            print(f"Processing step: {processing_step}")
-            if not user:
-                 reply_message = "Please register before uploading files. Send: register <ID> <role>"
-            else:
-                 # This bypasses NLP for now, directly calls handler
-                 reply_message = handle_media_upload(user, media_url, media_type)
-                 if not reply_message: # Ensure handler returned something
-                      reply_message = "Error: File upload processing failed unexpectedly."
+        log.debug("Processing step: %s", processing_step)
+        job_queue = get_job_queue()
+        if job_queue is not None and media_type.startswith(('audio/', 'image/', 'application/pdf')):
+            # Async mode: acknowledge Twilio now, the worker pool replies via the REST API
+            processing_step = "Media Enqueued"
+            queued = job_queue.enqueue({
+                'sender': sender_whatsapp_number, 'media_url': media_url, 'media_type': media_type,
+                'language_code': language_code, 'body': incoming_msg_body,
+                'message_sid': request.form.get('MessageSid'),
+            })
+            if queued:
+                log.info("Processing step: %s", processing_step)
+                return str(MessagingResponse())
+            # Queue full (backpressure): tell the user instead of blocking a web worker
+            log.warning("Media job queue is full, rejecting message.")
+            reply_message = "We're receiving a lot of messages right now. Please send your file or voice message again in a few minutes."
         else:
-            processing_step = "Unsupported Media"
-            print(f"Processing step: {processing_step} - Type: {media_type}")
-            reply_message = "Sorry, I can only process voice messages, images, and PDF files right now."
+            reply_message = process_media_message(
+                user, sender_whatsapp_number, media_url, media_type, language_code, incoming_msg_body
+            )
 
     # == PRIORITY 2: Handle Text Input via Dialogflow ==
     elif incoming_msg_body: # No media, but text is present
         processing_step = "Text Processing"
-        print(f"Processing step: {processing_step}")
-        # Call Dialogflow text detection only if audio didn't already find an intent
-        if intent_name is None:
+        log.debug("Processing step: %s", processing_step)
+        # An answer to a question from an unfinished command ('register' -> ID?) is read locally
+        conversations = current_app.extensions.get('conversations')
+        if conversations is not None:
+            intent_name, parameters, reply_message = conversations.resume(sender_whatsapp_number, incoming_msg_body, language_code)
+        # Try the local command matcher first; it avoids a Dialogflow round trip for literal commands
+        if intent_name is None and reply_message is None and current_app.config.get('LOCAL_INTENT_MATCHING', True):
+            intent_name, parameters, dialogflow_reply = match_local_intent(incoming_msg_body, language_code)
+            if intent_name:
+                log.debug("Local intent match: Intent='%s', Params='%s'", intent_name, parameters)
+                INTENTS_TOTAL.inc(intent=intent_name, source='local')
+        # Call Dialogflow text detection only if the local matcher found no intent
+        # (while Dialogflow is unavailable it answers from the degraded local parser instead)
+        if intent_name is None and reply_message is None:
             intent_name, parameters, dialogflow_reply = detect_intent_text(
                 session_id=session_id, text=incoming_msg_body, language_code=language_code
             )
             if intent_name is None and dialogflow_reply is None:
                  reply_message = "Sorry, I'm having trouble understanding that command (text error)."
+            # Intents are counted in nlp.py (source 'dialogflow', or 'degraded' while Dialogflow is down).
             # If intent is None but dialogflow_reply exists (e.g., fallback matched),
             # the routing block might use dialogflow_reply later.
 
     # == PRIORITY 3: Handle Empty Messages ==
     elif not incoming_msg_body and num_media == 0:
          processing_step = "Empty Message Received"
-         print(f"Processing step: {processing_step}")
+         log.debug("Processing step: %s", processing_step)
          # No intent possible here, fallback will be triggered later
 
     # --- Route to Command Handlers or Use Default Replies ---
-    # Execute if NO definitive reply set previously AND an intent WAS found (by audio or text)
+    # Execute if NO definitive reply set previously AND an intent WAS found
     if reply_message is None and intent_name:
         processing_step = f"Intent Routing ({intent_name})"
-        print(f"Processing step: {processing_step}")
-
-        # Safely get parameters dictionary (it's a Struct, use .get)
-        # Parameters might be None if detect_intent failed but somehow intent_name was set (unlikely)
-        params_dict = parameters if parameters else {}
-
-        # --- Route based on intent name ---
-        if intent_name == 'RegisterUser':
-            sampatti_id_param = params_dict.get('sampatti_id')
-            role_param = params_dict.get('role')
-            # Check if required params were actually extracted by Dialogflow
-            if sampatti_id_param is not None and role_param is not None:
-                 reply_message = handle_register_params(sender_whatsapp_number, sampatti_id_param, role_param)
-            else:
-                 # Parameters missing, use Dialogflow's prompt/fulfillment text
-                 reply_message = dialogflow_reply or "Please provide the missing registration details (ID and Role)."
-
-        elif intent_name == 'CheckIn':
-            reply_message = handle_attendance(user, 'checkin')
-        elif intent_name == 'CheckOut':
-            reply_message = handle_attendance(user, 'checkout')
-        elif intent_name == 'SalaryInquiry':
-            reply_message = handle_salary_inquiry(user)
-        elif intent_name == 'LogSalary':
-            sampatti_id_param = params_dict.get('sampatti_id')
-            amount_param = params_dict.get('amount') # Renamed parameter
-            date_param = params_dict.get('date')     # Raw DF date param
-            notes_param = params_dict.get('notes')   # Optional notes
-
-            # Check required params (amount can be 0)
-            if sampatti_id_param is not None and amount_param is not None:
-                reply_message = handle_log_salary_params(user, sampatti_id_param, amount_param, date_param, notes_param)
-            else:
-                 # Use Dialogflow's prompt if available
-                 reply_message = dialogflow_reply or "Please provide the missing salary details (Worker ID, Amount)."
-
-        elif intent_name == 'Default Welcome Intent':
-             # Usually just reply with Dialogflow's configured welcome message
-             reply_message = dialogflow_reply or "Hello! How can I help?"
-        elif intent_name == 'Default Fallback Intent':
-             # Use Dialogflow's fallback response, or generate our own
-             reply_message = dialogflow_reply or get_fallback_message(user, incoming_msg_body)
-        else: # Intent detected by Dialogflow but not explicitly handled above
-             print(f"WARN: Intent '{intent_name}' detected but not explicitly handled in webhook.")
-             reply_message = dialogflow_reply or f"I understood you want to '{intent_name}', but I don't have a specific action for that yet."
+        reply_message = route_intent(user, sender_whatsapp_number, intent_name, parameters, dialogflow_reply, incoming_msg_body)
 
     # --- Final Fallback Section ---
     # If after all the above, reply_message is still None (e.g., empty message, or NLP error with no reply)
     elif reply_message is None:
         processing_step = "Final Fallback"
-        print(f"Processing step: {processing_step} (No specific reply/intent handled)")
+        log.debug("Processing step: %s (No specific reply/intent handled)", processing_step)
         reply_message = get_fallback_message(user, incoming_msg_body)
 
     # --- Send the determined reply message ---
-    response = MessagingResponse()
-    # Ensure we always have a string message to send
-    final_reply_to_send = reply_message if reply_message else "Sorry, an unexpected error occurred. Please try again."
-    response.message(final_reply_to_send)
-
-    # --- DEBUG PRINTS ---
-    print(f"DEBUG: Final Reply Message Variable: '{final_reply_to_send}'")
-    final_twiml = str(response)
-    print(f"DEBUG: Final TwiML Response:\n{final_twiml}")
-    # --- END DEBUG PRINTS ---
-
-    return final_twiml
\ No newline at end of file
+    final_twiml = render_twiml(reply_message)
+    log.info("Replied (step=%s, intent=%s)", processing_step, intent_name)
+    log.debug("Final TwiML Response:\n%s", final_twiml)
+
+    return final_twiml
@@ -0,0 +1,37 @@
+# tests/conftest.py
+# Shared fixtures. Tests use create_app('testing'): in-memory SQLite unless TEST_DATABASE_URL is set.
+import pytest
+
+from src import create_app
+from src.models import db, User
+
+
+@pytest.fixture
+def app():
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def session(app):
+    return db.session
+
+
+@pytest.fixture
+def make_worker(session):
+    """make_worker() adds a worker User and returns its id."""
+    count = 0
+
+    def make_worker():
+        nonlocal count
+        count += 1
+        worker = User(whatsapp_number=f'whatsapp:+9100000{count:05d}', role='worker')
+        session.add(worker)
+        session.flush()
+        return worker.id
+
+    return make_worker
@@ -0,0 +1,213 @@
+# tests/test_attendance_partitions.py
+# Archiving attendance months (src/attendance_partitions.py): export -> rollup -> drop, the checks
+# that stop a month being dropped without its export and rollups, and (on PostgreSQL, with
+# TEST_DATABASE_URL set) converting attendance_logs to monthly partitions.
+import gzip
+import os
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import text
+
+from src.attendance_partitions import (
+    DEFAULT_PARTITION, TABLE, ArchiveIncomplete,
+    add_months, archive_month, archived_until, check_archived, convert_to_partitioned, count_exported_rows,
+    create_partition, drop_month, export_month, is_partitioned, list_partitions, month_rows, month_start,
+    partition_name, rollup_month,
+)
+from src.hours import hours_by_worker
+from src.models import AttendanceArchive, AttendanceDailySummary, AttendanceLog
+
+JANUARY, FEBRUARY = date(2026, 1, 1), date(2026, 2, 1)
+NOW = datetime(2026, 4, 1)
+
+
+@pytest.fixture
+def attendance(session, make_worker):
+    """Two workers with shifts in January and February 2026. Returns their ids."""
+    first, second = make_worker(), make_worker()
+    events = [
+        (first, 'checkin', datetime(2026, 1, 5, 8)), (first, 'checkout', datetime(2026, 1, 5, 16)),
+        (first, 'checkin', datetime(2026, 1, 6, 8)),
+        (second, 'checkin', datetime(2026, 1, 20, 9)), (second, 'checkout', datetime(2026, 1, 20, 17)),
+        (first, 'checkin', datetime(2026, 2, 2, 8)), (first, 'checkout', datetime(2026, 2, 2, 12)),
+    ]
+    session.add_all(AttendanceLog(user_id=user_id, log_type=log_type, timestamp=when) for user_id, log_type, when in events)
+    session.commit()
+    return first, second
+
+
+@pytest.fixture
+def postgresql(session):
+    connection = session.connection()
+    if connection.dialect.name != 'postgresql':
+        pytest.skip("needs PostgreSQL (set TEST_DATABASE_URL)")
+    return connection
+
+
+def record_archive(session, month, directory):
+    """Export and rollup for month plus its attendance_archives row, without dropping anything."""
+    path, written = export_month(session, month, directory)
+    archive = AttendanceArchive(month=month, row_count=written, summary_rows=rollup_month(session, month), file_path=path)
+    session.add(archive)
+    session.flush()
+    return archive
+
+
+def test_archive_round_trip(app, session, attendance, tmp_path):
+    first, second = attendance
+    span = (datetime(2026, 1, 1), datetime(2026, 3, 1))
+    before = hours_by_worker(session, [first, second], *span, now=NOW)
+
+    archive = archive_month(session, JANUARY, month_rows(session, JANUARY), str(tmp_path))
+    assert (archive.row_count, archive.summary_rows) == (5, 3)
+    assert month_rows(session, JANUARY) == 0
+    assert month_rows(session, FEBRUARY) == 2
+    assert count_exported_rows(archive.file_path) == 5
+    assert archived_until(session) == datetime(2026, 2, 1)
+    assert hours_by_worker(session, [first, second], *span, now=NOW, archived_until=archived_until(session)) == before
+
+    # The export restores the month with `flask import attendance`
+    result = app.test_cli_runner().invoke(args=['import', 'attendance', archive.file_path])
+    assert result.exit_code == 0, result.output
+    assert month_rows(session, JANUARY) == 5
+
+
+def test_export_holds_the_months_rows(session, attendance, tmp_path):
+    path, written = export_month(session, JANUARY, str(tmp_path))
+    assert written == 5
+    with gzip.open(path, 'rt') as f:
+        lines = f.read().splitlines()
+    assert lines[0] == 'id,user_id,sampatti_card_id,whatsapp_number,log_type,timestamp'
+    assert lines[1].endswith(',checkin,2026-01-05T08:00:00')
+    assert not os.path.exists(path + '.partial')
+
+
+def test_drop_needs_an_archive_row(session, attendance):
+    with pytest.raises(ArchiveIncomplete, match='no attendance_archives row'):
+        drop_month(session, JANUARY)
+    assert month_rows(session, JANUARY) == 5
+
+
+def test_drop_needs_the_export_file(session, attendance, tmp_path):
+    archive = record_archive(session, JANUARY, str(tmp_path))
+    os.remove(archive.file_path)
+    with pytest.raises(ArchiveIncomplete, match='missing'):
+        drop_month(session, JANUARY)
+    assert month_rows(session, JANUARY) == 5
+
+
+def test_drop_needs_a_complete_export(session, attendance, tmp_path):
+    archive = record_archive(session, JANUARY, str(tmp_path))
+    with gzip.open(archive.file_path, 'rt') as f:
+        lines = f.readlines()
+    with gzip.open(archive.file_path, 'wt') as f:
+        f.writelines(lines[:-1])
+    with pytest.raises(ArchiveIncomplete, match='has 4 rows, expected 5'):
+        check_archived(session, JANUARY)
+    with open(archive.file_path, 'r+b') as f:
+        f.truncate(20) # Cut inside the gzip stream
+    with pytest.raises(ArchiveIncomplete, match="can't be read"):
+        drop_month(session, JANUARY)
+    assert month_rows(session, JANUARY) == 5
+
+
+def test_drop_needs_the_rollups(session, attendance, tmp_path):
+    record_archive(session, JANUARY, str(tmp_path))
+    session.query(AttendanceDailySummary).filter(AttendanceDailySummary.day < FEBRUARY).delete()
+    with pytest.raises(ArchiveIncomplete, match='0 daily summaries, expected 3'):
+        drop_month(session, JANUARY)
+    assert month_rows(session, JANUARY) == 5
+
+
+def test_drop_refuses_rows_added_after_the_export(session, attendance, tmp_path):
+    first, _ = attendance
+    record_archive(session, JANUARY, str(tmp_path))
+    session.add(AttendanceLog(user_id=first, log_type='checkout', timestamp=datetime(2026, 1, 6, 15)))
+    session.flush()
+    with pytest.raises(ArchiveIncomplete, match='has 6 rows but 5 were archived'):
+        drop_month(session, JANUARY)
+    assert month_rows(session, JANUARY) == 6
+
+
+# --- PostgreSQL partitions ---
+
+def test_convert_to_partitioned(session, attendance, postgresql):
+    first, _ = attendance
+    ids = sorted(session.scalars(text(f"SELECT id FROM {TABLE}")))
+    created = convert_to_partitioned(postgresql, ahead=2)
+    session.commit()
+
+    connection = session.connection()
+    assert is_partitioned(connection)
+    current = month_start(datetime.utcnow())
+    months = sorted(list_partitions(connection))
+    assert months[0] == JANUARY and months[-1] == add_months(current, 2)
+    assert len(months) == len(created) == (add_months(current, 2).year - 2026) * 12 + add_months(current, 2).month
+    assert sorted(session.scalars(text(f"SELECT id FROM {TABLE}"))) == ids
+    assert session.scalar(text(f"SELECT count(*) FROM {partition_name(JANUARY)}")) == 5
+    assert session.scalar(text(f"SELECT count(*) FROM {DEFAULT_PARTITION}")) == 0
+
+    # The id sequence carried over, and the indexes exist on the new table
+    log_ = AttendanceLog(user_id=first, log_type='checkin', timestamp=datetime.utcnow())
+    session.add(log_)
+    session.commit()
+    assert log_.id > max(ids)
+    indexes = set(session.scalars(text("SELECT indexname FROM pg_indexes WHERE tablename = :table"), {'table': TABLE}))
+    assert {f'{TABLE}_pkey', 'ix_attendance_logs_user_timestamp'} <= indexes
+    # Scans bounded by timestamp only touch the months they cover
+    plan = '\n'.join(session.scalars(text(
+        f"EXPLAIN SELECT * FROM {TABLE} WHERE timestamp >= '2026-01-01' AND timestamp < '2026-02-01'"
+    )))
+    assert partition_name(JANUARY) in plan and partition_name(FEBRUARY) not in plan
+
+
+def test_create_partition_moves_rows_out_of_the_default(session, attendance, postgresql):
+    first, _ = attendance
+    convert_to_partitioned(postgresql, ahead=0)
+    later = add_months(month_start(datetime.utcnow()), 6)
+    session.add(AttendanceLog(user_id=first, log_type='checkin', timestamp=datetime(later.year, later.month, 3, 9)))
+    session.commit()
+    assert session.scalar(text(f"SELECT count(*) FROM {DEFAULT_PARTITION}")) == 1
+
+    assert create_partition(session.connection(), later) == partition_name(later)
+    session.commit()
+    assert session.scalar(text(f"SELECT count(*) FROM {DEFAULT_PARTITION}")) == 0
+    assert session.scalar(text(f"SELECT count(*) FROM {partition_name(later)}")) == 1
+    assert later in list_partitions(session.connection())
+
+
+@pytest.mark.parametrize('keep_detached', [False, True])
+def test_archive_drops_the_partition(session, attendance, postgresql, tmp_path, keep_detached):
+    first, second = attendance
+    convert_to_partitioned(postgresql, ahead=0)
+    session.commit()
+    before = hours_by_worker(session, [first, second], datetime(2026, 1, 1), datetime(2026, 3, 1), now=NOW)
+
+    archive = archive_month(session, JANUARY, month_rows(session, JANUARY), str(tmp_path), keep_detached=keep_detached)
+    name = partition_name(JANUARY)
+    assert JANUARY not in list_partitions(session.connection())
+    assert FEBRUARY in list_partitions(session.connection())
+    assert month_rows(session, JANUARY) == 0
+    exists = session.scalar(text("SELECT to_regclass(:name) IS NOT NULL"), {'name': name})
+    assert exists == keep_detached
+    assert archive.detached_table == (name if keep_detached else None)
+    assert hours_by_worker(
+        session, [first, second], datetime(2026, 1, 1), datetime(2026, 3, 1), now=NOW, archived_until=datetime(2026, 2, 1)
+    ) == before
+    if keep_detached:
+        assert session.scalar(text(f"SELECT count(*) FROM {name}")) == 5
+        session.execute(text(f"DROP TABLE {name}"))
+        session.commit()
+
+
+def test_partition_is_kept_when_the_archive_is_incomplete(session, attendance, postgresql, tmp_path):
+    convert_to_partitioned(postgresql, ahead=0)
+    session.commit()
+    archive = record_archive(session, JANUARY, str(tmp_path))
+    os.remove(archive.file_path)
+    with pytest.raises(ArchiveIncomplete):
+        drop_month(session, JANUARY)
+    session.rollback()
+    assert JANUARY in list_partitions(session.connection())
+    assert month_rows(session, JANUARY) == 5
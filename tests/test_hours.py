@@ -0,0 +1,153 @@
+# tests/test_hours.py
+# The SQL hours engine (src/hours.py) on SQLite, one test per rule in its header comment, plus the
+# merge with the daily rollups of archived months.
+from datetime import date, datetime
+
+import pytest
+
+from src.attendance_partitions import archive_month, month_rows
+from src.hours import daily_hours, hours_by_worker, month_range
+from src.models import AttendanceDailySummary, AttendanceLog
+
+MARCH = month_range(date(2026, 3, 1))
+NOW = datetime(2026, 4, 15, 12, 0) # Long after every March shift, so none of them is in progress
+
+
+def at(day, hour, minute=0, month=3):
+    return datetime(2026, month, day, hour, minute)
+
+
+@pytest.fixture
+def log_events(session):
+    """log_events(user_id, ('checkin', when), ('checkout', when), ...) adds AttendanceLog rows."""
+    def log_events(user_id, *events):
+        session.add_all(AttendanceLog(user_id=user_id, log_type=log_type, timestamp=when) for log_type, when in events)
+        session.flush()
+    return log_events
+
+
+def march_hours(session, user_ids, **kwargs):
+    kwargs.setdefault('now', NOW)
+    return hours_by_worker(session, user_ids, *MARCH, **kwargs)
+
+
+def test_paired_shifts(session, make_worker, log_events):
+    worker = make_worker()
+    log_events(
+        worker,
+        ('checkin', at(2, 8)), ('checkout', at(2, 16)),
+        ('checkin', at(2, 18)), ('checkout', at(2, 20, 30)),
+        ('checkin', at(3, 9)), ('checkout', at(3, 12)),
+    )
+    summary = march_hours(session, [worker])[worker]
+    assert summary.hours == 13.5
+    assert summary.days_worked == 2
+    assert summary.shifts == 3
+    assert summary.missing_checkouts == 0
+    assert summary.in_progress_since is None
+
+
+def test_repeated_checkin_counts_from_the_first(session, make_worker, log_events):
+    worker = make_worker()
+    log_events(worker, ('checkin', at(2, 8)), ('checkin', at(2, 8, 30)), ('checkin', at(2, 9)), ('checkout', at(2, 16)))
+    summary = march_hours(session, [worker])[worker]
+    assert (summary.hours, summary.shifts, summary.missing_checkouts) == (8.0, 1, 0)
+
+
+def test_repeated_checkout_ends_at_the_last(session, make_worker, log_events):
+    worker = make_worker()
+    log_events(worker, ('checkin', at(2, 8)), ('checkout', at(2, 12)), ('checkout', at(2, 16)))
+    summary = march_hours(session, [worker])[worker]
+    assert (summary.hours, summary.shifts) == (8.0, 1)
+
+
+def test_checkin_after_max_shift_starts_a_new_run(session, make_worker, log_events):
+    worker = make_worker()
+    # Forgot to check out on the 2nd; the next day's checkin is a new shift, not a repeat
+    log_events(worker, ('checkin', at(2, 8)), ('checkin', at(3, 8)), ('checkout', at(3, 16)))
+    summary = march_hours(session, [worker])[worker]
+    assert (summary.hours, summary.shifts, summary.missing_checkouts, summary.days_worked) == (8.0, 1, 1, 1)
+
+
+def test_checkout_long_before_the_next_is_kept(session, make_worker, log_events):
+    worker = make_worker()
+    # A stray checkout a day later must not stretch the shift to 32 hours
+    log_events(worker, ('checkin', at(2, 8)), ('checkout', at(2, 16)), ('checkout', at(3, 16)))
+    summary = march_hours(session, [worker])[worker]
+    assert (summary.hours, summary.shifts, summary.missing_checkouts) == (8.0, 1, 0)
+
+
+def test_checkout_beyond_max_shift_is_a_missing_checkout(session, make_worker, log_events):
+    worker = make_worker()
+    log_events(worker, ('checkin', at(2, 8)), ('checkout', at(3, 10)))
+    summary = march_hours(session, [worker])[worker]
+    assert (summary.hours, summary.shifts, summary.missing_checkouts, summary.days_worked) == (0.0, 0, 1, 0)
+    # A longer max_shift pairs them
+    summary = march_hours(session, [worker], max_shift_hours=30)[worker]
+    assert (summary.hours, summary.shifts, summary.missing_checkouts) == (26.0, 1, 0)
+
+
+def test_recent_unpaired_checkin_is_in_progress(session, make_worker, log_events):
+    worker = make_worker()
+    log_events(worker, ('checkin', at(2, 8)), ('checkout', at(2, 16)), ('checkin', at(20, 9)))
+    summary = march_hours(session, [worker], now=at(20, 11))[worker]
+    assert summary.in_progress_since == at(20, 9)
+    assert (summary.hours, summary.shifts, summary.missing_checkouts) == (8.0, 1, 0)
+    # Once max_shift has passed without a checkout it is a missing checkout instead
+    summary = march_hours(session, [worker], now=at(21, 9, 1))[worker]
+    assert summary.in_progress_since is None
+    assert summary.missing_checkouts == 1
+
+
+def test_shift_counts_towards_the_day_and_month_it_started(session, make_worker, log_events):
+    worker = make_worker()
+    log_events(worker, ('checkin', at(31, 22)), ('checkout', at(1, 6, month=4)))
+    assert march_hours(session, [worker])[worker].hours == 8.0
+    assert hours_by_worker(session, [worker], *month_range(date(2026, 4, 1)), now=NOW) == {}
+    assert daily_hours(session, [worker], *MARCH, now=NOW) == [(worker, date(2026, 3, 31), 8.0, 1, 0)]
+
+
+def test_boundary_margin_sees_a_run_started_before_the_range(session, make_worker, log_events):
+    worker = make_worker()
+    # The 01:00 checkin repeats the one from February 28th, so March has no shift of its own
+    log_events(worker, ('checkin', at(28, 23, month=2)), ('checkin', at(1, 1)), ('checkout', at(1, 7)))
+    assert march_hours(session, [worker]) == {}
+    february = hours_by_worker(session, [worker], *month_range(date(2026, 2, 1)), now=NOW)
+    assert february[worker].hours == 8.0
+
+
+def test_workers_are_independent(session, make_worker, log_events):
+    first, second, idle = make_worker(), make_worker(), make_worker()
+    log_events(first, ('checkin', at(2, 8)), ('checkout', at(2, 12)))
+    log_events(second, ('checkin', at(2, 9)), ('checkout', at(2, 10)))
+    hours = march_hours(session, [first, second, idle])
+    assert {user_id: summary.hours for user_id, summary in hours.items()} == {first: 4.0, second: 1.0}
+
+
+def test_archived_months_are_read_from_rollups(session, make_worker, log_events, tmp_path):
+    first, second = make_worker(), make_worker()
+    log_events(
+        first,
+        ('checkin', at(5, 8, month=1)), ('checkout', at(5, 16, month=1)),
+        ('checkin', at(6, 8, month=1)), # Missing checkout
+        ('checkin', at(31, 22, month=1)), ('checkout', at(1, 4, month=2)), # Crosses into February
+        ('checkin', at(3, 8, month=2)), ('checkout', at(3, 10, month=2)),
+    )
+    log_events(second, ('checkin', at(20, 9, month=1)), ('checkout', at(20, 17, month=1)))
+    span = (datetime(2026, 1, 1), datetime(2026, 3, 1))
+    before = hours_by_worker(session, [first, second], *span, now=NOW)
+
+    january = date(2026, 1, 1)
+    assert archive_month(session, january, month_rows(session, january), str(tmp_path)).summary_rows == 4
+    assert session.query(AttendanceLog).filter(AttendanceLog.timestamp < datetime(2026, 2, 1)).count() == 0
+
+    after = hours_by_worker(session, [first, second], *span, now=NOW, archived_until=datetime(2026, 2, 1))
+    assert after == before
+    assert after[first].hours == 16.0
+    assert (after[first].days_worked, after[first].shifts, after[first].missing_checkouts) == (3, 3, 1)
+    # A range inside the archive comes from the rollups alone
+    mid_january = hours_by_worker(
+        session, [first, second], datetime(2026, 1, 10), datetime(2026, 1, 25), now=NOW, archived_until=datetime(2026, 2, 1)
+    )
+    assert {user_id: summary.hours for user_id, summary in mid_january.items()} == {second: 8.0}
+    assert session.get(AttendanceDailySummary, (first, date(2026, 1, 31))).worked_seconds == 6 * 3600
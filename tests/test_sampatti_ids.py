@@ -0,0 +1,60 @@
+# tests/test_sampatti_ids.py
+# Sampatti card IDs are kept as typed (src/models.py clean_sampatti_id) on every path that stores or
+# looks one up, so an ID registered through one path is found by all the others (bulk salary too).
+from src.bulk_salary import handle_bulk_log_salary
+from src.commands import get_user_by_sampatti_id, handle_log_salary_params, handle_register_params
+from src.intents import match_local_intent, match_slot_answer
+from src.models import SalaryLog, User, clean_sampatti_id
+
+
+def test_clean_sampatti_id():
+    assert clean_sampatti_id('  abc१२३ ') == 'abc123'
+    assert clean_sampatti_id('W0000012') == 'W0000012'
+    assert clean_sampatti_id(None) == ''
+
+
+def test_local_matcher_keeps_the_case():
+    assert match_local_intent('register abc123 worker')[1]['sampatti_id'] == 'abc123'
+    assert match_slot_answer('w१२', ('sampatti_id',)) == {'sampatti_id': 'w12'}
+
+
+def test_lowercase_id_is_found_on_every_path(session):
+    assert handle_register_params('whatsapp:+910000000001', 'abc123', 'worker').startswith('Welcome!')
+    employer = User(whatsapp_number='whatsapp:+910000000002', role='employer')
+    session.add(employer)
+    session.commit()
+
+    _, parameters, _ = match_local_intent('log salary abc123 5000')
+    reply = handle_log_salary_params(employer, parameters['sampatti_id'], parameters['amount'])
+    assert reply.startswith('Successfully logged salary of 5000.00 for worker abc123')
+    assert get_user_by_sampatti_id(' abc123') is not None
+    assert 'already linked' in handle_register_params('whatsapp:+910000000003', 'abc123 ', 'worker')
+
+
+def test_bulk_salary_finds_ids_as_typed(session):
+    handle_register_params('whatsapp:+910000000001', 'abc123', 'worker')
+    employer = User(whatsapp_number='whatsapp:+910000000002', role='employer')
+    session.add(employer)
+    session.commit()
+    reply = handle_bulk_log_salary(employer, [(1, (' abc123', '100', None, None)), (2, ('ABC123', '200', None, None))])
+    assert session.query(SalaryLog).count() == 1
+    assert "no worker found with Sampatti ID 'ABC123'" in reply
+
+
+def test_users_import_matches_ids_ignoring_case(app, session, tmp_path):
+    handle_register_params('whatsapp:+910000000001', 'abc123', 'worker')
+    handle_register_params('whatsapp:+910000000002', 'xyz789', 'worker')
+    session.add(User(whatsapp_number='whatsapp:+910000000003', role='employer'))
+    session.commit()
+    path = tmp_path / 'users.csv'
+    path.write_text(
+        "whatsapp_number,sampatti_card_id,role\n"
+        "+910000000001,ABC123,worker\n" # Same card, new case: stored as given and reported
+        "+910000000003,XYZ789,employer\n" # Another user's card in another case: rejected
+    )
+    result = app.test_cli_runner().invoke(args=['import', 'users', str(path)])
+    assert result.exit_code == 0, result.output
+    assert '1 card IDs re-cased' in result.output
+    assert 'belongs to another user' in result.output
+    assert session.query(User).filter_by(whatsapp_number='whatsapp:+910000000001').one().sampatti_card_id == 'ABC123'
+    assert session.query(User).filter_by(sampatti_card_id='XYZ789').count() == 0
@@ -0,0 +1,180 @@
+# tests/test_voice.py
+# The Ogg/Opus pre-flight (src/voice.py) on synthetic voice notes. Pages are built here with a
+# bit-by-bit CRC, independent of the table-driven one under test.
+import struct
+
+import pytest
+
+from src.voice import (
+    OGG_EOS, OGG_HEADER, OPUS_RATE, VoiceNoteRejected,
+    inspect_ogg_opus, ogg_crc, opus_packet_samples, preflight_voice_note, trim_ogg_opus,
+)
+
+PRE_SKIP = 312
+SILK_20MS = (9 << 3) # TOC byte: SILK wideband, 20 ms, one frame
+
+
+def reference_crc(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) & 0xFFFFFFFF if crc & 0x80000000 else (crc << 1) & 0xFFFFFFFF
+    return crc
+
+
+def ogg_page(segments, granule, sequence, header_type=0, serial=7):
+    """One Ogg page. segments are (bytes, complete) pairs; an incomplete one continues on the next page."""
+    lacing = bytearray()
+    for body, complete in segments:
+        lacing += bytes([255]) * (len(body) // 255)
+        if complete:
+            lacing.append(len(body) % 255)
+    header = OGG_HEADER.pack(b'OggS', 0, header_type, granule, serial, sequence, 0, len(lacing))
+    page = bytearray(header + bytes(lacing) + b''.join(body for body, _ in segments))
+    page[22:26] = struct.pack('<I', reference_crc(page))
+    return bytes(page)
+
+
+def voice_note(seconds, channels=1, silent=False, input_rate=16000, packet_bytes=40):
+    """A WhatsApp-style note: OpusHead and OpusTags pages, then one page of 20 ms SILK packets per second."""
+    head = b'OpusHead' + struct.pack('<BBHIhB', 1, channels, PRE_SKIP, input_rate, 0, 0)
+    tags = b'OpusTags' + struct.pack('<I', 4) + b'test' + struct.pack('<I', 0)
+    pages = [ogg_page([(head, True)], 0, 0, header_type=0x02), ogg_page([(tags, True)], 0, 1)]
+    packet = bytes([SILK_20MS]) + b'\x55' * ((2 if silent else packet_bytes) - 1)
+    for second in range(seconds):
+        granule = PRE_SKIP + (second + 1) * OPUS_RATE
+        last = second == seconds - 1
+        pages.append(ogg_page([(packet, True)] * 50, granule, second + 2, header_type=OGG_EOS if last else 0))
+    return b''.join(pages)
+
+
+def split_pages(data):
+    pages, offset = [], 0
+    while offset < len(data):
+        segments = data[offset + 26]
+        end = offset + OGG_HEADER.size + segments + sum(data[offset + OGG_HEADER.size:offset + OGG_HEADER.size + segments])
+        pages.append(data[offset:end])
+        offset = end
+    return pages
+
+
+def crc_matches(page):
+    zeroed = bytearray(page)
+    zeroed[22:26] = b'\0\0\0\0'
+    return struct.unpack_from('<I', page, 22)[0] == reference_crc(zeroed)
+
+
+def rejection(data, **kwargs):
+    with pytest.raises(VoiceNoteRejected) as excinfo:
+        preflight_voice_note(data, **kwargs)
+    return excinfo.value.reason
+
+
+def test_ogg_crc_matches_reference():
+    assert ogg_crc(b'123456789') == 0x89A1897F # CRC-32/CKSUM check value without the final inversion
+    sample = bytes(range(256)) * 3
+    assert ogg_crc(sample) == reference_crc(sample)
+    assert ogg_crc(b'') == 0
+
+
+def test_mono_clip_passes_unchanged():
+    data = voice_note(3)
+    clip = preflight_voice_note(data)
+    assert clip.audio == data
+    assert clip.duration == pytest.approx(3.0)
+    assert clip.speech_seconds == pytest.approx(3.0)
+    assert clip.sample_rate == 16000
+    assert not clip.trimmed
+
+
+def test_stereo_clip_is_rejected():
+    assert rejection(voice_note(2, channels=2)) == 'channels'
+
+
+def test_silent_clip_is_rejected():
+    assert rejection(voice_note(4, silent=True)) == 'silent'
+
+
+def test_min_speech_seconds_threshold():
+    data = voice_note(1)
+    assert preflight_voice_note(data, min_speech_seconds=1.0).speech_seconds == pytest.approx(1.0)
+    assert rejection(data, min_speech_seconds=1.5) == 'silent'
+
+
+@pytest.mark.parametrize('input_rate, sent_rate', [(8000, 8000), (48000, 48000), (44100, 48000), (0, 16000)])
+def test_sample_rate_comes_from_opus_head(input_rate, sent_rate):
+    assert preflight_voice_note(voice_note(1, input_rate=input_rate)).sample_rate == sent_rate
+
+
+def test_over_length_clip_is_trimmed_at_a_page_boundary():
+    data = voice_note(70)
+    clip = preflight_voice_note(data, max_seconds=55)
+    assert clip.trimmed
+    assert clip.duration == pytest.approx(55.0)
+    assert data.startswith(clip.audio[:-len(split_pages(clip.audio)[-1])])
+
+    pages = split_pages(clip.audio)
+    assert len(pages) == 2 + 55
+    assert all(crc_matches(page) for page in pages)
+    assert pages[-1][5] & OGG_EOS
+    assert not any(page[5] & OGG_EOS for page in pages[:-1])
+    # The trimmed file is itself a valid note of the trimmed length
+    assert inspect_ogg_opus(clip.audio).duration == pytest.approx(55.0)
+
+
+def test_trim_keeps_clip_within_limit():
+    data = voice_note(3)
+    info = inspect_ogg_opus(data)
+    assert trim_ogg_opus(data, info, 10) == (data, pytest.approx(3.0))
+    audio, duration = trim_ogg_opus(data, info, 1.5)
+    assert duration == pytest.approx(1.0) # Cut after the last page ending within the limit
+    assert inspect_ogg_opus(audio).duration == pytest.approx(1.0)
+
+
+def test_truncated_page_is_rejected():
+    data = voice_note(2)
+    assert rejection(data[:-10]) == 'corrupt'
+    assert rejection(data[:len(data) - len(split_pages(data)[-1]) + 20]) == 'corrupt' # Cut inside the page header
+
+
+def test_garbage_between_pages_is_rejected():
+    pages = split_pages(voice_note(2))
+    assert rejection(b''.join(pages[:3]) + b'junk' + b''.join(pages[3:])) == 'corrupt'
+
+
+def test_non_ogg_and_non_opus_are_rejected():
+    assert rejection(b'ID3\x03' + b'\0' * 100) == 'unsupported_format'
+    vorbis = ogg_page([(b'\x01vorbis' + b'\0' * 23, True)], 0, 0, header_type=0x02)
+    assert rejection(vorbis) == 'unsupported_format'
+
+
+def test_multiplexed_streams_are_rejected():
+    pages = split_pages(voice_note(1))
+    other = ogg_page([(b'\x01vorbis' + b'\0' * 23, True)], 0, 0, header_type=0x02, serial=99)
+    assert rejection(b''.join(pages[:1]) + other + b''.join(pages[1:])) == 'unsupported_format'
+
+
+def test_packet_continued_across_pages_is_counted_once():
+    head = b'OpusHead' + struct.pack('<BBHIhB', 1, 1, PRE_SKIP, 16000, 0, 0)
+    tags = b'OpusTags' + struct.pack('<I', 0) + struct.pack('<I', 0)
+    packet = bytes([SILK_20MS]) + b'\x55' * 599 # Three lacing values, split 510 / 90 over two pages
+    data = b''.join([
+        ogg_page([(head, True)], 0, 0, header_type=0x02),
+        ogg_page([(tags, True)], 0, 1),
+        ogg_page([(packet[:510], False)], -1, 2),
+        ogg_page([(packet[510:], True)], PRE_SKIP + 960, 3, header_type=0x01 | OGG_EOS),
+    ])
+    info = inspect_ogg_opus(data)
+    assert info.duration == pytest.approx(0.02)
+    assert info.speech_seconds == pytest.approx(0.02)
+
+
+@pytest.mark.parametrize('packet, samples', [
+    (bytes([SILK_20MS]), 960),
+    (bytes([(3 << 3) | 1]), 2 * 2880), # SILK 60 ms, two frames
+    (bytes([(16 << 3) | 3, 6]), 6 * 120), # CELT 2.5 ms, code 3 with six frames
+    (b'', 0),
+])
+def test_opus_packet_samples(packet, samples):
+    assert opus_packet_samples(packet) == samples